@@ -2,9 +2,18 @@
 
 import file_utils as fu
 import utils as u
+import sweep as sw
+import reference as rs
+import intervals as iv
+import transcripts as tx
+import bgzf
+from concurrent.futures import ThreadPoolExecutor
 
 indicesKnownGenes = [12, 1, 3]  # 12 for gene
 
+# Records read per batch; stages resolve each batch's lookups together
+BATCH_SIZE = 1000
+
 
 def collapseGeneNames(row, indices, region, cnt):
     names = [
@@ -38,66 +47,75 @@ def collapseGeneNames(row, indices, region, cnt):
 
 """"Collapces bigRefSegTable
 """
+REFSEQ_NAMES = [
+    "chr",
+    "start",
+    "end",
+    "haplotypeReference",
+    "haplotypeAlternate",
+    "name",
+    "name2",
+    "transcriptStrand",
+    "positionType",
+    "frame",
+    "mrnaCoord",
+    "codonCoord",
+    "spliceDist",
+    "referenceCodon",
+    "referenceAA",
+    "variantCodon",
+    "variantAA",
+    "changesAA",
+    "functionalClass",
+    "codingCoordStr",
+    "proteinCoordStr",
+    "inCodingRegion",
+    "spliceInfo",
+    "uorfChange",
+]
+
+# (field position, "name=") for the fields that are reported
+REFSEQ_TEMPLATE = [
+    (i, name.strip() + "=") for i, name in enumerate(REFSEQ_NAMES) if i > 4
+]
 
 
 def collapseRefSeq(line):
-    names = [
-        "chr",
-        "start",
-        "end",
-        "haplotypeReference",
-        "haplotypeAlternate",
-        "name",
-        "name2",
-        "transcriptStrand",
-        "positionType",
-        "frame",
-        "mrnaCoord",
-        "codonCoord",
-        "spliceDist",
-        "referenceCodon",
-        "referenceAA",
-        "variantCodon",
-        "variantAA",
-        "changesAA",
-        "functionalClass",
-        "codingCoordStr",
-        "proteinCoordStr",
-        "inCodingRegion",
-        "spliceInfo",
-        "uorfChange",
-    ]
     fields = line.strip().split("\t")
-    fcount = 0
     collapsed = []
 
-    for f in fields:
-        if fcount > 4:
-            if len(str(f)) > 0 and str(f) != "0":
-                collapsed.append(str(names[fcount]).strip() + "=" + str(f).strip())
-        fcount = fcount + 1
+    for fcount, f in enumerate(fields):
+        if fcount > 4 and len(f) > 0 and f != "0":
+            collapsed.append(REFSEQ_NAMES[fcount].strip() + "=" + f.strip())
 
     return ";".join(collapsed)
 
 
-def binarySearchUniqueAndSorted(arg0, key):
-    low = 0
-    high = len(arg0) - 1
-    mid = 0
-    obj = 0
+"""Collapses a bigRefSeq table row (leading id column included) without
+joining it into a line first. Rows whose values would be reshaped by
+the line's strip and split take the line path
+"""
 
-    while low <= high:
-        mid = (low + high) / 2
-        obj = arg0[mid]
 
-        if obj < key:
-            low = mid + 1
-        elif obj > key:
-            high = mid - 1
-        else:
-            return mid
+def collapseRefSeqRow(row):
+    values = [str(x) for x in row[1:]]
+    if (
+        len(values) != len(REFSEQ_NAMES)
+        or values[0][:1].isspace()
+        or values[0] == ""
+        or values[-1][-1:].isspace()
+        or values[-1] == ""
+        or "\t" in "".join(values)
+    ):
+        return collapseRefSeq("\t".join(values))
 
-    return -1  # NOT_FOUND
+    collapsed = []
+    for i, prefix in REFSEQ_TEMPLATE:
+        f = values[i]
+        if len(f) > 0 and f != "0":
+            collapsed.append(prefix + f.strip())
+
+    return ";".join(collapsed)
 
 
 """Cleans characters not accepted by MySQL
@@ -137,760 +155,1081 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+"""Base class for an annotation stage
+A stage annotates one parsed record (list of fields) at a time, so stages
+can either be chained through temp files or fused into a single pass.
+Stages given a reference snapshot (see snapshot.py) answer lookups from
+it for the tables it holds instead of querying the database.
+Before a batch of records is annotated, prefetch() gets the records the
+stage will see so it can resolve their lookups with a few batched store
+calls; annotate() must still work for records that were not prefetched.
+The attributes named in counters are what writeLog() reports; stages run
+over separate parts of a file are combined with getCounts()/addCounts().
+getMetrics()/addMetrics() do the same for how often the window cursors
+(see intervals.WindowCursor) in cursors answered a lookup; they depend on
+the order records arrive in, so they go to the job log, not the count log.
+An independent stage only appends its own INFO keys and reads nothing
+earlier stages wrote, so its prefetch can run alongside the others
 """
 
 
-def getSnpsFromDbSnp(
-    vcf, format="vcf", tmpextin="", tmpextout=".1", varclass="SNV", sep="\t"
-):
+class Stage(object):
+    counters = []
+    independent = False
 
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + ".count.log"
-    fh_log = open(logcountfile, "w")
-    var_count = 0
+    def __init__(self, store, format="vcf", snapshot=None, sep="\t"):
+        self.store = store
+        self.inds = getFormatSpecificIndices(format=format)
+        self.snapshot = snapshot
+        self.sep = sep
+        self.cursors = []
+        self.metrics = {"cursor_hits": 0, "cursor_misses": 0}
 
-    inds = getFormatSpecificIndices(format=format)
+    def isHeader(self, line):
+        return (
+            line.startswith("##")
+            or line.startswith("CHROM")
+            or line.startswith("#CHROM")
+        )
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def prefetch(self, records):
+        pass
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace("chr", "")
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = (
-                'select * from dbSNP where CHR="'
-                + str(chr)
-                + '" AND POS='
-                + str(pos)
-                + ' AND ( REF="'
-                + str(ref)
-                + '" OR REF ="'
-                + str(compRef)
-                + '" )  AND INFO = "'
-                + varclass
-                + '" ;'
-            )
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+    def annotate(self, fields):
+        raise NotImplementedError
 
-            fields[2] = "."
-            rsids = []
-            mafs = []
-            if len(rows) > 0:
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if str(row[7]) != ".":
-                        mafs.append("GMAF=" + str(row[7]))
+    def getCounts(self):
+        return dict([(name, getattr(self, name)) for name in self.counters])
 
-                maf_str = ""
-                if len(mafs) > 0:
-                    maf_str = ";" + ";".join([str(x) for x in mafs])
+    def addCounts(self, counts):
+        for name in self.counters:
+            setattr(self, name, getattr(self, name) + counts[name])
 
-                var_count = var_count + 1
-                if str(fields[7]) == ".":
-                    fields[7] = "DB" + maf_str
-                else:
-                    fields[7] = fields[7] + ";DB;VC=" + varclass + maf_str
+    def getMetrics(self):
+        metrics = dict(self.metrics)
+        for cursor in self.cursors:
+            metrics["cursor_hits"] = metrics["cursor_hits"] + cursor.hits
+            metrics["cursor_misses"] = metrics["cursor_misses"] + cursor.misses
+        return metrics
+
+    def addMetrics(self, metrics):
+        for name in self.metrics:
+            self.metrics[name] = self.metrics[name] + metrics[name]
 
-                fields[2] = str(";".join(rsids))
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
+    """Wraps an index in a window cursor whose hits count toward the
+    stage's metrics
+    """
 
+    def addCursor(self, index):
+        cursor = iv.WindowCursor(index)
+        self.cursors.append(cursor)
+        return cursor
+
+    def writeLog(self, fh_log):
+        pass
+
+
+"""Re-splits a record the way the next stage would read it back from
+the temp file (whole line stripped, split on sep), if annotations changed it
+"""
+
+
+def reparse(fields, sep="\t"):
+    if fields[0][:1].isspace() or fields[-1][-1:].isspace():
+        return sep.join(fields).strip().split(sep)
+    for f in fields[2:8]:
+        if sep in f:
+            return sep.join(fields).strip().split(sep)
+    return fields
+
+
+"""One batch of input lines on its way through the stages
+fields holds each record as the stages have left it so far, or None while
+no stage has taken the line (headers pass through untouched)
+A variant cache (see varcache.py) fills in the records it holds before
+the stages run, with the counts each stage would have added (cached), and
+marks the records whose counts to collect for it (counts, under keys)
+"""
+
+
+class Batch(object):
+    def __init__(self, lines, sep="\t"):
+        self.lines = lines
+        self.sep = sep
+        self.records = [line.split(sep) for line in lines]
+        self.fields = [None] * len(lines)
+        self.cached = {}
+        self.counts = {}
+        self.keys = {}
+
+    def getRecords(self, stage):
+        records = []
+        for i, line in enumerate(self.lines):
+            if i in self.cached:
+                continue
+            fields = self.fields[i]
+            if not stage.isHeader(line if fields is None else fields[0]):
+                records.append(self.records[i] if fields is None else fields)
+        return records
+
+    """Runs stage, the one at position in the pipeline, over every record
+    it takes; the records are re-split for the next stage unless this is
+    the last one
+    """
+
+    def annotate(self, stage, position=0, last=False):
+        for i, line in enumerate(self.lines):
+            if i in self.cached:
+                stage.addCounts(dict(zip(stage.counters, self.cached[i][position])))
+                continue
+            fields = self.fields[i]
+            if stage.isHeader(line if fields is None else fields[0]):
+                continue
+            if fields is None:
+                fields = self.records[i]
+            if i in self.counts:
+                before = stage.getCounts()
+            fields = stage.annotate(fields)
+            if i in self.counts:
+                after = stage.getCounts()
+                self.counts[i][position] = [
+                    after[name] - before[name] for name in stage.counters
+                ]
+            if not last:
+                fields = reparse(fields, sep=self.sep)
+            self.fields[i] = fields
+
+    def write(self, fh_out):
+        for line, fields in zip(self.lines, self.fields):
+            if fields is None:
+                fh_out.write(line + "\n")
             else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write("\t".join([str(x) for x in fields]) + "\n")
+                fh_out.write(self.sep.join(fields) + "\n")
 
-            linenum = linenum + 1
 
-        else:
-            fh_out.write(line + "\n")
+"""Annotates one batch of lines with every stage and writes the results
+Each stage first prefetches the records it will annotate; the chromosome,
+position and alleles it keys on are never changed by earlier stages.
+Given an executor, independent stages prefetch concurrently. Records are
+then annotated stage by stage in pipeline order, so INFO fragments are
+merged exactly as a sequential run would. Given a variant cache, the
+records it holds skip the stages and the rest are added to it
+"""
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def annotateBatch(lines, stages, fh_out, sep="\t", executor=None, cache=None):
+    batch = Batch(lines, sep=sep)
+    if cache is not None:
+        cache.resolve(batch, stages)
+    pending = []
+    for stage in stages:
+        if executor is not None and stage.independent:
+            pending.append(executor.submit(stage.prefetch, batch.getRecords(stage)))
+        else:
+            stage.prefetch(batch.getRecords(stage))
+    for future in pending:
+        future.result()
 
+    last = len(stages) - 1
+    for i, stage in enumerate(stages):
+        batch.annotate(stage, position=i, last=i == last)
+    if cache is not None:
+        cache.store(batch, stages)
+    batch.write(fh_out)
 
-"""NOTE: all isoforms are collapsed in one record
-    1. chrom_pos_equal_base
-    2. chrom_pos_equal_nobase
-    3. chrom_pos_unequal
+
+"""Yields the lines of infile that start in the byte range [start, end)
+start must be the beginning of a line
 """
 
 
-def getBigRefGene(vcf, format="vcf", tmpextin=".1", tmpextout=".2", sep="\t"):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
+def readLines(infile, start=0, end=None):
+    with open(infile, "rb") as fh:
+        fh.seek(start)
+        offset = start
+        for raw in fh:
+            if end is not None and offset >= end:
+                break
+            offset = offset + len(raw)
+            yield raw.decode("utf-8")
+
+
+def openInput(infile, start=0, end=None):
+    if not isinstance(infile, str):
+        return iter(infile)
+    if start == 0 and end is None:
+        return bgzf.openText(infile)
+    return readLines(infile, start, end)
+
+
+def openOutput(outfile):
+    if not isinstance(outfile, str):
+        return outfile
+    return open(outfile, "w")
+
+
+def closeFiles(infile, fh, outfile, fh_out):
+    if isinstance(infile, str):
+        fh.close()
+    if isinstance(outfile, str):
+        fh_out.close()
+
+
+"""Runs stages over the input file in a single pass
+Every record is parsed once and handed from stage to stage in memory;
+only the output file and the combined count log are written. Records are
+read batch_size at a time so stages can batch their lookups. Given a byte
+range (start, end), only the lines starting inside it are annotated;
+otherwise the input may be gzip or BGZF compressed.
+With threads > 0, independent stages prefetch each batch concurrently;
+they must not share a store. infile and outfile may also be an iterable
+of lines and a writable text stream (see s3stream.py), which are left
+open for the caller. Given a variant cache (varcache.VariantCache, or a
+panel.Panel, or varcache.Tiers of them), its hits and misses follow the
+stages in the count log
+"""
 
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
 
+def runStages(
+    infile,
+    outfile,
+    stages,
+    logcountfile=None,
+    logmode="a",
+    sep="\t",
+    batch_size=BATCH_SIZE,
+    start=0,
+    end=None,
+    threads=0,
+    cache=None,
+):
+    fh = openInput(infile, start, end)
+    fh_out = openOutput(outfile)
+    executor = ThreadPoolExecutor(max_workers=threads) if threads > 0 else None
+
+    lines = []
     for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace("chr", "")
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = (
-                'select * from chrom_pos_equal_base where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ' AND ((haplotypeReference="'
-                + str(ref)
-                + '" AND haplotypeAlternate ="'
-                + str(alt)
-                + '") OR (haplotypeReference="'
-                + str(compRef)
-                + '" AND haplotypeAlternate ="'
-                + str(compAlt)
-                + '"));'
+        lines.append(line.strip())
+        if len(lines) >= batch_size:
+            annotateBatch(
+                lines, stages, fh_out, sep=sep, executor=executor, cache=cache
             )
+            lines = []
+    if len(lines) > 0:
+        annotateBatch(lines, stages, fh_out, sep=sep, executor=executor, cache=cache)
 
-            sql2 = (
-                'select * from chrom_pos_equal_nobase where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ";"
-            )
+    if executor is not None:
+        executor.shutdown()
+    closeFiles(infile, fh, outfile, fh_out)
 
-            sql3 = (
-                'select * from chrom_pos_unequal where CHR="'
-                + str(chr)
-                + '" AND start <= '
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= end ;"
-            )
+    if logcountfile is not None:
+        fh_log = open(logcountfile, logmode)
+        for stage in stages:
+            stage.writeLog(fh_log)
+        if cache is not None:
+            cache.writeLog(fh_log)
+        fh_log.close()
+
+
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+"""
+
+
+class DbSnpStage(Stage):
+    counters = ["var_count", "linenum"]
+
+    def __init__(self, store, format="vcf", varclass="SNV", snapshot=None, sep="\t"):
+        Stage.__init__(self, store, format=format, snapshot=snapshot, sep=sep)
+        self.varclass = varclass
+        self.var_count = 0
+        self.linenum = 1
+        self.prefetched = {}
+
+        self.index = None
+        if snapshot is not None:
+            self.index = snapshot.dbsnp()
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    def getKey(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if chr.startswith("chr"):
+            chr = chr.replace("chr", "")
+        return (chr, int(fields[self.inds[1]].strip()))
+
+    """Rows for each key as (rsID, REF, INFO, GMAF), from the snapshot's
+    dbSNP index when it has one, otherwise from the store
+    """
+
+    def lookup(self, keys):
+        if self.index is not None:
+            return self.index.lookup(keys)
+        return [
+            [(row[3], row[4], row[6], row[7]) for row in rows]
+            for rows in self.store.exact("dbSNP", keys, ("CHR", "POS"))
+        ]
+
+    # One multi-key lookup per batch; REF and INFO are filtered per record
+    def prefetch(self, records):
+        keys = list(dict.fromkeys([self.getKey(fields) for fields in records]))
+        self.prefetched = dict(zip(keys, self.lookup(keys)))
+
+    def getRows(self, key):
+        if key in self.prefetched:
+            return self.prefetched[key]
+        return self.lookup([key])[0]
+
+    def annotate(self, fields):
+        key = self.getKey(fields)
+        ref = clean_mysql_chars(fields[self.inds[2]]).strip()
+        compRef = getComplementary(ref)
+
+        # String comparisons follow MySQL's case-insensitive collation
+        refs = [ref.upper(), compRef.upper()]
+        rows = [
+            row
+            for row in self.getRows(key)
+            if str(row[1]).upper() in refs
+            and str(row[2]).upper() == self.varclass.upper()
+        ]
+
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        fields[2] = "."
+        rsids = []
+        mafs = []
+        if len(rows) > 0:
+            for row in rows:
+                rsids.append(str(row[0]))
+                if str(row[3]) != ".":
+                    mafs.append("GMAF=" + str(row[3]))
+
+            maf_str = ""
+            if len(mafs) > 0:
+                maf_str = ";" + ";".join([str(x) for x in mafs])
+
+            self.var_count = self.var_count + 1
+            if str(fields[7]) == ".":
+                fields[7] = "DB" + maf_str
+            else:
+                fields[7] = fields[7] + ";DB;VC=" + self.varclass + maf_str
+
+            fields[2] = str(";".join(rsids))
+
+        self.linenum = self.linenum + 1
+        return fields
+
+    # linenum starts at 1 in every stage
+    def getCounts(self):
+        counts = Stage.getCounts(self)
+        counts["linenum"] = counts["linenum"] - 1
+        return counts
+
+    def writeLog(self, fh_log):
+        ratioInDbSnp = (self.var_count / float(self.linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(self.linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(self.var_count)} ({str(ratioInDbSnp)}%)\n")
+
+
+def getSnpsFromDbSnp(
+    vcf, format="vcf", tmpextin="", tmpextout=".1", varclass="SNV", sep="\t"
+):
+    store = rs.MySQLStore()
+    stage = DbSnpStage(store, format=format, varclass=varclass, sep=sep)
+    runStages(
+        vcf, vcf + tmpextout, [stage], logcountfile=vcf + ".count.log", logmode="w"
+    )
+    store.close()
 
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
 
+"""NOTE: all isoforms are collapsed in one record
+    1. chrom_pos_equal_base
+    2. chrom_pos_equal_nobase
+    3. chrom_pos_unequal
+"""
+BIGREFGENE_TABLES = [
+    "chrom_pos_equal_base",
+    "chrom_pos_equal_nobase",
+    "chrom_pos_unequal",
+]
+
+
+class BigRefGeneStage(Stage):
+    def __init__(self, store, format="vcf", snapshot=None, sep="\t"):
+        Stage.__init__(self, store, format=format, snapshot=snapshot, sep=sep)
+
+        self.indexes = None
+        if snapshot is not None and all(
+            [snapshot.hasTable(t) for t in BIGREFGENE_TABLES]
+        ):
+            self.indexes = [
+                snapshot.index("chrom_pos_equal_base", "start", "start"),
+                snapshot.index("chrom_pos_equal_nobase", "start", "start"),
+                snapshot.index("chrom_pos_unequal", "start", "end"),
+            ]
+            columns = snapshot.table("chrom_pos_equal_base").columns
+        else:
+            columns = store.columns("chrom_pos_equal_base")
+
+        self.refIndex = columns.index("haplotypeReference")
+        self.altIndex = columns.index("haplotypeAlternate")
+        self.prefetched = [{} for _ in BIGREFGENE_TABLES]
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    def getKey(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if chr.startswith("chr"):
+            chr = chr.replace("chr", "")
+        return (chr, int(fields[self.inds[1]].strip()))
+
+    def getAlleles(self, fields):
+        ref = clean_mysql_chars(fields[self.inds[2]]).strip()
+        alt = clean_mysql_chars(fields[self.inds[3]]).strip()
+
+        # String comparisons follow MySQL's case-insensitive collation
+        return [
+            (ref.upper(), alt.upper()),
+            (getComplementary(ref).upper(), getComplementary(alt).upper()),
+        ]
+
+    """Rows of table t (an index into BIGREFGENE_TABLES) for each key
+    """
+
+    def lookup(self, t, keys):
+        if self.indexes is not None:
+            return [self.indexes[t].overlaps(chr, pos) for chr, pos in keys]
+
+        if t < 2:
+            return self.store.exact(BIGREFGENE_TABLES[t], keys, ("CHR", "start"))
+
+        # Range lookups go out one chromosome at a time
+        results = [None] * len(keys)
+        groups = {}
+        for q, (chr, pos) in enumerate(keys):
+            groups.setdefault(chr, []).append(q)
+        for chr, queries in groups.items():
+            rows = self.store.overlaps(
+                BIGREFGENE_TABLES[t],
+                chr,
+                [keys[q][1] for q in queries],
+                start_column="start",
+                end_column="end",
+                chrom_column="CHR",
+            )
+            for q, hits in zip(queries, rows):
+                results[q] = hits
+        return results
+
+    def getRows(self, t, key, alleles):
+        if key in self.prefetched[t]:
+            rows = self.prefetched[t][key]
+        else:
+            rows = self.lookup(t, [key])[0]
+
+        if t == 0:
+            return [
+                row
+                for row in rows
+                if (str(row[self.refIndex]).upper(), str(row[self.altIndex]).upper())
+                in alleles
+            ]
+        return rows
+
+    """Fetches the batch from each table in turn, one lookup per table;
+    a table is only asked for the records no earlier table matched
+    """
+
+    def prefetch(self, records):
+        self.prefetched = [{} for _ in BIGREFGENE_TABLES]
+        if self.indexes is not None:
+            return
+
+        pending = [(self.getKey(fields), self.getAlleles(fields)) for fields in records]
+        for t in range(len(BIGREFGENE_TABLES)):
+            if len(pending) == 0:
+                break
+            keys = list(dict.fromkeys([key for key, _ in pending]))
+            self.prefetched[t] = dict(zip(keys, self.lookup(t, keys)))
+            pending = [
+                (key, alleles)
+                for key, alleles in pending
+                if len(self.getRows(t, key, alleles)) == 0
+            ]
+
+    def annotate(self, fields):
+        key = self.getKey(fields)
+        alleles = self.getAlleles(fields)
+
+        for t in range(len(BIGREFGENE_TABLES)):
+            rows = self.getRows(t, key, alleles)
             if len(rows) > 0:
-                keep_going = False
                 m = set([])
                 for row in rows:
-                    m.add(
-                        collapseRefSeq("\t".join([str(x) for x in row[1 : len(row)]]))
-                    )
+                    m.add(collapseRefSeqRow(row))
 
                 fields[7] = fields[7] + ";" + ";".join(m)
                 if str(fields[7]).startswith(".;"):
                     fields[7] = str(fields[7]).replace(".;", "", 1)
+                break
 
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
-
-            if keep_going:
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
-                            )
-                        )
+        return fields
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
-
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
-
-            if keep_going:
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
-                            )
-                        )
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
+def getBigRefGene(
+    vcf, format="vcf", tmpextin=".1", tmpextout=".2", snapshot=None, sep="\t"
+):
+    store = rs.MySQLStore()
+    stage = BigRefGeneStage(store, format=format, snapshot=snapshot, sep=sep)
+    runStages(vcf + tmpextin, vcf + tmpextout, [stage])
+    store.close()
+
 
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
+"""Shared lookups for the refGene transcript stages
+Each chromosome's transcripts and CpG islands are loaded once into
+interval indexes (or read from the snapshot), and every transcript is
+parsed once into a TranscriptModel for the rest of the job
+"""
 
-            if keep_going:
-                fh_out.write(line + "\n")
 
-            vcf_linenum = vcf_linenum + 1
+class TranscriptStage(Stage):
+    counters = [
+        "interGenic_count",
+        "cds_count",
+        "utr3_count",
+        "utr5_count",
+        "intronic_count",
+        "non_coding_intronic_count",
+        "exonic_count",
+        "non_coding_exonic_count",
+        "promoter_count",
+    ]
 
+    def __init__(
+        self,
+        store,
+        format="vcf",
+        table="refGene",
+        promoter_offset=500,
+        snapshot=None,
+        sep="\t",
+    ):
+        Stage.__init__(self, store, format=format, snapshot=snapshot, sep=sep)
+        self.table = table
+        self.promoter_offset = promoter_offset
+
+        self.models = tx.TranscriptModels(promoter_offset=promoter_offset)
+
+        if snapshot is not None and snapshot.hasTable(table):
+            transcripts = snapshot.index(table, "txStart", "txEnd")
         else:
-            fh_out.write(line + "\n")
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+            transcripts = iv.TableIndex(
+                self.loadTranscripts, start_column="txStart", end_column="txEnd"
+            )
+        self.transcripts = self.addCursor(transcripts)
 
+        if snapshot is not None and snapshot.hasTable("cpgIslandExt"):
+            promoters = snapshot.index("cpgIslandExt")
+        else:
+            promoters = iv.TableIndex(self.loadIslands)
+        self.promoters = self.addCursor(promoters)
 
-"""Get information about location in gene structures
-"""
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count = 0
 
+    def isHeader(self, line):
+        return line.startswith("#")
 
-def getGenes(
-    vcf,
-    format="vcf",
-    table="refGene",
-    promoter_offset=500,
-    tmpextin=".2",
-    tmpextout=".3",
-    sep="\t",
-):
+    def loadTranscripts(self, chr):
+        return self.store.columns(self.table), self.store.rows(self.table, chr)
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def loadIslands(self, chr):
+        columns = ["chrom", "chromStart", "chromEnd", "name"]
+        return columns, self.store.rows("cpgIslandExt", chr, columns=columns)
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
-
-            sql = (
-                "select * from "
-                + table
-                + ' where chrom="'
-                + str(chr)
-                + '" AND (txStart - '
-                + str(promoter_offset)
-                + ") <= "
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= (txEnd + "
-                + str(promoter_offset)
-                + ");"
-            )
+    def getTranscripts(self, chr, pos):
+        return self.transcripts.overlaps(
+            chr, int(pos) - self.promoter_offset, int(pos) + self.promoter_offset
+        )
 
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
+    def getPromoterRegion(self, chr, pos):
+        rows = self.getPromoterIsland(chr, pos)
 
-            if len(rows) > 0:
-                cnt = 1
-                for row in rows:
-                    # count location
-                    positionType = str(
-                        u.parse_field(info_field, "positionType", ";", "=")
-                    )
+        if rows is not None:
+            self.promoter_count = self.promoter_count + 1
+            return "putativePromoterRegion=" + "".join(str(rows[3]).split())
+        return ""
 
-                    if positionType == "intron":
-                        intronic_count = intronic_count + 1
-                    elif positionType == "non_coding_intron":
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif positionType == "CDS":
-                        cds_count = cds_count + 1
-                    elif positionType == "non_coding_exon":
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif positionType == "utr5":
-                        utr5_count = utr5_count + 1
-                    elif positionType == "utr3":
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts = str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(",")
-                    exonsEn = exonEnds.split(",")
-
-                    if cdsStart == cdsEnd:
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "non_coding_exon="
-                                    + "ex"
-                                    + str(exnum)
-                                    + "/"
-                                    + str(exonCount)
-                                )
-                        if len(exons) > 0:
-                            region = ";".join(exons)
-                    elif u.isBetween(pos, cdsStart, cdsEnd):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
-                                )
-                                exonic_count = exonic_count + 1
-                        if len(exons) > 0:
-                            region = ";".join(exons)
-
-                    elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
+    def getPromoterIsland(self, chr, pos):
+        rows = self.promoters.overlaps(chr, int(pos))
+        return rows[0] if len(rows) > 0 else None
 
-                        rows = cursor.fetchone()
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
+    def writeLog(self, fh_log):
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
 
-                    else:
-                        region = ""
-
-                    if region != "":
-                        info.append(
-                            collapseGeneNames(
-                                row=row,
-                                indices=indicesKnownGenes,
-                                region=region,
-                                cnt=cnt,
-                            )
-                        )
+        print(f"In interGenic {str(self.interGenic_count)}")
+        fh_log.write(f"In interGenic {str(self.interGenic_count)}\n")
 
-                    cnt = cnt + 1
+        print(f"In CDS {str(self.cds_count)}")
+        fh_log.write(f"In CDS {str(self.cds_count)}\n")
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ";" + str_info
-                fh_out.write("\t".join(fields) + "\n")
+        print(f"In '3 UTR {str(self.utr3_count)}")
+        fh_log.write(f"In '3 UTR {str(self.utr3_count)}\n")
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write("\t".join(fields) + "\n")
-                interGenic_count = interGenic_count + 1
+        print(f"In '5 UTR {str(self.utr5_count)}")
+        fh_log.write(f"In '5 UTR {str(self.utr5_count)}\n")
 
-            linenum = linenum + 1
+        print(f"In Intronic {str(self.intronic_count)}")
+        fh_log.write(f"In Intronic {str(self.intronic_count)}\n")
 
-        else:
-            fh_out.write(line + "\n")
+        print(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}")
+        fh_log.write(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}\n")
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+        print(f"In Exonic {str(self.exonic_count)}")
+        fh_log.write(f"In Exonic {str(self.exonic_count)}\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+        print(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}")
+        fh_log.write(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+        print(f"In Putative Promoter Region {str(self.promoter_count)}")
+        fh_log.write(f"In Putative Promoter Region {str(self.promoter_count)}\n")
 
-    print(f"In '3 UTR {str(utr3_count)}")
-    fh_log.write(f"In '3 UTR {str(utr3_count)}\n")
 
-    print(f"In '5 UTR {str(utr5_count)}")
-    fh_log.write(f"In '5 UTR {str(utr5_count)}\n")
+"""Get information about location in gene structures
+"""
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+class GenesStage(TranscriptStage):
+    def annotate(self, fields):
+        inds = self.inds
+        chr = fields[inds[0]].strip()
+
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = fields[inds[1]].strip()
+        info_field = clean_mysql_chars(fields[7]).strip()
+
+        rows = self.getTranscripts(chr, pos)
+        info = []
+
+        if len(rows) > 0:
+            cnt = 1
+            for row in rows:
+                # count location
+                positionType = str(u.parse_field(info_field, "positionType", ";", "="))
+
+                if positionType == "intron":
+                    self.intronic_count = self.intronic_count + 1
+                elif positionType == "non_coding_intron":
+                    self.non_coding_intronic_count = self.non_coding_intronic_count + 1
+                elif positionType == "CDS":
+                    self.cds_count = self.cds_count + 1
+                elif positionType == "non_coding_exon":
+                    self.non_coding_exonic_count = self.non_coding_exonic_count + 1
+                elif positionType == "utr5":
+                    self.utr5_count = self.utr5_count + 1
+                elif positionType == "utr3":
+                    self.utr3_count = self.utr3_count + 1
+
+                model = self.models.get(row)
+                txtStart = model.txStart
+                txtEnd = model.txEnd
+                cdsStart = model.cdsStart
+                cdsEnd = model.cdsEnd
+                strand = model.strand
+
+                promoter_plus = model.promoter_plus
+                promoter_minus = model.promoter_minus
+                region = ""
+                pos = int(pos)
+                exons = []
+
+                if cdsStart == cdsEnd:
+                    for e in model.getExons(pos):
+                        exons.append("non_coding_exon=" + model.getExonLabel(e))
+                    if len(exons) > 0:
+                        region = ";".join(exons)
+                elif u.isBetween(pos, cdsStart, cdsEnd):
+                    for e in model.getExons(pos):
+                        exons.append("exon=" + model.getExonLabel(e))
+                        self.exonic_count = self.exonic_count + 1
+                    if len(exons) > 0:
+                        region = ";".join(exons)
+
+                elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
+                    region = self.getPromoterRegion(chr, pos)
+
+                elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
+                    region = self.getPromoterRegion(chr, pos)
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+                else:
+                    region = ""
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+                if region != "":
+                    info.append(
+                        collapseGeneNames(
+                            row=row,
+                            indices=indicesKnownGenes,
+                            region=region,
+                            cnt=cnt,
+                        )
+                    )
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+                cnt = cnt + 1
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+            str_info = ";".join(info)
+            fields[7] = fields[7] + ";" + str_info
 
+        else:
+            fields[7] = fields[7] + ";positionType=interGenic"
+            self.interGenic_count = self.interGenic_count + 1
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
-"""
+        return fields
 
 
-def getExonsEtAl(
+def getGenes(
     vcf,
     format="vcf",
     table="refGene",
     promoter_offset=500,
     tmpextin=".2",
     tmpextout=".3",
+    snapshot=None,
     sep="\t",
 ):
+    store = rs.MySQLStore()
+    stage = GenesStage(
+        store,
+        format=format,
+        table=table,
+        promoter_offset=promoter_offset,
+        snapshot=snapshot,
+        sep=sep,
+    )
+    runStages(vcf + tmpextin, vcf + tmpextout, [stage], logcountfile=vcf + ".count.log")
+    store.close()
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
-
-            sql = (
-                "select * from "
-                + table
-                + ' where chrom="'
-                + str(chr)
-                + '"   AND (txStart - '
-                + str(promoter_offset)
-                + ") <= "
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= (txEnd + "
-                + str(promoter_offset)
-                + ");"
-            )
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if len(rows) > 0:
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts = str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(",")
-                    exonsEn = exonEnds.split(",")
-
-                    if cdsStart == cdsEnd:
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "non_coding_exon="
-                                    + "ex"
-                                    + str(exnum)
-                                    + "/"
-                                    + str(exonCount)
-                                )
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if len(exons) > 0:
-                            region = "positionType=non_coding_exon;" + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = "positionType=non_coding_intron"
-
-                    elif u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
-                                )
-                                exonic_count = exonic_count + 1
-                        if len(exons) > 0:
-                            region = "positionType=CDS;" + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = "positionType=CDS;" + "intron"
-
-                    elif (
-                        u.isBetween(pos, txtStart, cdsStart)
-                        and (cdsStart < cdsEnd)
-                        and (strand == "+")
-                    ):
-                        utr5_count = utr5_count + 1
-                        region = "positionType=utr5"
-
-                    elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd)(
-                        strand == "+"
-                    ):
-                        utr3_count = utr3_count + 1
-                        region = "positionType=utr3"
-
-                    elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd)(
-                        strand == "-"
-                    ):
-                        utr5_count = utr5_count + 1
-                        region = "positionType=utr5"
-
-                    elif (
-                        u.isBetween(pos, txtStart, cdsStart)
-                        and (cdsStart < cdsEnd)
-                        and (strand == "-")
-                    ):
-                        utr3_count = utr3_count + 1
-                        region = "positionType=utr3"
-
-                    elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name "
-                            + 'from cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name "
-                            + 'from cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""
 
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
 
+class ExonsEtAlStage(TranscriptStage):
+    def annotate(self, fields):
+        inds = self.inds
+        chr = fields[inds[0]].strip()
+
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = fields[inds[1]].strip()
+
+        rows = self.getTranscripts(chr, pos)
+        info = []
+        if len(rows) > 0:
+            cnt = 1
+            for row in rows:
+                model = self.models.get(row)
+                txtStart = model.txStart
+                txtEnd = model.txEnd
+                cdsStart = model.cdsStart
+                cdsEnd = model.cdsEnd
+                strand = model.strand
+
+                promoter_plus = model.promoter_plus
+                promoter_minus = model.promoter_minus
+                region = ""
+                pos = int(pos)
+                exons = []
+
+                if cdsStart == cdsEnd:
+                    for e in model.getExons(pos):
+                        exons.append("non_coding_exon=" + model.getExonLabel(e))
+                        self.non_coding_exonic_count = self.non_coding_exonic_count + 1
+                    if len(exons) > 0:
+                        region = "positionType=non_coding_exon;" + ";".join(exons)
                     else:
-                        region = ""
-
-                    if region != "":
-                        info.append(
-                            collapseGeneNames(
-                                row=row,
-                                indices=indicesKnownGenes,
-                                region=region,
-                                cnt=cnt,
-                            )
+                        self.non_coding_intronic_count = (
+                            self.non_coding_intronic_count + 1
                         )
+                        region = "positionType=non_coding_intron"
+
+                elif u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd):
+                    self.cds_count = self.cds_count + 1
+                    for e in model.getExons(pos):
+                        exons.append("exon=" + model.getExonLabel(e))
+                        self.exonic_count = self.exonic_count + 1
+                    if len(exons) > 0:
+                        region = "positionType=CDS;" + ";".join(exons)
+                    else:
+                        self.intronic_count = self.intronic_count + 1
+                        region = "positionType=CDS;" + "intron"
+
+                elif (
+                    u.isBetween(pos, txtStart, cdsStart)
+                    and (cdsStart < cdsEnd)
+                    and (strand == "+")
+                ):
+                    self.utr5_count = self.utr5_count + 1
+                    region = "positionType=utr5"
+
+                elif (
+                    u.isBetween(pos, cdsEnd, txtEnd)
+                    and (cdsStart < cdsEnd)
+                    and (strand == "+")
+                ):
+                    self.utr3_count = self.utr3_count + 1
+                    region = "positionType=utr3"
+
+                elif (
+                    u.isBetween(pos, cdsEnd, txtEnd)
+                    and (cdsStart < cdsEnd)
+                    and (strand == "-")
+                ):
+                    self.utr5_count = self.utr5_count + 1
+                    region = "positionType=utr5"
+
+                elif (
+                    u.isBetween(pos, txtStart, cdsStart)
+                    and (cdsStart < cdsEnd)
+                    and (strand == "-")
+                ):
+                    self.utr3_count = self.utr3_count + 1
+                    region = "positionType=utr3"
+
+                elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
+                    region = self.getPromoterRegion(chr, pos)
+
+                elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
+                    region = self.getPromoterRegion(chr, pos)
 
-                    cnt = cnt + 1
+                else:
+                    region = ""
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ";" + str_info
-                fh_out.write("\t".join(fields) + "\n")
+                if region != "":
+                    info.append(
+                        collapseGeneNames(
+                            row=row,
+                            indices=indicesKnownGenes,
+                            region=region,
+                            cnt=cnt,
+                        )
+                    )
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write("\t".join(fields) + "\n")
-                interGenic_count = interGenic_count + 1
+                cnt = cnt + 1
 
-            linenum = linenum + 1
+            str_info = ";".join(info)
+            fields[7] = fields[7] + ";" + str_info
 
         else:
-            fh_out.write(line + "\n")
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+            fields[7] = fields[7] + ";positionType=interGenic"
+            self.interGenic_count = self.interGenic_count + 1
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+        return fields
 
-    print(f"In '3 UTR {str(utr3_count)}")
-    fh_log.write(f"In '3 UTR {str(utr3_count)}\n")
 
-    print(f"In '5 UTR {str(utr5_count)}")
-    fh_log.write(f"In '5 UTR {str(utr5_count)}\n")
-
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic " + str(intronic_count) + "\n")
-
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+def getExonsEtAl(
+    vcf,
+    format="vcf",
+    table="refGene",
+    promoter_offset=500,
+    tmpextin=".2",
+    tmpextout=".3",
+    snapshot=None,
+    sep="\t",
+):
+    store = rs.MySQLStore()
+    stage = ExonsEtAlStage(
+        store,
+        format=format,
+        table=table,
+        promoter_offset=promoter_offset,
+        snapshot=snapshot,
+        sep=sep,
+    )
+    runStages(vcf + tmpextin, vcf + tmpextout, [stage], logcountfile=vcf + ".count.log")
+    store.close()
+
+
+"""Base class for stages that count overlapping records per table
+With sweep=True, a coordinate-sorted input is merge-joined against the
+table one chromosome at a time instead of one store lookup per variant;
+if the input turns out not to be sorted, the stage falls back to
+per-variant lookups for the rest of the file. With index=True, each
+chromosome of the table is loaded once into an in-memory interval index
+that serves lookups in any order. Each batch's lookups are resolved in
+prefetch(): one store call per chromosome, or the sweep/index in record
+order. Index lookups go through a window cursor (intervals.WindowCursor),
+so runs of records between the same interval boundaries share one lookup
+"""
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+class OverlapStage(Stage):
+    counters = ["var_count", "line_count"]
+    independent = True
+    chromName = "chrom"
+    startName = "chromStart"
+    endName = "chromEnd"
+    columns = None
+
+    def __init__(
+        self,
+        store,
+        format="vcf",
+        table=None,
+        sweep=False,
+        index=False,
+        snapshot=None,
+        sep="\t",
+    ):
+        Stage.__init__(self, store, format=format, snapshot=snapshot, sep=sep)
+        self.table = table
+        self.var_count = 0
+        self.line_count = 0
+        self.prefetched = {}
+
+        self.sweep = None
+        if sweep:
+            self.sweep = sw.SweepJoin(
+                self.loadChrom, start_column=self.startName, end_column=self.endName
+            )
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+        self.index = None
+        if snapshot is not None and snapshot.hasTable(self.table):
+            self.index = snapshot.index(self.table, self.startName, self.endName)
+        elif index:
+            self.index = iv.TableIndex(
+                self.loadChrom, start_column=self.startName, end_column=self.endName
+            )
+        if self.index is not None:
+            self.index = self.addCursor(self.index)
+
+    def getChrom(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+        return chr
+
+    def getTable(self, chr):
+        return self.table
+
+    """The (chromosome, position) annotate() will look up for a record, or
+    None if it skips the record
+    """
+
+    def getLookupKey(self, fields):
+        return (self.getChrom(fields), int(fields[self.inds[1]].strip()))
+
+    def getChromFilter(self, chr):
+        if self.chromName is None:
+            return None
+        return chr
+
+    def loadChrom(self, chr):
+        table = self.getTable(chr)
+        rows = self.store.rows(
+            table,
+            self.getChromFilter(chr),
+            chrom_column=self.chromName,
+            columns=self.columns,
+        )
+        return self.store.getColumnNames(table, self.columns), rows
+
+    def prefetch(self, records):
+        self.prefetched = {}
+        keys = [self.getLookupKey(fields) for fields in records]
+        keys = [key for key in dict.fromkeys(keys) if key is not None]
+        prefetched = {}
+
+        if self.index is not None or self.sweep is not None:
+            for chr, pos in keys:
+                prefetched[(chr, pos)] = self.getOverlaps(chr, pos)
+        else:
+            groups = {}
+            for chr, pos in keys:
+                groups.setdefault(chr, []).append(pos)
+            for chr, positions in groups.items():
+                rows = self.store.overlaps(
+                    self.getTable(chr),
+                    self.getChromFilter(chr),
+                    positions,
+                    start_column=self.startName,
+                    end_column=self.endName,
+                    chrom_column=self.chromName,
+                    columns=self.columns,
+                )
+                for pos, hits in zip(positions, rows):
+                    prefetched[(chr, pos)] = hits
+
+        self.prefetched = prefetched
+
+    def getOverlaps(self, chr, pos):
+        pos = int(pos)
+        if (chr, pos) in self.prefetched:
+            return self.prefetched[(chr, pos)]
+
+        if self.index is not None:
+            return self.index.overlaps(chr, pos)
+
+        if self.sweep is not None:
+            try:
+                return self.sweep.overlaps(chr, pos)
+            except sw.UnsortedInputError as e:
+                print(
+                    f"{self.table}: input is not sorted ({e}), "
+                    + "using per-variant queries"
+                )
+                self.sweep = None
+
+        return self.store.overlaps(
+            self.getTable(chr),
+            self.getChromFilter(chr),
+            [pos],
+            start_column=self.startName,
+            end_column=self.endName,
+            chrom_column=self.chromName,
+            columns=self.columns,
+        )[0]
+
+    def getFirstOverlap(self, chr, pos):
+        rows = self.getOverlaps(chr, pos)
+        if len(rows) > 0:
+            return rows[0]
+        return None
+
+    def appendInfo(self, fields, records_str):
+        if str(fields[7]).endswith(";"):
+            fields[7] = fields[7] + records_str
+        else:
+            fields[7] = fields[7] + ";" + records_str
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+    def writeLog(self, fh_log):
+        fh_log.write(
+            f"In {str(self.table)}: {str(self.var_count)} in "
+            + f"{str(self.line_count)} variants\n"
+        )
 
 
 """Overlap with tfbsConsSites
 """
 
 
-def addOverlapWithTfbsConsSites(
-    vcf, format="vcf", table="tfbsConsSites", tmpextin=".2", tmpextout=".3", sep="\t"
-):
-
+class TfbsConsSitesStage(OverlapStage):
+    chromName = None
+    columns = ["chrom", "chromStart", "chromEnd", "name"]
     allowed_chrom = [
         "1",
         "2",
@@ -918,830 +1257,708 @@ def addOverlapWithTfbsConsSites(
         "Y",
     ]
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if line.startswith("##"):
-            fh_out.write(line + "\n")
-
-        # header line
-        elif line.startswith("#CHROM") or line.startswith("CHROM"):
-            fh_out.write(line + "\n")
-
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex = chr.replace("chr", "")
-
-            if chrIndex in allowed_chrom:
-                isOverlap = False
-                sql = (
-                    "select chrom, chromStart, chromEnd, name "
-                    + "from tfbsConsSites"
-                    + chrIndex
-                    + " where  chromStart <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd;"
+    def __init__(
+        self,
+        store,
+        format="vcf",
+        table="tfbsConsSites",
+        sweep=False,
+        index=False,
+        snapshot=None,
+        sep="\t",
+    ):
+        OverlapStage.__init__(
+            self,
+            store,
+            format=format,
+            table=table,
+            sweep=sweep,
+            index=index,
+            snapshot=snapshot,
+            sep=sep,
+        )
+
+    # One table per chromosome, keyed by chromosome number
+    def getTable(self, chrIndex):
+        return "tfbsConsSites" + chrIndex
+
+    def getLookupKey(self, fields):
+        chrIndex = self.getChrom(fields).replace("chr", "")
+        if chrIndex not in self.allowed_chrom:
+            return None
+        return (chrIndex, int(fields[self.inds[1]].strip()))
+
+    def annotate(self, fields):
+        # For some reason this table has no "chr" preceeding number
+        chr = self.getChrom(fields)
+        pos = fields[self.inds[1]].strip()
+        chrIndex = chr.replace("chr", "")
+
+        # chrom is not on the list
+        if chrIndex not in self.allowed_chrom:
+            return fields
+
+        rows = self.getOverlaps(chrIndex, pos)
+        records = []
+
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+
+            for row in rows:
+                self.var_count = self.var_count + 1
+                t = (
+                    str(row[3])
+                    + "."
+                    + str(row[0])
+                    + "."
+                    + str(row[1])
+                    + "."
+                    + str(row[2])
                 )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = (
-                            str(row[3])
-                            + "."
-                            + str(row[0])
-                            + "."
-                            + str(row[1])
-                            + "."
-                            + str(row[2])
-                        )
-                        t = t.strip()
-                        records.append("tfbsRegion" + "=" + t)
-                        records_count = records_count + 1
+                t = t.strip()
+                records.append("tfbsRegion" + "=" + t)
 
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-
-                    fh_out.write("\t".join(fields) + "\n")
-
-                else:  # chrom is not on the list
-                    fh_out.write(line + "\n")
+            self.appendInfo(fields, ";".join(records))
 
-            else:  # chrom is not on the list
-                fh_out.write(line + "\n")
+        return fields
 
-        linenum = linenum + 1
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWithTfbsConsSites(
+    vcf,
+    format="vcf",
+    table="tfbsConsSites",
+    tmpextin=".2",
+    tmpextout=".3",
+    sweep=False,
+    index=False,
+    snapshot=None,
+    sep="\t",
+):
+    store = rs.MySQLStore()
+    stage = TfbsConsSitesStage(
+        store,
+        format=format,
+        table=table,
+        sweep=sweep,
+        index=index,
+        snapshot=snapshot,
+        sep=sep,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStages(vcf + tmpextin, vcf + tmpextout, [stage], logcountfile=vcf + ".count.log")
+    store.close()
 
 
 """Overlap with GadAll table
 """
 
 
+class GadAllStage(OverlapStage):
+    # For some reason this table has no "chr" preceeding number
+    chromName = "chromosome"
+
+    def __init__(
+        self,
+        store,
+        format="vcf",
+        table="gadAll",
+        sweep=False,
+        index=False,
+        snapshot=None,
+        sep="\t",
+    ):
+        OverlapStage.__init__(
+            self,
+            store,
+            format=format,
+            table=table,
+            sweep=sweep,
+            index=index,
+            snapshot=snapshot,
+            sep=sep,
+        )
+
+    def getLookupKey(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if chr.startswith("chr"):
+            chr = str(chr).replace("chr", "")
+        return (chr, int(fields[self.inds[1]].strip()))
+
+    def annotate(self, fields):
+        chr = fields[self.inds[0]].strip()
+        if chr.startswith("chr"):
+            chr = str(chr).replace("chr", "")
+
+        pos = fields[self.inds[1]].strip()
+
+        rows = self.getOverlaps(chr, pos)
+        records = []
+
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]))
+                    records.append(str(self.table) + "=" + str(row[3]))
+            self.appendInfo(fields, ";".join(records))
+            # Annotated records have always been written out tab-space separated
+            fields = [fields[0]] + [" " + f for f in fields[1:]]
+
+        return fields
+
+
 def addOverlapWithGadAll(
-    vcf, format="vcf", table="gadAll", tmpextin="", tmpextout=".1", sep="\t"
+    vcf,
+    format="vcf",
+    table="gadAll",
+    tmpextin="",
+    tmpextout=".1",
+    sweep=False,
+    index=False,
+    snapshot=None,
+    sep="\t",
 ):
+    store = rs.MySQLStore()
+    stage = GadAllStage(
+        store,
+        format=format,
+        table=table,
+        sweep=sweep,
+        index=index,
+        snapshot=snapshot,
+        sep=sep,
+    )
+    runStages(vcf + tmpextin, vcf + tmpextout, [stage], logcountfile=vcf + ".count.log")
+    store.close()
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
+""" Overlap with gwasCatalog table """
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chromosome="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
+class GwasCatalogStage(OverlapStage):
+    # Exact match on chromEnd; as a range, every row is [chromEnd, chromEnd]
+    startName = "chromEnd"
+    endName = "chromEnd"
+
+    def __init__(
+        self,
+        store,
+        format="vcf",
+        table="gwasCatalog",
+        sweep=False,
+        index=False,
+        snapshot=None,
+        sep="\t",
+    ):
+        OverlapStage.__init__(
+            self,
+            store,
+            format=format,
+            table=table,
+            sweep=sweep,
+            index=index,
+            snapshot=snapshot,
+            sep=sep,
+        )
+
+    def annotate(self, fields):
+        chr = self.getChrom(fields)
+        pos = fields[self.inds[1]].strip()
+
+        rows = self.getOverlaps(chr, pos)
+        records = []
+
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                records.append(
+                    str(self.table)
+                    + "="
+                    + str("pubMedID")
+                    + "="
+                    + str(row[5])
+                    + ",trait="
+                    + str(row[10])
                 )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]))
-                            records.append(str(table) + "=" + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t ".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
+            self.appendInfo(fields, ";".join(records))
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-
-""" Overlap with gwasCatalog table """
+        return fields
 
 
 def addOverlapWithGwasCatalog(
-    vcf, format="vcf", table="gwasCatalog", tmpextin="", tmpextout=".1", sep="\t"
+    vcf,
+    format="vcf",
+    table="gwasCatalog",
+    tmpextin="",
+    tmpextout=".1",
+    sweep=False,
+    index=False,
+    snapshot=None,
+    sep="\t",
 ):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND chromEnd = '
-                    + str(pos)
-                    + ";"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(
-                            str(table)
-                            + "="
-                            + str("pubMedID")
-                            + "="
-                            + str(row[5])
-                            + ",trait="
-                            + str(row[10])
-                        )
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+    store = rs.MySQLStore()
+    stage = GwasCatalogStage(
+        store,
+        format=format,
+        table=table,
+        sweep=sweep,
+        index=index,
+        snapshot=snapshot,
+        sep=sep,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStages(vcf + tmpextin, vcf + tmpextout, [stage], logcountfile=vcf + ".count.log")
+    store.close()
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
 
 
-def addOverlapWitHUGOGeneNomenclature(
-    vcf, format="vcf", table="hugo", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + "," + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append("HGNC_GeneAnnotation" + "=" + t)
-                        records_count = records_count + 1
-
-                    records_str = ",".join(records).replace(";", ",")
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + records_str
-                    else:
-                        fields[7] = fields[7] + ";" + records_str
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
+class HugoStage(OverlapStage):
+    def __init__(
+        self,
+        store,
+        format="vcf",
+        table="hugo",
+        sweep=False,
+        index=False,
+        snapshot=None,
+        sep="\t",
+    ):
+        OverlapStage.__init__(
+            self,
+            store,
+            format=format,
+            table=table,
+            sweep=sweep,
+            index=index,
+            snapshot=snapshot,
+            sep=sep,
+        )
+
+    def annotate(self, fields):
+        chr = self.getChrom(fields)
+        pos = fields[self.inds[1]].strip()
+
+        rows = self.getOverlaps(chr, pos)
+        records = []
+
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                t = str(str(row[5]) + "," + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append("HGNC_GeneAnnotation" + "=" + t)
+
+            self.appendInfo(fields, ",".join(records).replace(";", ","))
+
+        return fields
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWitHUGOGeneNomenclature(
+    vcf,
+    format="vcf",
+    table="hugo",
+    tmpextin="",
+    tmpextout=".1",
+    sweep=False,
+    index=False,
+    snapshot=None,
+    sep="\t",
+):
+    store = rs.MySQLStore()
+    stage = HugoStage(
+        store,
+        format=format,
+        table=table,
+        sweep=sweep,
+        index=index,
+        snapshot=snapshot,
+        sep=sep,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStages(vcf + tmpextin, vcf + tmpextout, [stage], logcountfile=vcf + ".count.log")
+    store.close()
 
 
 """Overlap with segdup regions genomicSuperDups
 """
 
 
-def addOverlapWithGenomicSuperDups(
-    vcf, format="vcf", table="genomicSuperDups", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ""
-                otherStart = ""
-                otherEnd = ""
-                l = str(isOverlap)
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = (
-                        fields[7]
-                        + ";"
-                        + str(table)
-                        + "="
-                        + str(isOverlap)
-                        + ";"
-                        + "otherChrom="
-                        + str(otherChrom)
-                        + ";otherStart="
-                        + str(otherStart)
-                        + ";otherEnd="
-                        + str(otherEnd)
-                    )
+class GenomicSuperDupsStage(OverlapStage):
+    def __init__(
+        self,
+        store,
+        format="vcf",
+        table="genomicSuperDups",
+        sweep=False,
+        index=False,
+        snapshot=None,
+        sep="\t",
+    ):
+        OverlapStage.__init__(
+            self,
+            store,
+            format=format,
+            table=table,
+            sweep=sweep,
+            index=index,
+            snapshot=snapshot,
+            sep=sep,
+        )
+
+    def annotate(self, fields):
+        chr = self.getChrom(fields)
+        pos = fields[self.inds[1]].strip()
+
+        rows = self.getFirstOverlap(chr, pos)
+
+        if rows is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            fields[7] = (
+                fields[7]
+                + ";"
+                + str(self.table)
+                + "="
+                + str(True)
+                + ";"
+                + "otherChrom="
+                + str(rows[7])
+                + ";otherStart="
+                + str(rows[8])
+                + ";otherEnd="
+                + str(rows[9])
+            )
 
-                fh_out.write("\t".join(fields) + "\n")
+        return fields
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWithGenomicSuperDups(
+    vcf,
+    format="vcf",
+    table="genomicSuperDups",
+    tmpextin="",
+    tmpextout=".1",
+    sweep=False,
+    index=False,
+    snapshot=None,
+    sep="\t",
+):
+    store = rs.MySQLStore()
+    stage = GenomicSuperDupsStage(
+        store,
+        format=format,
+        table=table,
+        sweep=sweep,
+        index=index,
+        snapshot=snapshot,
+        sep=sep,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStages(vcf + tmpextin, vcf + tmpextout, [stage], logcountfile=vcf + ".count.log")
+    store.close()
 
 
-"""Searches Genes Databases and returns Genes/Cytobands 
+"""Searches Genes Databases and returns Genes/Cytobands
    with which SNP or INDEL overlaps
 """
 
 
-def addOverlapWithRefGene(
-    vcf, format="vcf", table="refGene", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-    colindex = 1
-    colindex2 = 12
-    name = "name"
-    name2 = "name2"
+class RefGeneStage(OverlapStage):
     startName = "txStart"
     endName = "txEnd"
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def __init__(
+        self,
+        store,
+        format="vcf",
+        table="refGene",
+        sweep=False,
+        index=False,
+        snapshot=None,
+        sep="\t",
+    ):
+        OverlapStage.__init__(
+            self,
+            store,
+            format=format,
+            table=table,
+            sweep=sweep,
+            index=index,
+            snapshot=snapshot,
+            sep=sep,
+        )
+
+    def annotate(self, fields):
+        chr = self.getChrom(fields)
+        pos = fields[self.inds[1]].strip()
+
+        overlapsWith = []
+        rows = self.getOverlaps(chr, pos)
+
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                overlapsWith.append("name2=" + str(row[12]) + ";name=" + str(row[1]))
+
+            genes = ";".join([str(x) for x in overlapsWith])
+            self.appendInfo(fields, str(genes))
+
+        return fields
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
-                )
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(
-                            name2
-                            + "="
-                            + str(row[colindex2])
-                            + ";"
-                            + name
-                            + "="
-                            + str(row[colindex])
-                        )
 
-                    genes = ";".join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ";" + str(genes)
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWithRefGene(
+    vcf,
+    format="vcf",
+    table="refGene",
+    tmpextin="",
+    tmpextout=".1",
+    sweep=False,
+    index=False,
+    snapshot=None,
+    sep="\t",
+):
+    store = rs.MySQLStore()
+    stage = RefGeneStage(
+        store,
+        format=format,
+        table=table,
+        sweep=sweep,
+        index=index,
+        snapshot=snapshot,
+        sep=sep,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStages(vcf + tmpextin, vcf + tmpextout, [stage], logcountfile=vcf + ".count.log")
+    store.close()
 
 
 """Method to find overlap with Cytoband table
 """
 
 
-def addOverlapWithCytoband(
-    vcf, format="vcf", table="cytoBand", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = "txStart"
-    endName = "txEnd"
-
-    if table == "cytoBand":
-        colindex = 3
-        startName = "chromStart"
-        endName = "chromEnd"
+class CytobandStage(OverlapStage):
+    def __init__(
+        self,
+        store,
+        format="vcf",
+        table="cytoBand",
+        sweep=False,
+        index=False,
+        snapshot=None,
+        sep="\t",
+    ):
+        self.colindex = 12
+        self.startName = "txStart"
+        self.endName = "txEnd"
+
+        if table == "cytoBand":
+            self.colindex = 3
+            self.startName = "chromStart"
+            self.endName = "chromEnd"
+
+        OverlapStage.__init__(
+            self,
+            store,
+            format=format,
+            table=table,
+            sweep=sweep,
+            index=index,
+            snapshot=snapshot,
+            sep=sep,
+        )
+
+    def annotate(self, fields):
+        chr = self.getChrom(fields)
+        pos = fields[self.inds[1]].strip()
+
+        overlapsWith = []
+        rows = self.getOverlaps(chr, pos)
+
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ";".join([str(x) for x in overlapsWith])
+            self.appendInfo(fields, str(self.table) + "=" + str(cytoband))
+
+        return fields
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
-                )
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ";".join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(cytoband)
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWithCytoband(
+    vcf,
+    format="vcf",
+    table="cytoBand",
+    tmpextin="",
+    tmpextout=".1",
+    sweep=False,
+    index=False,
+    snapshot=None,
+    sep="\t",
+):
+    store = rs.MySQLStore()
+    stage = CytobandStage(
+        store,
+        format=format,
+        table=table,
+        sweep=sweep,
+        index=index,
+        snapshot=snapshot,
+        sep=sep,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStages(vcf + tmpextin, vcf + tmpextout, [stage], logcountfile=vcf + ".count.log")
+    store.close()
 
 
 """Method to find overlap with CNV tables
 """
 
 
-def addOverlapWithCnvDatabase(
-    vcf, format="vcf", table="dgv_Cnv", tmpextin="", tmpextout=".1", sep="\t"
-):
+class CnvDatabaseStage(OverlapStage):
+    def __init__(
+        self,
+        store,
+        format="vcf",
+        table="dgv_Cnv",
+        sweep=False,
+        index=False,
+        snapshot=None,
+        sep="\t",
+    ):
+        OverlapStage.__init__(
+            self,
+            store,
+            format=format,
+            table=table,
+            sweep=sweep,
+            index=index,
+            snapshot=snapshot,
+            sep=sep,
+        )
+
+    def annotate(self, fields):
+        chr = self.getChrom(fields)
+        pos = fields[self.inds[1]].strip()
+
+        rows = self.getFirstOverlap(chr, pos)
+
+        if rows is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            self.appendInfo(fields, str(self.table) + "=" + str(True))
+
+        return fields
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(isOverlap)
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWithCnvDatabase(
+    vcf,
+    format="vcf",
+    table="dgv_Cnv",
+    tmpextin="",
+    tmpextout=".1",
+    sweep=False,
+    index=False,
+    snapshot=None,
+    sep="\t",
+):
+    store = rs.MySQLStore()
+    stage = CnvDatabaseStage(
+        store,
+        format=format,
+        table=table,
+        sweep=sweep,
+        index=index,
+        snapshot=snapshot,
+        sep=sep,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStages(vcf + tmpextin, vcf + tmpextout, [stage], logcountfile=vcf + ".count.log")
+    store.close()
 
 
 """Method to find overlap with targetScanS tables
 """
 
 
-def addOverlapWithMiRNA(
-    vcf, format="vcf", table="targetScanS", tmpextin="", tmpextout=".1", sep="\t"
-):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class MiRNAStage(OverlapStage):
+    def __init__(
+        self,
+        store,
+        format="vcf",
+        table="targetScanS",
+        sweep=False,
+        index=False,
+        snapshot=None,
+        sep="\t",
+    ):
+        OverlapStage.__init__(
+            self,
+            store,
+            format=format,
+            table=table,
+            sweep=sweep,
+            index=index,
+            snapshot=snapshot,
+            sep=sep,
+        )
+
+    def annotate(self, fields):
+        chr = self.getChrom(fields)
+        pos = fields[self.inds[1]].strip()
+
+        rows = self.getFirstOverlap(chr, pos)
+
+        if rows is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            t = (
+                str(rows[4])
+                + ","
+                + str(rows[1])
+                + "_"
+                + str(rows[2])
+                + "_"
+                + str(rows[3])
+            )
+            self.appendInfo(fields, "miRNAsites=" + t.strip())
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+        return fields
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
+    def writeLog(self, fh_log):
+        fh_log.write(
+            f"In miRNAsites: {str(self.var_count)} in "
+            + f"{str(self.line_count)} variants\n"
+        )
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = (
-                        str(rows[4])
-                        + ","
-                        + str(rows[1])
-                        + "_"
-                        + str(rows[2])
-                        + "_"
-                        + str(rows[3])
-                    )
-                    t = "miRNAsites=" + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ";" + t
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
-
-    fh_log.write(
-        f"In miRNAsites: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWithMiRNA(
+    vcf,
+    format="vcf",
+    table="targetScanS",
+    tmpextin="",
+    tmpextout=".1",
+    sweep=False,
+    index=False,
+    snapshot=None,
+    sep="\t",
+):
+    store = rs.MySQLStore()
+    stage = MiRNAStage(
+        store,
+        format=format,
+        table=table,
+        sweep=sweep,
+        index=index,
+        snapshot=snapshot,
+        sep=sep,
     )
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    runStages(vcf + tmpextin, vcf + tmpextout, [stage], logcountfile=vcf + ".count.log")
+    store.close()
 
 
 ### EOF
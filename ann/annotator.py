@@ -3,13 +3,19 @@
 # NOTE: This file lives on the AnnTools instance
 
 import boto3
-import json
 import os
 import sys
 import time
-from subprocess import Popen, PIPE
 from botocore.exceptions import ClientError
 from botocore.client import Config
+import functools
+import workers
+import lease
+
+# Import the shared SQS consumer and message types
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, "util"))
+import consumer
+import messages
 
 # Get configuration
 from configparser import ConfigParser, ExtendedInterpolation
@@ -18,202 +24,247 @@ config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
 config.read("annotator_config.ini")
 
 
-"""Reads request messages from SQS and runs AnnTools as a subprocess.
+"""Runs once in each worker of the pool: imports the AnnTools runner and
+opens the clients and reference handles its jobs share
+"""
+
+
+def init_worker():
+    import run
+    return run.JobContext()
+
+
+def run_job(context, job_id, *args):
+    import run
+    return run.runJob(context, job_id, *args)
 
-Move existing annotator code here
+
+"""Reports the jobs the pool finished and ends their leases, deleting
+their messages; a job that failed is marked FAILED so it does not stay
+RUNNING
 """
 
 
-def handle_requests_queue(sqs=None):
+def report_results(pool, leases, timeout=0):
+    for job_id, ok, message in pool.results(timeout=timeout):
+        if ok:
+            print(f"Job {job_id} completed")
+            leases.complete(job_id)
+            continue
+        print({
+            "code": 500,
+            "status": "error",
+            "message": f"error: annotator job {job_id} failed - {message}"
+        }, 500)
 
-    # Open a connection to sqs
-    sqs_client = boto3.client(
-        "sqs",
+        db_client = boto3.client(
+            "dynamodb",
+            region_name=config["aws"]["AwsRegionName"],
+            config=Config(signature_version=config["aws"]["AwsSignatureVersion"]),
+        )
+        try:
+            db_client.update_item(
+                TableName=config["gas"]["AnnotationsTable"],
+                Key={"job_id": {'S': job_id}},
+                ExpressionAttributeValues={
+                    ':FAILED': {'S': 'FAILED'},
+                    ':RUNNING': {'S': 'RUNNING'},
+                },
+                UpdateExpression="SET job_status = :FAILED",
+                ConditionExpression="job_status = :RUNNING",
+            )
+        except ClientError as e:
+            print({
+                "code": 500,
+                "status": "error",
+                "message": f"error: failed to update job status in database - {e}"
+            }, 500)
+        leases.complete(job_id)
+
+
+"""Claims one job request and runs AnnTools on it in the worker pool; see
+consumer.py. The message stays on the queue, hidden under the job's
+lease, until the job is done
+"""
+
+
+def start_job(data, receipt, pool=None, leases=None):
+    job_id = data['job_id']
+    user_id = data['user_id']
+    input_file_name = data['input_file_name']
+    s3_inputs_bucket = data['s3_inputs_bucket']
+    s3_key_input_file = data['s3_key_input_file']
+
+    # Open a connection to s3
+    s3 = boto3.client(
+        "s3",
         region_name=config["aws"]["AwsRegionName"],
         config=Config(signature_version=config["aws"]["AwsSignatureVersion"]),
     )
+    try:
+        # Check if key exists in instance: https://towardsthecloud.com/aws-sdk-key-exists-s3-bucket-boto3
+        # head_object reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/head_object.html
+        # head_object retrieves metadata from an object without returning the object itself
+        # If key does not exist, it will throw error
+        s3.head_object(Bucket=s3_inputs_bucket, Key=s3_key_input_file)
+    except ClientError as e:
+        # Trap key/file not found error 
+        print({
+            "code": 404,
+            "status": "error",
+            "message": f"error: key/file not found - {e}"
+        }, 404)
+        return consumer.RETRY
 
-    # Attempt to read the maximum number of messages from the queue
-    # Use long polling - DO NOT use sleep() to wait between polls
+    # Check if table exists first
+    # Open a connection to dynamodb
+    db_client = boto3.client(
+        "dynamodb",
+        region_name=config["aws"]["AwsRegionName"],
+        config=Config(signature_version=config["aws"]["AwsSignatureVersion"]),
+    )
+    table_name = config["gas"]["AnnotationsTable"]
     try:
-        # SQS receive message: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/receive_message.html
-        sqs_msg_response = sqs_client.receive_message(
-            QueueUrl=sqs,
-            MaxNumberOfMessages=int(config["sqs"]["MaxMessages"]),
-            WaitTimeSeconds=int(config["sqs"]["WaitTime"]),
-        )
+        # Check if table exists: https://stackoverflow.com/questions/42485616/how-to-check-if-dynamodb-table-exists
+        db_describe_response = db_client.describe_table(TableName=table_name)
     except ClientError as e:
-        # Trap failure to receive messages from SQS service
+        print({
+            "code": 404,
+            "status": "error",
+            "message": f"error: table not found - {e}"
+        }, 404)
+        return consumer.RETRY
+    # Claim the job: mark it RUNNING under a lease held by this
+    # instance, which the heartbeat renews until the job is done
+    try:
+        claimed = leases.claim(job_id, receipt)
+    except ClientError as e:
+        # Trap failure to update job status to DynamoDB
         print({
             "code": 500,
             "status": "error",
-            "message": f"Failed to receive message: {e}"
+            "message": f"error: failed to update job status in database - {e}"
         }, 500)
-        return 
-
-    # Process messages received
-    if 'Messages' in sqs_msg_response:
-        for msg in sqs_msg_response['Messages']:
-            # Extract job parameters from the message body 
-            data = json.loads(msg['Body'])['Message']
-            data = data.replace("'", '"')
-            data = json.loads(data)
-            # The unique receipt identifier is for deleting the message
-            receipt_identifier = msg['ReceiptHandle']
+        return consumer.RETRY
+    if not claimed:
+        print(f"Job {job_id} is held by another annotator or done")
+        return consumer.HELD
 
-            try:
-                job_id = data['job_id']['S']
-                user_id = data['user_id']['S']
-                input_file_name = data['input_file_name']['S']
-                s3_inputs_bucket = data['s3_inputs_bucket']['S']
-                s3_key_input_file = data['s3_key_input_file']['S']
-                submit_time = data['submit_time']['N']
-                job_status = data['job_status']['S']
-                if not job_id or not user_id or not input_file_name or not s3_inputs_bucket or not s3_key_input_file or not submit_time or not job_status:
-                    print({
-                        "code": 400,
-                        "status": "error",
-                        "message": "error: empty field value"
-                    }, 400)
-                    continue
-            except KeyError as e:
-                print({
-                    "code": 400,
-                    "status": "error",
-                    "message": "error: key error"
-                }, 400)
-                continue
+    # Create the job's own scratch directory, which run.py removes
+    # once the job is done: https://www.geeksforgeeks.org/how-to-create-directory-if-it-does-not-exist-using-python/
+    job_dir = os.path.join("jobs", job_id)
+    if not os.path.exists(job_dir):
+        try:
+            os.makedirs(job_dir)
+        except IOError as e:
+            print({
+                "code": 500,
+                "status": "error",
+                "message": f"error: failed to set up working dir/files {str(e)}",
+            }, 500)
+            leases.release(job_id)
+            return consumer.HELD
+    # Set path to dump the file to be downloaded
+    filename = job_id + "~" + input_file_name
+    downloaded_file_path = os.path.join(job_dir, filename)
 
-            # Open a connection to s3
-            s3 = boto3.client(
-                "s3",
-                region_name=config["aws"]["AwsRegionName"],
-                config=Config(signature_version=config["aws"]["AwsSignatureVersion"]),
-            )
-            try:
-                # Check if key exists in instance: https://towardsthecloud.com/aws-sdk-key-exists-s3-bucket-boto3
-                # head_object reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/head_object.html
-                # head_object retrieves metadata from an object without returning the object itself
-                # If key does not exist, it will throw error
-                s3.head_object(Bucket=s3_inputs_bucket, Key=s3_key_input_file)
-            except ClientError as e:
-                # Trap key/file not found error 
-                print({
-                    "code": 404,
-                    "status": "error",
-                    "message": f"error: key/file not found - {e}"
-                }, 404)
-                continue
+    # Streamed jobs read the input straight from S3 in run.py
+    job_args = [input_file_name, user_id]
+    if config.getboolean("ann", "StreamS3", fallback=False):
+        job_args = job_args + [s3_inputs_bucket, s3_key_input_file]
+    else:
+        # Get the input file S3 object and copy it to a local file
+        try:
+            # Download file from s3: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-example-download-file.html
+            s3.download_file(s3_inputs_bucket, s3_key_input_file, downloaded_file_path)
+        except ClientError as e:
+            # Trap failure to download error 
+            print({
+              "code": 500,
+              "status": "error",
+              "message": f"error: failed to download file - {e}"
+            }, 500)
+            leases.release(job_id)
+            return consumer.HELD
 
-            # Create directory for storing jobs info: https://www.geeksforgeeks.org/how-to-create-directory-if-it-does-not-exist-using-python/
-            if not os.path.exists('jobs'):
-                try:
-                    os.makedirs('jobs')
-                except IOError as e:
-                    print({
-                        "code": 500,
-                        "status": "error",
-                        "message": f"error: failed to set up working dir/files {str(e)}",
-                    }, 500)
-                    continue
-            # Set path to dump the file to be downloaded
-            filename = job_id + "~" + input_file_name
-            downloaded_file_path = os.path.join("jobs", filename)
-
-            # Get the input file S3 object and copy it to a local file
-            try:
-                # Download file from s3: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-example-download-file.html
-                s3.download_file(s3_inputs_bucket, s3_key_input_file, downloaded_file_path)
-            except ClientError as e:
-                # Trap failure to download error 
-                print({
-                  "code": 500,
-                  "status": "error",
-                  "message": f"error: failed to download file - {e}"
-                }, 500)
-                continue
+    # Hand the job to a worker of the pool; its message is deleted
+    # when the job is done
+    pool.submit(job_id, *job_args)
+    return consumer.HELD
 
-            # Launch annotation job as a background process
-            try:
-                # Spawn a subprocess: https://docs.python.org/3/library/subprocess.html#popen-constructor  
-                Popen(['python', 'run.py', job_id, input_file_name, user_id]) 
-            except Exception as e:
-                print({
-                  "code": 500,
-                  "status": "error",
-                  "message": f"error: failure to launch the annotator job - {e}"
-                }, 500)
-                continue
 
-            # Update job status to running
-            job_status = "RUNNING"
-            # Check if table exists first
-            # Open a connection to dynamodb
-            db_client = boto3.client(
-                "dynamodb",
-                region_name=config["aws"]["AwsRegionName"],
-                config=Config(signature_version=config["aws"]["AwsSignatureVersion"]),
-            )
-            table_name = config["gas"]["AnnotationsTable"]
-            try:
-                # Check if table exists: https://stackoverflow.com/questions/42485616/how-to-check-if-dynamodb-table-exists
-                db_describe_response = db_client.describe_table(TableName=table_name)
-            except ClientError as e:
-                print({
-                    "code": 404,
-                    "status": "error",
-                    "message": f"error: table not found - {e}"
-                }, 404)
-                continue
-            # Update job status only if the current job status is pending
-            try:
-                # Update table: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
-                # Example of updating table on conditional: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.UpdateItem.html
-                db_update_response = db_client.update_item(
-                    TableName=table_name,
-                    Key={"job_id": {'S': job_id}}, 
-                    ExpressionAttributeValues={
-                        ':RUNNING': {'S': 'RUNNING'},
-                        ':PENDING': {'S': 'PENDING'},
-                    },
-                    UpdateExpression="SET job_status = :RUNNING",
-                    ConditionExpression="job_status = :PENDING",
-                    ReturnValues="ALL_NEW"
-                )
-            except ClientError as e:
-                # Trap failure to update job status to DynamoDB
-                print({
-                    "code": 500,
-                    "status": "error",
-                    "message": f"error: failed to update job status in database - {e}"
-                }, 500)
-                continue
+def main():
 
-            # Delete the message from the queue, if job was successfully submitted
+    # Get handles to queue
+    sqs = config["sqs"]["QueueName"]
+
+    # Jobs run in a pool of preforked workers, at most PoolSize at a time;
+    # the fork server imports the AnnTools runner once for all of them
+    pool = workers.WorkerPool(
+        config.getint("ann", "PoolSize", fallback=4), init_worker, run_job,
+        preload=["run"],
+    )
+
+    # Jobs are claimed under leases that keep their messages hidden while
+    # they run, for as long as they take
+    leases = lease.LeaseManager(
+        sqs,
+        config["gas"]["AnnotationsTable"],
+        config["aws"]["AwsRegionName"],
+        config["aws"]["AwsSignatureVersion"],
+        visibility=config.getint("sqs", "VisibilityTimeout", fallback=lease.VISIBILITY),
+        heartbeat=config.getint("sqs", "HeartbeatInterval", fallback=lease.HEARTBEAT),
+    )
+
+    # Requests are received as workers free up and claimed concurrently,
+    # a handler thread per free worker; the client is from a session of
+    # its own, like the leases'
+    sqs_client = boto3.session.Session().client(
+        "sqs",
+        region_name=config["aws"]["AwsRegionName"],
+        config=Config(signature_version=config["aws"]["AwsSignatureVersion"]),
+    )
+    requests = consumer.Consumer(
+        sqs_client,
+        sqs,
+        functools.partial(start_job, pool=pool, leases=leases),
+        messages.JOB.decode,
+        workers=pool.size,
+        max_messages=int(config["sqs"]["MaxMessages"]),
+        wait_time=int(config["sqs"]["WaitTime"]),
+        dead_letter_url=config.get("sqs", "DeadLetterQueueName", fallback="") or None,
+        max_receives=config.getint("sqs", "MaxReceives", fallback=5),
+        capacity=pool.free,
+    )
+
+    # Poll queue for new results and process them; while every worker is
+    # busy, wait for one to finish instead
+    # Use long polling - DO NOT use sleep() to wait between polls
+    try:
+        while True:
+            if pool.free() == 0:
+                report_results(pool, leases, timeout=int(config["sqs"]["WaitTime"]))
+                continue
             try:
-                # SQS delete message: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/delete_message.html
-                sqs_response = sqs_client.delete_message(
-                    QueueUrl=sqs,
-                    ReceiptHandle=receipt_identifier
-                )
+                requests.poll()
             except ClientError as e:
-                # Trap failure to delete messages from SQS service
+                # Trap failure to receive messages from SQS service
                 print({
                     "code": 500,
                     "status": "error",
-                    "message": f"Failed to delete message: {e}"
+                    "message": f"Failed to receive message: {e}"
                 }, 500)
-                continue
-
-
-def main():
-
-    # Get handles to queue
-    sqs = config["sqs"]["QueueName"]
-
-    # Poll queue for new results and process them
-    while True:
-        handle_requests_queue(sqs=sqs)
+            report_results(pool, leases)
+    finally:
+        # Report what is done before the workers stop, then what they
+        # finish while stopping; whatever is left goes back to the queue
+        try:
+            requests.close()
+            report_results(pool, leases)
+            pool.close()
+            report_results(pool, leases)
+        finally:
+            leases.close()
 
 
 if __name__ == "__main__":
@@ -10,10 +10,15 @@ import os
 import json
 import sys
 import time
-from subprocess import Popen, PIPE
+import threading
 from flask import Flask, jsonify, request
 from botocore.client import Config
 from botocore.exceptions import ClientError
+import workers
+import lease
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, "util"))
+import consumer
+import messages
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
@@ -31,11 +36,248 @@ def annotator_webhook():
     return ("Annotator webhook; POST job to /process-job-request"), 200
 
 
+"""Pool of preforked annotation workers, started by the first request
+in the process serving them, and the leases on the jobs they run; see
+workers.py and lease.py
+"""
+pool = None
+leases = None
+requests_consumer = None
+pool_lock = threading.Lock()
+requests_lock = threading.Lock()
+
+
+def init_worker():
+    import run
+    return run.JobContext()
+
+
+def run_job(context, job_id, *args):
+    import run
+    return run.runJob(context, job_id, *args)
+
+
+def get_pool():
+    global pool, leases, requests_consumer
+    with pool_lock:
+        if pool is None:
+            # Workers are forked by a fork server that imports this module
+            # and the AnnTools runner once for all of them
+            pool = workers.WorkerPool(
+                int(app.config["ANNOTATOR_POOL_SIZE"]), init_worker, run_job,
+                preload=["annotator_webhook", "run"],
+            )
+            leases = lease.LeaseManager(
+                app.config["AWS_SQS_REQUESTS_QUEUE_NAME"],
+                app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"],
+                app.config["AWS_REGION_NAME"],
+                app.config["AWS_SIGNATURE_VERSION"],
+                visibility=int(app.config["AWS_SQS_VISIBILITY_TIMEOUT"]),
+                heartbeat=int(app.config["AWS_SQS_HEARTBEAT_INTERVAL"]),
+            )
+            # Requests are claimed concurrently, a handler thread per free
+            # worker; the client is from a session of its own, like the
+            # leases'
+            sqs_client = boto3.session.Session().client(
+                "sqs",
+                region_name=app.config["AWS_REGION_NAME"],
+                config=Config(signature_version=app.config["AWS_SIGNATURE_VERSION"]),
+            )
+            requests_consumer = consumer.Consumer(
+                sqs_client,
+                app.config["AWS_SQS_REQUESTS_QUEUE_NAME"],
+                start_job,
+                messages.JOB.decode,
+                workers=pool.size,
+                max_messages=int(app.config["AWS_SQS_MAX_MESSAGES"]),
+                wait_time=int(app.config["AWS_SQS_WAIT_TIME"]),
+                dead_letter_url=app.config["AWS_SQS_REQUESTS_DEAD_LETTER_QUEUE_NAME"],
+                max_receives=int(app.config["AWS_SQS_MAX_RECEIVES"]),
+                capacity=pool.free,
+            )
+            threading.Thread(target=report_results, daemon=True).start()
+    return pool
+
+
+"""Reports the jobs the pool finished and ends their leases, deleting
+their messages, marking a job that failed FAILED so it does not stay
+RUNNING, and receives more requests as workers free up
+"""
+
+
+def report_results():
+    while True:
+        results = get_pool().results(timeout=int(app.config["AWS_SQS_WAIT_TIME"]))
+        for job_id, ok, message in results:
+            if ok:
+                print(f"Job {job_id} completed")
+                leases.complete(job_id)
+                continue
+            print({
+                "code": 500,
+                "status": "error",
+                "message": f"error: annotator job {job_id} failed - {message}"
+            }, 500)
+
+            db_client = boto3.client(
+                "dynamodb",
+                region_name=app.config["AWS_REGION_NAME"],
+                config=Config(signature_version=app.config["AWS_SIGNATURE_VERSION"]),
+            )
+            try:
+                db_client.update_item(
+                    TableName=app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"],
+                    Key={"job_id": {'S': job_id}},
+                    ExpressionAttributeValues={
+                        ':FAILED': {'S': 'FAILED'},
+                        ':RUNNING': {'S': 'RUNNING'},
+                    },
+                    UpdateExpression="SET job_status = :FAILED",
+                    ConditionExpression="job_status = :RUNNING",
+                )
+            except ClientError as e:
+                print({
+                    "code": 500,
+                    "status": "error",
+                    "message": f"error: failed to update job status in database - {e}"
+                }, 500)
+            leases.complete(job_id)
+
+        if len(results) > 0:
+            error = process_job_requests()
+            if error is not None:
+                print({"code": 500, "status": "error", "message": error}, 500)
+
+
+"""Receives job requests from SQS and hands them to the worker pool;
+returns an error message if the queue could not be read. Only as many
+messages are received as the pool has free workers; the rest stay on the
+queue until a worker finishes (see report_results). A message stays on
+the queue, hidden under the job's lease, until the job is done
+"""
+
+
+def process_job_requests():
+    with requests_lock:
+        try:
+            get_pool()
+            requests_consumer.poll()
+        except ClientError as e:
+            # Trap failure to receive messages from SQS service
+            return f"Failed to receive message: {e}"
+    return None
+
+
+"""Claims a job request and hands it to the worker pool; see consumer.py
+"""
+
+
+def start_job(data, receipt):
+    job_id = data['job_id']
+    user_id = data['user_id']
+    input_file_name = data['input_file_name']
+    s3_inputs_bucket = data['s3_inputs_bucket']
+    s3_key_input_file = data['s3_key_input_file']
+
+    # Open a connection to s3
+    s3 = boto3.client(
+        "s3",
+        region_name=app.config["AWS_REGION_NAME"],
+        config=Config(signature_version=app.config["AWS_SIGNATURE_VERSION"]),
+    )
+    try:
+        # Check if key exists in instance: https://towardsthecloud.com/aws-sdk-key-exists-s3-bucket-boto3
+        # head_object reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/head_object.html
+        # head_object retrieves metadata from an object without returning the object itself
+        # If key does not exist, it will throw error
+        s3.head_object(Bucket=s3_inputs_bucket, Key=s3_key_input_file)
+    except ClientError as e:
+        # Trap key/file not found error 
+        print({
+            "code": 404,
+            "status": "error",
+            "message": f"error: key/file not found - {e}"
+        }, 404)
+        return consumer.RETRY
+
+    # Check if table exists first
+    # Open a connection to dynamodb
+    db_client = boto3.client(
+        "dynamodb",
+        region_name=app.config["AWS_REGION_NAME"],
+        config=Config(signature_version=app.config["AWS_SIGNATURE_VERSION"]),
+    )
+    table_name = app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"]
+    try:
+        # Check if table exists: https://stackoverflow.com/questions/42485616/how-to-check-if-dynamodb-table-exists
+        db_describe_response = db_client.describe_table(TableName=table_name)
+    except ClientError as e:
+        print({
+            "code": 404,
+            "status": "error",
+            "message": f"error: table not found - {e}"
+        }, 404)
+        return consumer.RETRY
+
+    # Claim the job: mark it RUNNING under a lease held by this
+    # instance, which the heartbeat renews until the job is done
+    try:
+        claimed = leases.claim(job_id, receipt)
+    except ClientError as e:
+        # Trap failure to update job status to DynamoDB
+        print({
+            "code": 500,
+            "status": "error",
+            "message": f"error: failed to update job status in database - {e}"
+        }, 500)
+        return consumer.RETRY
+    if not claimed:
+        print(f"Job {job_id} is held by another annotator or done")
+        return consumer.HELD
+
+    # Create the job's own scratch directory, which run.py removes
+    # once the job is done: https://www.geeksforgeeks.org/how-to-create-directory-if-it-does-not-exist-using-python/
+    job_dir = os.path.join("jobs", job_id)
+    if not os.path.exists(job_dir):
+        try:
+            os.makedirs(job_dir)
+        except IOError as e:
+            print({
+                "code": 500,
+                "status": "error",
+                "message": f"error: failed to set up working dir/files {str(e)}",
+            }, 500)
+            leases.release(job_id)
+            return consumer.HELD
+    # Set path to dump the file to be downloaded
+    filename = job_id + "~" + input_file_name
+    downloaded_file_path = os.path.join(job_dir, filename)
+
+    # Get the input file S3 object and copy it to a local file
+    try:
+        # Download file from s3: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-example-download-file.html
+        s3.download_file(s3_inputs_bucket, s3_key_input_file, downloaded_file_path)
+    except ClientError as e:
+        # Trap failure to download error 
+        print({
+          "code": 500,
+          "status": "error",
+          "message": f"error: failed to download file - {e}"
+        }, 500)
+        leases.release(job_id)
+        return consumer.HELD
+
+    # Hand the job to a worker of the pool; its message is deleted
+    # when the job is done
+    get_pool().submit(job_id, input_file_name, user_id)
+    return consumer.HELD
+
+
 """
 Replace polling with webhook in annotator
 
 Receives request from SNS; queries job queue and processes message.
-Reads request messages from SQS and runs AnnTools as a subprocess.
+Reads request messages from SQS and runs AnnTools in the worker pool.
 Updates the annotations database with the status of the request.
 """
 
@@ -86,191 +328,19 @@ def annotate():
                 400,
             )
     elif message_type == 'Notification':
-        # Process job request
-        sqs = app.config["AWS_SQS_REQUESTS_QUEUE_NAME"]
-
-        # Open a connection to sqs
-        sqs_client = boto3.client(
-            "sqs",
-            region_name=app.config["AWS_REGION_NAME"],
-            config=Config(signature_version=app.config["AWS_SIGNATURE_VERSION"]),
-        )
-
-        # Attempt to read the maximum number of messages from the queue
-        try:
-            # SQS receive message: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/receive_message.html
-            sqs_msg_response = sqs_client.receive_message(
-                QueueUrl=sqs,
-                MaxNumberOfMessages=int(app.config["AWS_SQS_MAX_MESSAGES"]),
-                WaitTimeSeconds=int(app.config["AWS_SQS_WAIT_TIME"]),
-            )
-        except ClientError as e:
-            # Trap failure to receive messages from SQS service
+        error = process_job_requests()
+        if error is not None:
             return (
                 jsonify(
                     {
                         "code": 500,
                         "status": "error",
-                        "message": f"Failed to receive message: {e}"
+                        "message": error
                     }
                 ),
                 500,
             )
 
-        # Process messages received
-        if 'Messages' in sqs_msg_response:
-            for msg in sqs_msg_response['Messages']:
-                # Extract job parameters from the message body 
-                data = json.loads(msg['Body'])['Message']
-                data = data.replace("'", '"')
-                data = json.loads(data)
-                # The unique receipt identifier is for deleting the message
-                receipt_identifier = msg['ReceiptHandle']
-
-                try:
-                    job_id = data['job_id']['S']
-                    user_id = data['user_id']['S']
-                    input_file_name = data['input_file_name']['S']
-                    s3_inputs_bucket = data['s3_inputs_bucket']['S']
-                    s3_key_input_file = data['s3_key_input_file']['S']
-                    submit_time = data['submit_time']['N']
-                    job_status = data['job_status']['S']
-                    if not job_id or not user_id or not input_file_name or not s3_inputs_bucket or not s3_key_input_file or not submit_time or not job_status:
-                        print({
-                            "code": 400,
-                            "status": "error",
-                            "message": "error: empty field value"
-                        }, 400)
-                        continue
-                except KeyError as e:
-                    print({
-                        "code": 400,
-                        "status": "error",
-                        "message": f"error: key error {e}"
-                    }, 400)
-                    continue
-
-                # Open a connection to s3
-                s3 = boto3.client(
-                    "s3",
-                    region_name=app.config["AWS_REGION_NAME"],
-                    config=Config(signature_version=app.config["AWS_SIGNATURE_VERSION"]),
-                )
-                try:
-                    # Check if key exists in instance: https://towardsthecloud.com/aws-sdk-key-exists-s3-bucket-boto3
-                    # head_object reference: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/head_object.html
-                    # head_object retrieves metadata from an object without returning the object itself
-                    # If key does not exist, it will throw error
-                    s3.head_object(Bucket=s3_inputs_bucket, Key=s3_key_input_file)
-                except ClientError as e:
-                    # Trap key/file not found error 
-                    print({
-                        "code": 404,
-                        "status": "error",
-                        "message": f"error: key/file not found - {e}"
-                    }, 404)
-                    continue
-
-                # Create directory for storing jobs info: https://www.geeksforgeeks.org/how-to-create-directory-if-it-does-not-exist-using-python/
-                if not os.path.exists('jobs'):
-                    try:
-                        os.makedirs('jobs')
-                    except IOError as e:
-                        print({
-                            "code": 500,
-                            "status": "error",
-                            "message": f"error: failed to set up working dir/files {str(e)}",
-                        }, 500)
-                        continue
-                # Set path to dump the file to be downloaded
-                filename = job_id + "~" + input_file_name
-                downloaded_file_path = os.path.join("jobs", filename)
-
-                # Get the input file S3 object and copy it to a local file
-                try:
-                    # Download file from s3: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-example-download-file.html
-                    s3.download_file(s3_inputs_bucket, s3_key_input_file, downloaded_file_path)
-                except ClientError as e:
-                    # Trap failure to download error 
-                    print({
-                      "code": 500,
-                      "status": "error",
-                      "message": f"error: failed to download file - {e}"
-                    }, 500)
-                    continue
-
-                # Launch annotation job as a background process
-                try:
-                    # Spawn a subprocess: https://docs.python.org/3/library/subprocess.html#popen-constructor  
-                    Popen(['python', 'run.py', job_id, input_file_name, user_id]) 
-                except Exception as e:
-                    print({
-                      "code": 500,
-                      "status": "error",
-                      "message": f"error: failure to launch the annotator job - {e}"
-                    }, 500)
-                    continue
-
-                # Update job status to running
-                job_status = "RUNNING"
-                # Check if table exists first
-                # Open a connection to dynamodb
-                db_client = boto3.client(
-                    "dynamodb",
-                    region_name=app.config["AWS_REGION_NAME"],
-                    config=Config(signature_version=app.config["AWS_SIGNATURE_VERSION"]),
-                )
-                table_name = app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"]
-                try:
-                    # Check if table exists: https://stackoverflow.com/questions/42485616/how-to-check-if-dynamodb-table-exists
-                    db_describe_response = db_client.describe_table(TableName=table_name)
-                except ClientError as e:
-                    print({
-                        "code": 404,
-                        "status": "error",
-                        "message": f"error: table not found - {e}"
-                    }, 404)
-                    continue
-                # Update job status only if the current job status is pending
-                try:
-                    # Update table: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
-                    # Example of updating table on conditional: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.UpdateItem.html
-                    db_update_response = db_client.update_item(
-                        TableName=table_name,
-                        Key={"job_id": {'S': job_id}}, 
-                        ExpressionAttributeValues={
-                            ':RUNNING': {'S': 'RUNNING'},
-                            ':PENDING': {'S': 'PENDING'},
-                        },
-                        UpdateExpression="SET job_status = :RUNNING",
-                        ConditionExpression="job_status = :PENDING",
-                        ReturnValues="ALL_NEW"
-                    )
-                except ClientError as e:
-                    # Trap failure to update job status to DynamoDB
-                    print({
-                        "code": 500,
-                        "status": "error",
-                        "message": f"error: failed to update job status in database - {e}"
-                    }, 500)
-                    continue
-
-                # Delete the message from the queue, if job was successfully submitted
-                try:
-                    # SQS delete message: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/delete_message.html
-                    sqs_response = sqs_client.delete_message(
-                        QueueUrl=sqs,
-                        ReceiptHandle=receipt_identifier
-                    )
-                except ClientError as e:
-                    # Trap failure to delete messages from SQS service
-                    print({
-                        "code": 500,
-                        "status": "error",
-                        "message": f"Failed to delete message: {e}"
-                    }, 500)
-                    continue
-
     return (
         jsonify(
             {
@@ -23,6 +23,9 @@ class Config(object):
     ANNOTATOR_BASE_DIR = "/home/ubuntu/gas/ann"
     ANNOTATOR_JOBS_DIR = f"{ANNOTATOR_BASE_DIR}/jobs"
 
+    # Annotation jobs run at once by the preforked worker pool
+    ANNOTATOR_POOL_SIZE = 4
+
     AWS_REGION_NAME = (
         os.environ["AWS_REGION_NAME"]
         if ("AWS_REGION_NAME" in os.environ)
@@ -46,6 +49,13 @@ class Config(object):
     # AWS SQS queues
     AWS_SQS_WAIT_TIME = 20
     AWS_SQS_MAX_MESSAGES = 10
+    # Seconds a running job's request stays hidden per lease heartbeat, and
+    # seconds between heartbeats
+    AWS_SQS_VISIBILITY_TIMEOUT = 300
+    AWS_SQS_HEARTBEAT_INTERVAL = 60
+    # Receives after which a request goes to the dead-letter queue, if any
+    AWS_SQS_MAX_RECEIVES = 5
+    AWS_SQS_REQUESTS_DEAD_LETTER_QUEUE_NAME = None
     AWS_SQS_REQUESTS_QUEUE_NAME = (
         f"https://sqs.us-east-1.amazonaws.com/127134666975/{iam_username}_a{HW}_job_requests"
     )
@@ -0,0 +1,265 @@
+# bgzf.py
+# BGZF-compressed VCF input/output and tabix indexes for annotation results
+
+import gzip
+import struct
+import zlib
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Uncompressed bytes per block; keeps every compressed block under 64 KiB
+BLOCK_SIZE = 0xFF00
+
+# Empty block that ends every BGZF file
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# Tabix: VCF preset (sequence, begin columns; end from the REF length),
+# '#' meta lines, 16 kb linear index windows
+TBX_VCF = 2
+LINEAR_SHIFT = 14
+
+
+def isGzip(path):
+    with open(path, "rb") as fh:
+        return fh.read(2) == GZIP_MAGIC
+
+
+"""Opens a VCF for reading as text, decompressing gzip and BGZF (which is
+multi-member gzip) as it is read
+"""
+
+
+def openText(path):
+    if isGzip(path):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path)
+
+
+"""Decompresses a gzip or BGZF stream a chunk at a time, across members
+"""
+
+
+class Inflater(object):
+    def __init__(self):
+        self.inflater = None
+
+    def decompress(self, chunk):
+        out = []
+        while len(chunk) > 0:
+            if self.inflater is None:
+                self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out.append(self.inflater.decompress(chunk))
+            chunk = b""
+            if self.inflater.eof:
+                chunk = self.inflater.unused_data
+                self.inflater = None
+        return b"".join(out)
+
+
+"""The bin of the UCSC/tabix binning scheme holding [beg, end), 0-based
+"""
+
+
+def reg2bin(beg, end):
+    end = end - 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+"""Writes BGZF to a path or a binary stream (e.g. s3stream.S3MultipartWriter)
+
+Accepts text or bytes. tell() is the BGZF virtual offset of the next byte:
+the compressed offset of its block shifted left 16 bits, plus its offset
+in the block. Given a TabixIndex, every line written is added to it with
+the virtual offsets where it starts and ends. close() ends the file; a
+stream passed in is left open.
+"""
+
+
+class BgzfWriter(object):
+    def __init__(self, out, index=None, level=6):
+        self.owned = isinstance(out, str)
+        self.fh = open(out, "wb") if self.owned else out
+        self.index = index
+        self.level = level
+
+        self.block = bytearray()
+        self.offset = 0
+        self.line = bytearray()
+        self.line_start = 0
+
+    def tell(self):
+        return (self.offset << 16) | len(self.block)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if self.index is None:
+            self.append(data)
+            return
+
+        start = 0
+        while start < len(data):
+            stop = data.find(b"\n", start)
+            stop = len(data) if stop < 0 else stop + 1
+            piece = data[start:stop]
+            start = stop
+            if len(self.line) == 0:
+                self.line_start = self.tell()
+            self.append(piece)
+            self.line.extend(piece)
+            if piece.endswith(b"\n"):
+                self.index.add(self.line, self.line_start, self.tell())
+                self.line = bytearray()
+
+    def append(self, data):
+        self.block.extend(data)
+        while len(self.block) >= BLOCK_SIZE:
+            self.flushBlock(BLOCK_SIZE)
+
+    def flushBlock(self, size):
+        data = bytes(self.block[:size])
+        del self.block[:size]
+
+        deflate = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        cdata = deflate.compress(data) + deflate.flush()
+        header = struct.pack(
+            "<4BI2BH2BHH",
+            0x1F,
+            0x8B,
+            8,
+            4,
+            0,
+            0,
+            0xFF,
+            6,
+            ord("B"),
+            ord("C"),
+            2,
+            len(cdata) + 25,
+        )
+        block = header + cdata + struct.pack("<2I", zlib.crc32(data), len(data))
+        self.fh.write(block)
+        self.offset = self.offset + len(block)
+
+    def close(self):
+        if len(self.line) > 0 and self.index is not None:
+            self.index.add(self.line, self.line_start, self.tell())
+            self.line = bytearray()
+        if len(self.block) > 0:
+            self.flushBlock(len(self.block))
+        self.fh.write(EOF_BLOCK)
+        if self.owned:
+            self.fh.close()
+
+
+"""Tabix (.tbi) index of a BGZF-compressed, coordinate-sorted VCF
+
+Built from the lines as BgzfWriter writes them. Each record is placed in
+the smallest bin of the binning scheme that holds its REF span, as a
+chunk of virtual offsets (adjacent chunks in a bin are merged), and the
+linear index keeps the first record offset in every 16 kb window. If the
+records turn out not to be sorted the index cannot be used, and write()
+declines to write it.
+"""
+
+
+class TabixIndex(object):
+    def __init__(self):
+        self.names = []
+        self.refs = {}
+        self.chrom = None
+        self.last = -1
+        self.sorted = True
+
+    def add(self, line, start, end):
+        if line.startswith(b"#"):
+            return
+        fields = line.rstrip(b"\r\n").split(b"\t", 4)
+        if len(fields) < 4:
+            return
+        try:
+            beg = int(fields[1]) - 1
+        except ValueError:
+            return
+        stop = beg + max(len(fields[3]), 1)
+
+        chrom = fields[0].decode("utf-8")
+        if chrom != self.chrom:
+            if chrom in self.refs:
+                self.sorted = False
+            else:
+                self.names.append(chrom)
+                self.refs[chrom] = ({}, [])
+            self.chrom = chrom
+            self.last = -1
+        if beg < self.last:
+            self.sorted = False
+        self.last = beg
+
+        bins, linear = self.refs[chrom]
+        chunks = bins.setdefault(reg2bin(max(beg, 0), stop), [])
+        if len(chunks) > 0 and chunks[-1][1] == start:
+            chunks[-1][1] = end
+        else:
+            chunks.append([start, end])
+
+        first = max(beg, 0) >> LINEAR_SHIFT
+        last = (stop - 1) >> LINEAR_SHIFT
+        if len(linear) <= last:
+            linear.extend([None] * (last + 1 - len(linear)))
+        for w in range(first, last + 1):
+            if linear[w] is None:
+                linear[w] = start
+
+    def getBytes(self):
+        names = b"".join([name.encode("utf-8") + b"\0" for name in self.names])
+        out = [b"TBI\1"]
+        out.append(
+            struct.pack(
+                "<8i", len(self.names), TBX_VCF, 1, 2, 0, ord("#"), 0, len(names)
+            )
+        )
+        out.append(names)
+        for name in self.names:
+            bins, linear = self.refs[name]
+            out.append(struct.pack("<i", len(bins)))
+            for bin in sorted(bins):
+                chunks = bins[bin]
+                out.append(struct.pack("<Ii", bin, len(chunks)))
+                for start, end in chunks:
+                    out.append(struct.pack("<QQ", start, end))
+
+            # Empty windows take the offset of the window before them
+            offsets = []
+            previous = 0
+            for offset in linear:
+                previous = previous if offset is None else offset
+                offsets.append(previous)
+            out.append(struct.pack("<i", len(offsets)))
+            out.append(struct.pack(f"<{len(offsets)}Q", *offsets))
+        return b"".join(out)
+
+    """Writes the index, BGZF-compressed, to a path or binary stream;
+    returns False, writing nothing, if the records were not sorted
+    """
+
+    def write(self, out):
+        if not self.sorted:
+            return False
+        writer = BgzfWriter(out)
+        writer.write(self.getBytes())
+        writer.close()
+        return True
+
+
+### EOF
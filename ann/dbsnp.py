@@ -0,0 +1,386 @@
+# dbsnp.py
+# Compact memory-mapped dbSNP index with a blocked bloom filter
+#
+# Built as part of a reference snapshot (see snapshot.py)
+
+import os
+import re
+import mmap
+from bisect import bisect_left
+
+import numpy as np
+import pymysql
+
+# Rows fetched from dbSNP per round trip while building
+FETCH_SIZE = 100000
+
+# Bloom filter sizing: bits per distinct (chromosome, position) key and
+# bits set per key; one 512-bit block (8 x uint64) per lookup
+BLOOM_BITS_PER_KEY = 10
+BLOOM_HASHES = 7
+BLOCK_WORDS = 8
+
+BASES = "ACGT"
+RSID = re.compile(r"^rs([1-9][0-9]*)$")
+
+"""Column positions in `select * from dbSNP`, as DbSnpStage reads them
+"""
+CHR = 0
+POS = 1
+RSID_COLUMN = 3
+REF = 4
+INFO = 6
+GMAF = 7
+
+
+def getChromKey(chrom):
+    return str(chrom).upper().rstrip()
+
+
+"""64-bit hashes of (chromosome number, position) keys (splitmix64)
+"""
+
+
+def mix(x):
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def hashKeys(chrom_ids, positions):
+    keys = (np.asarray(chrom_ids, dtype=np.uint64) << np.uint64(32)) | np.asarray(
+        positions, dtype=np.uint64
+    )
+    with np.errstate(over="ignore"):
+        first = mix(keys + np.uint64(0x9E3779B97F4A7C15))
+        second = mix(first + np.uint64(0x9E3779B97F4A7C15))
+    return first, second
+
+
+"""Word offsets and bit masks of every bit a key sets in the filter
+"""
+
+
+def getBloomBits(chrom_ids, positions, blocks):
+    first, second = hashKeys(chrom_ids, positions)
+    base = (first % np.uint64(blocks)) * np.uint64(BLOCK_WORDS)
+    words = []
+    masks = []
+    for j in range(BLOOM_HASHES):
+        bit = (second >> np.uint64(9 * j)) & np.uint64(511)
+        words.append(base + (bit >> np.uint64(6)))
+        masks.append(np.uint64(1) << (bit & np.uint64(63)))
+    return words, masks
+
+
+def buildBloom(chrom_ids, positions):
+    blocks = max(1, -(-len(positions) * BLOOM_BITS_PER_KEY // (64 * BLOCK_WORDS)))
+    bloom = np.zeros(blocks * BLOCK_WORDS, dtype=np.uint64)
+    words, masks = getBloomBits(chrom_ids, positions, blocks)
+    for word, mask in zip(words, masks):
+        np.bitwise_or.at(bloom, word.astype(np.int64), mask)
+    return bloom
+
+
+def getStreamingCursor(conn):
+    if isinstance(conn, pymysql.connections.Connection):
+        return conn.cursor(pymysql.cursors.SSCursor)
+    return conn.cursor()
+
+
+"""Column arrays for one chromosome, accumulated chunk by chunk
+rsIDs of the form rs<n> are kept as uint32 and REF alleles that are a
+single base as a 2-bit code; anything else goes to a sparse side list.
+INFO is a one-byte code into the class list and GMAF a fixed-width
+byte string holding its text exactly as MySQL returned it
+"""
+
+
+class ChromBuilder(object):
+    def __init__(self):
+        self.positions = []
+        self.rsids = []
+        self.refs = []
+        self.classes = []
+        self.gmafs = []
+        self.sparse_rsids = {}
+        self.sparse_refs = {}
+        self.count = 0
+
+    def add(self, rows, classes):
+        positions = np.empty(len(rows), dtype=np.uint32)
+        rsids = np.zeros(len(rows), dtype=np.uint32)
+        refs = np.zeros(len(rows), dtype=np.uint8)
+        codes = np.empty(len(rows), dtype=np.uint8)
+        gmafs = []
+
+        for i, row in enumerate(rows):
+            positions[i] = int(row[POS])
+
+            rsid = str(row[RSID_COLUMN])
+            match = RSID.match(rsid)
+            if match is not None and int(match.group(1)) < 2**32:
+                rsids[i] = int(match.group(1))
+            else:
+                self.sparse_rsids[self.count + i] = rsid
+
+            ref = str(row[REF]).upper()
+            if len(ref) == 1 and ref in BASES:
+                refs[i] = BASES.index(ref)
+            else:
+                self.sparse_refs[self.count + i] = ref
+
+            varclass = str(row[INFO])
+            if varclass not in classes:
+                if len(classes) == 256:
+                    raise ValueError("dbSNP has more than 256 INFO classes")
+                classes[varclass] = len(classes)
+            codes[i] = classes[varclass]
+
+            gmafs.append(str(row[GMAF]).encode("utf-8"))
+
+        self.positions.append(positions)
+        self.rsids.append(rsids)
+        self.refs.append(refs)
+        self.classes.append(codes)
+        self.gmafs.append(np.asarray(gmafs, dtype=bytes))
+        self.count = self.count + len(rows)
+
+    """Writes the chromosome sorted by position; rows at the same position
+    keep the order the table returned them in
+    """
+
+    def write(self, path):
+        os.makedirs(path)
+        positions = np.concatenate(self.positions)
+        order = np.argsort(positions, kind="stable")
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order), dtype=np.int64)
+
+        np.save(os.path.join(path, "pos.npy"), positions[order])
+        np.save(os.path.join(path, "rsid.npy"), np.concatenate(self.rsids)[order])
+        np.save(os.path.join(path, "class.npy"), np.concatenate(self.classes)[order])
+        np.save(
+            os.path.join(path, "ref.npy"), packBases(np.concatenate(self.refs)[order])
+        )
+        np.save(os.path.join(path, "gmaf.npy"), np.concatenate(self.gmafs)[order])
+        writeSparse(path, "rsid", rank, self.sparse_rsids)
+        writeSparse(path, "ref", rank, self.sparse_refs)
+
+        return positions[order]
+
+
+"""Packs 2-bit base codes four to a byte
+"""
+
+
+def packBases(codes):
+    padded = np.zeros(-(-len(codes) // 4) * 4, dtype=np.uint8)
+    padded[: len(codes)] = codes
+    padded = padded.reshape(-1, 4)
+    return (
+        padded[:, 0] | (padded[:, 1] << 2) | (padded[:, 2] << 4) | (padded[:, 3] << 6)
+    ).astype(np.uint8)
+
+
+def writeHeap(path, name, values):
+    lengths = np.fromiter((len(v) for v in values), dtype=np.int64, count=len(values))
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    dtype = np.uint32 if offsets[-1] < 2**32 else np.uint64
+    np.save(os.path.join(path, name + ".offsets.npy"), offsets.astype(dtype))
+    with open(os.path.join(path, name + ".heap"), "wb") as fh:
+        for v in values:
+            fh.write(v)
+
+
+def writeSparse(path, name, rank, values):
+    if len(values) == 0:
+        return
+    items = sorted([(int(rank[i]), v) for i, v in values.items()])
+    np.save(
+        os.path.join(path, name + ".sparse.npy"),
+        np.asarray([i for i, _ in items], dtype=np.int64),
+    )
+    writeHeap(path, name + ".sparse", [v.encode("utf-8") for _, v in items])
+
+
+"""Exports the dbSNP table into path, one directory per chromosome, plus
+the bloom filter. Returns the manifest entry describing the index
+"""
+
+
+def build(path, conn):
+    os.makedirs(path)
+    cursor = getStreamingCursor(conn)
+    cursor.execute("select * from dbSNP;")
+
+    builders = {}
+    classes = {}
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if len(rows) == 0:
+            break
+
+        groups = {}
+        for row in rows:
+            if row[CHR] is not None and row[POS] is not None:
+                groups.setdefault(getChromKey(row[CHR]), []).append(row)
+        for chrom, group in groups.items():
+            builders.setdefault(chrom, ChromBuilder()).add(group, classes)
+    cursor.close()
+
+    chroms = {}
+    chrom_ids = []
+    positions = []
+    for i, chrom in enumerate(sorted(builders)):
+        entry = str(i)
+        sorted_positions = builders[chrom].write(os.path.join(path, entry))
+        chroms[chrom] = {"path": entry, "id": i, "rows": builders[chrom].count}
+        builders[chrom] = None
+
+        # The filter holds each distinct position once
+        distinct = np.unique(sorted_positions)
+        chrom_ids.append(np.full(len(distinct), i, dtype=np.uint64))
+        positions.append(distinct)
+
+    bloom = buildBloom(
+        np.concatenate(chrom_ids) if len(chrom_ids) > 0 else [],
+        np.concatenate(positions) if len(positions) > 0 else [],
+    )
+    np.save(os.path.join(path, "bloom.npy"), bloom)
+
+    return {
+        "chroms": chroms,
+        "classes": sorted(classes, key=classes.get),
+        "bloom": {"blocks": len(bloom) // BLOCK_WORDS, "hashes": BLOOM_HASHES},
+    }
+
+
+def loadArray(path, name):
+    return np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+
+
+"""Strings stored as a heap plus offsets, read without loading the heap
+"""
+
+
+class Heap(object):
+    def __init__(self, path, name):
+        self.offsets = loadArray(path, name + ".offsets")
+        self.heap = b""
+        if self.offsets[-1] > 0:
+            with open(os.path.join(path, name + ".heap"), "rb") as fh:
+                self.heap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, i):
+        return self.heap[self.offsets[i] : self.offsets[i + 1]].decode("utf-8")
+
+
+class Sparse(object):
+    def __init__(self, path, name):
+        self.rows = []
+        self.heap = None
+        if os.path.exists(os.path.join(path, name + ".sparse.npy")):
+            self.rows = loadArray(path, name + ".sparse")
+            self.heap = Heap(path, name + ".sparse")
+
+    def get(self, i):
+        if len(self.rows) == 0:
+            return None
+        k = bisect_left(self.rows, i)
+        if k < len(self.rows) and self.rows[k] == i:
+            return self.heap.get(k)
+        return None
+
+
+class DbSnpChrom(object):
+    def __init__(self, path):
+        self.positions = loadArray(path, "pos")
+        self.rsids = loadArray(path, "rsid")
+        self.refs = loadArray(path, "ref")
+        self.classes = loadArray(path, "class")
+        self.gmafs = loadArray(path, "gmaf")
+        self.sparse_rsids = Sparse(path, "rsid")
+        self.sparse_refs = Sparse(path, "ref")
+
+
+"""Read-only dbSNP index inside a snapshot
+lookup() takes a batch of (CHR, POS) keys and returns, per key, the
+matching rows as (rsID, REF, INFO, GMAF) strings in table order. Keys the
+bloom filter rules out never touch the position arrays.
+"""
+
+
+class DbSnpIndex(object):
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.classes = meta["classes"]
+        self.blocks = meta["bloom"]["blocks"]
+        self.bloom = loadArray(path, "bloom")
+        self.chroms = {}
+
+        self.lookups = 0
+        self.rejected = 0
+
+    def chrom(self, key):
+        entry = self.meta["chroms"].get(key)
+        if entry is None:
+            return None
+        if key not in self.chroms:
+            self.chroms[key] = DbSnpChrom(os.path.join(self.path, entry["path"]))
+        return self.chroms[key]
+
+    def mayContain(self, chrom_ids, positions):
+        words, masks = getBloomBits(chrom_ids, positions, self.blocks)
+        present = np.ones(len(positions), dtype=bool)
+        for word, mask in zip(words, masks):
+            present &= (self.bloom[word.astype(np.int64)] & mask) != 0
+        return present
+
+    def getRow(self, data, i):
+        rsid = data.sparse_rsids.get(i)
+        if rsid is None:
+            rsid = "rs" + str(int(data.rsids[i]))
+
+        ref = data.sparse_refs.get(i)
+        if ref is None:
+            ref = BASES[(int(data.refs[i >> 2]) >> ((i & 3) * 2)) & 3]
+
+        gmaf = data.gmafs[i].decode("utf-8")
+        return (rsid, ref, self.classes[int(data.classes[i])], gmaf)
+
+    def lookup(self, keys):
+        results = [[] for _ in keys]
+        queries = []
+        for q, (chrom, pos) in enumerate(keys):
+            entry = self.meta["chroms"].get(getChromKey(chrom))
+            pos = int(pos)
+            if entry is not None and 0 <= pos < 2**32:
+                queries.append((q, getChromKey(chrom), entry["id"], pos))
+
+        self.lookups = self.lookups + len(keys)
+        if len(queries) == 0:
+            self.rejected = self.rejected + len(keys)
+            return results
+
+        present = self.mayContain(
+            [chrom_id for _, _, chrom_id, _ in queries],
+            [pos for _, _, _, pos in queries],
+        )
+        self.rejected = self.rejected + len(keys) - int(present.sum())
+
+        for (q, chrom, _, pos), hit in zip(queries, present.tolist()):
+            if not hit:
+                continue
+            data = self.chrom(chrom)
+            i = int(np.searchsorted(data.positions, pos, side="left"))
+            while i < len(data.positions) and data.positions[i] == pos:
+                results[q].append(self.getRow(data, i))
+                i = i + 1
+
+        return results
+
+
+### EOF
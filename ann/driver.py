@@ -2,168 +2,540 @@
 
 import sys
 import os
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import file_utils as fu
+import utils as u
 import annotate as ann
+import engine as en
+import reference as rs
+import snapshot as sn
+import bgzf
 
+"""Annotation stages in the order they are applied: (stage, options, label)
+"""
+PIPELINE = [
+    (ann.DbSnpStage, {}, "dbSNP"),
+    (ann.BigRefGeneStage, {}, "BigRefGene"),
+    (ann.GenesStage, {"table": "refGene", "promoter_offset": 500}, "refGene"),
+    (ann.CytobandStage, {"table": "cytoBand"}, "Cytoband"),
+    (ann.GadAllStage, {"table": "gadAll"}, "gadAll"),
+    (ann.GwasCatalogStage, {"table": "gwasCatalog"}, "GwasCatalog"),
+    (ann.MiRNAStage, {"table": "targetScanS"}, "miRNA"),
+    (ann.HugoStage, {"table": "hugo"}, "HUGO Gene Nomenclature Committee"),
+    (ann.CnvDatabaseStage, {"table": "dgv_Cnv"}, "dgv_Cnv"),
+    (
+        ann.CnvDatabaseStage,
+        {"table": "abParts_IG_T_CelReceptors"},
+        "abParts_IG_T_CelReceptors",
+    ),
+    (ann.CnvDatabaseStage, {"table": "mcCarroll_Cnv"}, "mcCarroll_Cnv"),
+    (ann.CnvDatabaseStage, {"table": "conrad_Cnv"}, "conrad_Cnv"),
+    (ann.GenomicSuperDupsStage, {"table": "genomicSuperDups"}, "genomicSuperDups"),
+    (ann.TfbsConsSitesStage, {"table": "tfbsConsSites"}, "tfbsConsSites"),
+]
 
-def run(infile, format):
+
+"""Runs the pipeline
+By default every stage makes its own pass over the file, writing
+infile.1 ... infile.N; with fused=True each record is parsed once and
+run through all stages in memory, producing identical output
+With sweep=True the range-table stages merge-join a coordinate-sorted
+input against each table instead of querying once per variant; with
+index=True they load each table into an in-memory interval index instead.
+Given a snapshot (snapshot.Snapshot), stages read the tables it holds from
+the memory-mapped snapshot rather than the database
+backend picks the reference store for everything else: "mysql" (RDS),
+"sqlite" (a local file built with reference.py, at backend_path) or
+"memory" (tables cached from RDS for the rest of the job)
+Records are annotated batch_size at a time so stages can batch lookups.
+With concurrent=True the fused pipeline runs the lookups of independent
+stages (see annotate.Stage) in threads, each with its own store, when
+they go to the database; lookups served from a snapshot or a SQLite file
+are CPU bound and stay serial, as workers already spreads them over cores
+With engine="async" the fused pipeline runs as asyncio tasks instead (see
+engine.py): every stage gets its own store and works through the batches
+behind a window of at most window batches, overlapping the lookups of all
+stages with reading and writing
+With workers > 1 the input is split into that many byte ranges, each run
+through the fused pipeline in its own process; the outputs are joined in
+input order and the counts summed into a single count log. gzip and BGZF
+inputs are read as they are decompressed, so they run in one process
+With compress=True the results are written BGZF compressed, with a tabix
+index next to them if the input was sorted (see getOutputNames)
+Given a variant cache (varcache.VariantCache, or a panel.Panel, or
+varcache.Tiers of them), the fused pipeline takes the records it already
+holds from it and adds the rest; the chained pipeline writes every stage's
+output to disk and does not use it
+"""
+
+
+def run(
+    infile,
+    format,
+    fused=False,
+    sweep=False,
+    index=False,
+    snapshot=None,
+    backend="mysql",
+    backend_path=None,
+    batch_size=ann.BATCH_SIZE,
+    workers=1,
+    concurrent=False,
+    engine="batch",
+    window=en.WINDOW,
+    compress=False,
+    cache=None,
+):
 
     print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format="vcf", tmpextin="", tmpextout=".1")
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
+    results, logfile = getOutputNames(infile, compress=compress)
+    if workers > 1 and bgzf.isGzip(infile):
+        print("Compressed input - annotating in a single process")
+        workers = 1
+        fused = True
 
-    ann.getBigRefGene(
-        vcf=infile,
-        format="vcf",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(
-        vcf=infile,
-        format="vcf",
-        table="refGene",
-        promoter_offset=500,
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(
-        vcf=infile,
-        format="vcf",
-        table="cytoBand",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    outfile = results
+    if compress:
+        tbi = bgzf.TabixIndex()
+        outfile = bgzf.BgzfWriter(results, index=tbi)
+
+    options = dict(
+        sweep=sweep,
+        index=index,
+        snapshot=snapshot,
+        backend=backend,
+        backend_path=backend_path,
+        batch_size=batch_size,
     )
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(
-        vcf=infile,
-        format="vcf",
-        table="gadAll",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    fused_options = dict(
+        concurrent=concurrent, engine=engine, window=window, cache=cache
     )
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(
-        vcf=infile,
-        format="vcf",
-        table="gwasCatalog",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    if workers > 1:
+        runParallel(
+            infile,
+            outfile,
+            logfile,
+            format,
+            workers=workers,
+            **options,
+            **fused_options,
+        )
+    elif fused:
+        runFused(infile, outfile, logfile, format, **options, **fused_options)
+    else:
+        runChained(infile, outfile, logfile, format, **options)
+
+    if compress:
+        outfile.close()
+        if not tbi.write(results + ".tbi"):
+            print("Results are not sorted by position - no index written")
+
+    # Connection pool metrics for the job log
+    pool = u.getPool()
+    if pool.getStats()["acquired"] > 0:
+        print(pool.summary())
+
+
+"""Names of the files a job writes next to its input (.vcf or .vcf.gz):
+the results (.annot.vcf, or .annot.vcf.gz if compressed) and the count log
+"""
+
+
+def getOutputNames(infile, compress=False):
+    base = getBaseName(infile)
+    results = (base + ".annot").replace(".vcf.annot", ".annot.vcf")
+    if compress:
+        results = results + ".gz"
+    return results, base + ".count.log"
+
+
+def getBaseName(infile):
+    if infile.endswith(".gz"):
+        return infile[: -len(".gz")]
+    return infile
+
+
+"""Moves an annotated temp file to outfile, a path or a binary stream
+"""
+
+
+def moveOutput(path, outfile):
+    if isinstance(outfile, str):
+        os.rename(path, outfile)
+        return
+    with open(path, "rb") as fh:
+        shutil.copyfileobj(fh, outfile)
+    fu.delete(path)
+
+
+def getStageOptions(stage, options, sweep=False, index=False, snapshot=None):
+    options = dict(options, snapshot=snapshot)
+    if issubclass(stage, ann.OverlapStage):
+        options.update(sweep=sweep, index=index)
+    return options
+
+
+def runChained(
+    infile,
+    outfile,
+    logfile,
+    format,
+    sweep=False,
+    index=False,
+    snapshot=None,
+    backend="mysql",
+    backend_path=None,
+    batch_size=ann.BATCH_SIZE,
+):
+    base = getBaseName(infile)
+    for i, (stage, options, label) in enumerate(PIPELINE):
+        tmpin = infile if i == 0 else base + "." + str(i)
+        tmpout = base + "." + str(i + 1)
+        options = getStageOptions(
+            stage, options, sweep=sweep, index=index, snapshot=snapshot
+        )
+
+        store = rs.connect(backend, backend_path)
+        stages = [stage(store, format=format, **options)]
+        ann.runStages(
+            tmpin,
+            tmpout,
+            stages,
+            logcountfile=logfile,
+            logmode="w" if i == 0 else "a",
+            batch_size=batch_size,
+        )
+        store.close()
+        print(f"{label} - done.")
+        printMetrics([stages[0]], [label])
+
+    ## Cleanup
+    last = len(PIPELINE)
+    for i in range(1, last):
+        fu.delete(base + "." + str(i))
+
+    moveOutput(base + "." + str(last), outfile)
+
+
+"""Opens the stores for PIPELINE, one per stage
+Stages that prefetch concurrently get a store of their own, the rest share
+one; the async engine gives every stage its own. Returns the stores and
+the number of threads to prefetch with
+"""
+
+
+def openStores(backend, backend_path, snapshot=None, concurrent=False, engine="batch"):
+    if engine == "async":
+        return [rs.connect(backend, backend_path) for _ in PIPELINE], 0
+
+    shared = rs.connect(backend, backend_path)
+    if not concurrent or backend == "sqlite" or snapshot is not None:
+        return [shared] * len(PIPELINE), 0
+
+    stores = []
+    for stage, _, _ in PIPELINE:
+        if stage.independent:
+            stores.append(rs.connect(backend, backend_path))
+        else:
+            stores.append(shared)
+    return stores, len([s for s in stores if s is not shared])
+
+
+def closeStores(stores):
+    for store in dict([(id(s), s) for s in stores]).values():
+        store.close()
+
+
+"""Prints how many range lookups each stage's window cursors answered
+without going to the index, for the job log
+"""
+
+
+def printMetrics(stages, labels=None):
+    if labels is None:
+        labels = [label for _, _, label in PIPELINE]
+    for stage, label in zip(stages, labels):
+        metrics = stage.getMetrics()
+        total = metrics["cursor_hits"] + metrics["cursor_misses"]
+        if total > 0:
+            ratio = (metrics["cursor_hits"] / float(total)) * 100
+            print(
+                f"{label} window cursor: {metrics['cursor_hits']} of {total} "
+                + f"lookups ({ratio:.1f}%)"
+            )
+
+
+"""Runs the fused stages with the batch or the async engine
+"""
+
+
+def runStages(
+    infile, outfile, stages, engine="batch", window=en.WINDOW, threads=0, **options
+):
+    if engine == "async":
+        en.runStages(infile, outfile, stages, window=window, **options)
+    else:
+        ann.runStages(infile, outfile, stages, threads=threads, **options)
+
+
+def getStages(stores, format, sweep=False, index=False, snapshot=None):
+    stages = []
+    for store, (stage, options, _) in zip(stores, PIPELINE):
+        options = getStageOptions(
+            stage, options, sweep=sweep, index=index, snapshot=snapshot
+        )
+        stages.append(stage(store, format=format, **options))
+    return stages
+
+
+def runFused(
+    infile,
+    outfile,
+    logfile,
+    format,
+    sweep=False,
+    index=False,
+    snapshot=None,
+    backend="mysql",
+    backend_path=None,
+    batch_size=ann.BATCH_SIZE,
+    concurrent=False,
+    engine="batch",
+    window=en.WINDOW,
+    cache=None,
+):
+    stores, threads = openStores(
+        backend,
+        backend_path,
+        snapshot=snapshot,
+        concurrent=concurrent,
+        engine=engine,
     )
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(
-        vcf=infile,
-        format="vcf",
-        table="targetScanS",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    stages = getStages(stores, format, sweep=sweep, index=index, snapshot=snapshot)
+
+    runStages(
+        infile,
+        outfile,
+        stages,
+        engine=engine,
+        window=window,
+        threads=threads,
+        logcountfile=logfile,
+        logmode="w",
+        batch_size=batch_size,
+        cache=cache,
     )
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(
-        vcf=infile,
-        format="vcf",
-        table="hugo",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    closeStores(stores)
+    print(f"{', '.join([label for _, _, label in PIPELINE])} - done.")
+    printMetrics(stages)
+
+
+"""Runs the fused pipeline from a stream of input lines to a writable
+stream (see s3stream.py), writing the counts to logcountfile; the input
+is read once, front to back, so it is never split into workers
+"""
+
+
+def runStream(
+    reader,
+    writer,
+    logcountfile,
+    format,
+    sweep=False,
+    index=False,
+    snapshot=None,
+    backend="mysql",
+    backend_path=None,
+    batch_size=ann.BATCH_SIZE,
+    concurrent=False,
+    engine="batch",
+    window=en.WINDOW,
+    cache=None,
+):
+    print("Running . . .")
+
+    stores, threads = openStores(
+        backend,
+        backend_path,
+        snapshot=snapshot,
+        concurrent=concurrent,
+        engine=engine,
     )
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="dgv_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    stages = getStages(stores, format, sweep=sweep, index=index, snapshot=snapshot)
+
+    runStages(
+        reader,
+        writer,
+        stages,
+        engine=engine,
+        window=window,
+        threads=threads,
+        logcountfile=logcountfile,
+        logmode="w",
+        batch_size=batch_size,
+        cache=cache,
     )
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="abParts_IG_T_CelReceptors",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    closeStores(stores)
+    print(f"{', '.join([label for _, _, label in PIPELINE])} - done.")
+    printMetrics(stages)
+
+    pool = u.getPool()
+    if pool.getStats()["acquired"] > 0:
+        print(pool.summary())
+
+
+"""Splits infile into up to count byte ranges that start on line
+boundaries, roughly equal in size
+"""
+
+
+def getShards(infile, count):
+    size = os.path.getsize(infile)
+    bounds = [0]
+    with open(infile, "rb") as fh:
+        for k in range(1, count):
+            fh.seek(max(bounds[-1], size * k // count))
+            if fh.tell() > 0:
+                fh.readline()
+            if bounds[-1] < fh.tell() < size:
+                bounds.append(fh.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+"""Annotates one byte range of the input in a worker process
+Returns each stage's counts, the variant cache's, each stage's metrics
+and the worker's connection pool stats
+"""
+
+
+def runShard(shard):
+    infile, outfile, start, end, format, options = shard
+
+    snapshot = None
+    if options["snapshot"] is not None:
+        snapshot = sn.Snapshot(*options["snapshot"])
+    cache = options["cache"]
+
+    stores, threads = openStores(
+        options["backend"],
+        options["backend_path"],
+        snapshot=snapshot,
+        concurrent=options["concurrent"],
+        engine=options["engine"],
     )
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="mcCarroll_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    stages = getStages(
+        stores,
+        format,
+        sweep=options["sweep"],
+        index=options["index"],
+        snapshot=snapshot,
     )
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="conrad_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    runStages(
+        infile,
+        outfile,
+        stages,
+        engine=options["engine"],
+        window=options["window"],
+        threads=threads,
+        batch_size=options["batch_size"],
+        start=start,
+        end=end,
+        cache=cache,
     )
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(
-        vcf=infile,
-        format="vcf",
-        table="genomicSuperDups",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    closeStores(stores)
+    cache_counts = None
+    if cache is not None:
+        cache_counts = cache.getCounts()
+        cache.close()
+    return (
+        [stage.getCounts() for stage in stages],
+        cache_counts,
+        [stage.getMetrics() for stage in stages],
+        u.getPool().getStats(),
     )
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(
-        vcf=infile,
-        table="tfbsConsSites",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+
+
+def runParallel(
+    infile,
+    outfile,
+    logfile,
+    format,
+    workers=2,
+    sweep=False,
+    index=False,
+    snapshot=None,
+    backend="mysql",
+    backend_path=None,
+    batch_size=ann.BATCH_SIZE,
+    concurrent=False,
+    engine="batch",
+    window=en.WINDOW,
+    cache=None,
+):
+    # Workers open their own store and snapshot handles; a variant cache is
+    # reopened as it is unpickled
+    options = dict(
+        sweep=sweep,
+        index=index,
+        snapshot=(
+            None if snapshot is None else (snapshot.snapshot_dir, snapshot.version)
+        ),
+        backend=backend,
+        backend_path=backend_path,
+        batch_size=batch_size,
+        concurrent=concurrent,
+        engine=engine,
+        window=window,
+        cache=cache,
     )
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    base = getBaseName(infile)
+    shards = [
+        (infile, base + ".part" + str(k), start, end, format, options)
+        for k, (start, end) in enumerate(getShards(infile, workers))
+    ]
 
-    ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + "." + str(i))
+    # Forked workers start with an empty connection pool of their own
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(shards)),
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=u.resetPool,
+    ) as executor:
+        results = list(executor.map(runShard, shards))
 
-    os.rename(infile + "." + str(tmpextin), infile + ".annot")
-    finalout = (infile + ".annot").replace(".vcf.annot", ".annot.vcf")
-    os.rename(infile + ".annot", finalout)
+    fh_out = open(outfile, "wb") if isinstance(outfile, str) else outfile
+    for shard in shards:
+        moveOutput(shard[1], fh_out)
+    if isinstance(outfile, str):
+        fh_out.close()
+
+    store = rs.connect(backend, backend_path)
+    stages = getStages(
+        [store] * len(PIPELINE), format, sweep=sweep, index=index, snapshot=snapshot
+    )
+    for counts, cache_counts, metrics, stats in results:
+        for stage, stage_counts, stage_metrics in zip(stages, counts, metrics):
+            stage.addCounts(stage_counts)
+            stage.addMetrics(stage_metrics)
+        if cache is not None:
+            cache.addCounts(cache_counts)
+        u.getPool().addStats(stats)
+
+    fh_log = open(logfile, "w")
+    for stage in stages:
+        stage.writeLog(fh_log)
+    if cache is not None:
+        cache.writeLog(fh_log)
+    fh_log.close()
+    store.close()
+    print(
+        f"{', '.join([label for _, _, label in PIPELINE])} - done "
+        + f"({len(shards)} shards)."
+    )
+    printMetrics(stages)
 
 
 ### EOF
@@ -0,0 +1,150 @@
+# engine.py
+# asyncio pipeline that overlaps reading, per-stage lookups and writing
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import annotate as ann
+
+WINDOW = 4
+
+"""Marks the end of the input on a stage queue
+"""
+DONE = None
+
+
+"""Runs stages over the input as a pipeline of asyncio tasks
+
+A reader task splits the input into batches, one task per stage prefetches
+and annotates each batch in turn, and a writer task writes them out. The
+tasks are joined by queues of at most window batches, so each stage has
+up to window batches in flight behind it while its own lookups for the
+batch at hand are on the wire; the blocking store calls run in a thread
+pool, one thread at a time per stage. Every queue is first in, first out,
+so batches are written in input order and each stage sees the records
+exactly as the batch engine (annotate.runStages) would.
+
+Each stage must have a store of its own. The arguments are those of
+annotate.runStages.
+"""
+
+
+async def runPipeline(
+    infile,
+    outfile,
+    stages,
+    sep="\t",
+    batch_size=ann.BATCH_SIZE,
+    start=0,
+    end=None,
+    window=WINDOW,
+    cache=None,
+):
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=len(stages) + 2)
+    queues = [asyncio.Queue(maxsize=window) for _ in range(len(stages) + 1)]
+
+    fh = ann.openInput(infile, start, end)
+    fh_out = ann.openOutput(outfile)
+
+    def readBatch():
+        lines = []
+        for line in fh:
+            lines.append(line.strip())
+            if len(lines) >= batch_size:
+                break
+        if len(lines) == 0:
+            return None
+        batch = ann.Batch(lines, sep=sep)
+        if cache is not None:
+            cache.resolve(batch, stages)
+        return batch
+
+    def runStage(stage, batch, position):
+        stage.prefetch(batch.getRecords(stage))
+        batch.annotate(stage, position=position, last=position == len(stages) - 1)
+        return batch
+
+    def writeBatch(batch):
+        if cache is not None:
+            cache.store(batch, stages)
+        batch.write(fh_out)
+
+    async def read():
+        while True:
+            batch = await loop.run_in_executor(executor, readBatch)
+            if batch is None:
+                break
+            await queues[0].put(batch)
+        await queues[0].put(DONE)
+
+    async def annotate(i, stage):
+        while True:
+            batch = await queues[i].get()
+            if batch is DONE:
+                break
+            batch = await loop.run_in_executor(executor, runStage, stage, batch, i)
+            await queues[i + 1].put(batch)
+        await queues[i + 1].put(DONE)
+
+    async def write():
+        while True:
+            batch = await queues[-1].get()
+            if batch is DONE:
+                break
+            await loop.run_in_executor(executor, writeBatch, batch)
+
+    tasks = [asyncio.create_task(read())]
+    tasks.extend([asyncio.create_task(annotate(i, s)) for i, s in enumerate(stages)])
+    tasks.append(asyncio.create_task(write()))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        executor.shutdown()
+        ann.closeFiles(infile, fh, outfile, fh_out)
+
+
+"""Runs stages over the input file with runPipeline
+Drop-in for annotate.runStages, writing the same output and count log
+"""
+
+
+def runStages(
+    infile,
+    outfile,
+    stages,
+    logcountfile=None,
+    logmode="a",
+    sep="\t",
+    batch_size=ann.BATCH_SIZE,
+    start=0,
+    end=None,
+    window=WINDOW,
+    cache=None,
+):
+    asyncio.run(
+        runPipeline(
+            infile,
+            outfile,
+            stages,
+            sep=sep,
+            batch_size=batch_size,
+            start=start,
+            end=end,
+            window=window,
+            cache=cache,
+        )
+    )
+
+    if logcountfile is not None:
+        fh_log = open(logcountfile, logmode)
+        for stage in stages:
+            stage.writeLog(fh_log)
+        if cache is not None:
+            cache.writeLog(fh_log)
+        fh_log.close()
+
+
+### EOF
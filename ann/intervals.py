@@ -0,0 +1,251 @@
+# intervals.py
+# Array-backed interval index for reference range tables
+
+from bisect import bisect_left
+from collections import deque
+
+import numpy as np
+
+"""Nested containment list over one chromosome's intervals
+
+Intervals are sorted by start (longest first on ties) and every interval
+that is contained in another becomes part of that interval's sublist, so
+within any sublist both starts and ends are increasing. The sublists are
+laid out breadth-first in flat int64 arrays; each entry records where its
+own sublist lives. A query binary searches the first entry of a sublist
+whose end reaches the query start, then walks forward while starts stay
+within the query end, descending into the sublists of the entries it hits.
+
+Use buildIndex() to construct one; the constructor takes an existing
+layout, e.g. arrays memory-mapped from a reference snapshot.
+overlaps() returns the positions of the overlapping intervals in the
+arrays the index was built from, in increasing order.
+"""
+
+
+class IntervalIndex(object):
+    def __init__(self, starts, ends, ids, sub_start, sub_len, root):
+        self.starts = starts
+        self.ends = ends
+        self.ids = ids
+        self.sub_start = sub_start
+        self.sub_len = sub_len
+        self.root = (int(root[0]), int(root[1]))
+
+        # Memoryviews give bisect and the scan loop plain ints without copying
+        self._starts = memoryview(starts)
+        self._ends = memoryview(ends)
+        self._ids = memoryview(ids)
+        self._sub_start = memoryview(sub_start)
+        self._sub_len = memoryview(sub_len)
+        self.bounds = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    """Returns the ids of intervals overlapping the closed span [start, end],
+    or the single position start if end is None
+    """
+
+    def overlaps(self, start, end=None):
+        if end is None:
+            end = start
+
+        starts = self._starts
+        ends = self._ends
+        ids = self._ids
+        sub_start = self._sub_start
+        sub_len = self._sub_len
+        hits = []
+        pending = [self.root]
+
+        while pending:
+            first, length = pending.pop()
+            last = first + length
+            i = bisect_left(ends, start, first, last)
+            while i < last and starts[i] <= end:
+                hits.append(ids[i])
+                if sub_len[i]:
+                    pending.append((sub_start[i], sub_len[i]))
+                i += 1
+
+        if len(hits) > 1:
+            hits.sort()
+        return hits
+
+    """Starts and ends of the intervals, each sorted, for WindowCursor
+    """
+
+    def getBounds(self):
+        if self.bounds is None:
+            self.bounds = (np.sort(self.starts), np.sort(self.ends))
+        return self.bounds
+
+
+"""Lays out the nested containment list for the given intervals
+"""
+
+
+def buildLayout(starts, ends):
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    count = len(starts)
+
+    order = np.lexsort((-ends, starts))
+    sorted_ends = ends[order].tolist()
+
+    # Parent of each interval (in sorted order) is the nearest interval
+    # still open on the stack that contains it
+    children = {}
+    stack = []
+    for k in range(count):
+        while len(stack) > 0 and sorted_ends[stack[-1]] < sorted_ends[k]:
+            stack.pop()
+        children.setdefault(stack[-1] if len(stack) > 0 else -1, []).append(k)
+        stack.append(k)
+
+    # Lay sublists out breadth-first, starting with the top level
+    slots = []
+    sublists = {}
+    queue = deque([-1])
+    while len(queue) > 0:
+        parent = queue.popleft()
+        kids = children.get(parent)
+        if kids is not None:
+            sublists[parent] = (len(slots), len(kids))
+            slots.extend(kids)
+            queue.extend(kids)
+
+    slots = np.asarray(slots, dtype=np.int64)
+    sub_start = np.zeros(count, dtype=np.int64)
+    sub_len = np.zeros(count, dtype=np.int64)
+    for slot, k in enumerate(slots.tolist()):
+        if k in sublists:
+            sub_start[slot], sub_len[slot] = sublists[k]
+
+    return (
+        starts[order][slots],
+        ends[order][slots],
+        order[slots].astype(np.int64),
+        sub_start,
+        sub_len,
+        np.asarray(sublists.get(-1, (0, 0)), dtype=np.int64),
+    )
+
+
+def buildIndex(starts, ends):
+    return IntervalIndex(*buildLayout(starts, ends))
+
+
+"""Interval indexes over a reference table, one per chromosome
+
+Each chromosome is loaded the first time it is asked for and kept for the
+rest of the job, so inputs can arrive in any order. load(chrom) must return
+the column names and every row on the chromosome. Rows are returned in the
+order load() gave them; rows with a NULL bound never match.
+"""
+
+
+class TableIndex(object):
+    def __init__(self, load, start_column="chromStart", end_column="chromEnd"):
+        self.load = load
+        self.start_column = start_column
+        self.end_column = end_column
+        self.indexes = {}
+
+    def build(self, chrom):
+        names, rows = self.load(chrom)
+        start_index = names.index(self.start_column)
+        end_index = names.index(self.end_column)
+
+        valid = [
+            i
+            for i, row in enumerate(rows)
+            if row[start_index] is not None and row[end_index] is not None
+        ]
+        starts = np.fromiter(
+            (rows[i][start_index] for i in valid), dtype=np.int64, count=len(valid)
+        )
+        ends = np.fromiter(
+            (rows[i][end_index] for i in valid), dtype=np.int64, count=len(valid)
+        )
+        self.indexes[chrom] = ([rows[i] for i in valid], buildIndex(starts, ends))
+
+    def overlaps(self, chrom, start, end=None):
+        if chrom not in self.indexes:
+            self.build(chrom)
+        rows, index = self.indexes[chrom]
+        return [rows[i] for i in index.overlaps(start, end)]
+
+    def getBounds(self, chrom):
+        if chrom not in self.indexes:
+            self.build(chrom)
+        return self.indexes[chrom][1].getBounds()
+
+
+"""Remembers the last overlaps looked up on each chromosome and the span
+over which they stay the same
+
+Moving a query [start, end] along a chromosome only changes its overlaps
+when end passes an interval start or start passes an interval end, so
+the overlaps found at one position hold for every shift of the query
+that stays between the neighbouring starts and ends. Each lookup that
+falls inside the span of the previous one on its chromosome (with the
+same query width) is answered from it without touching the index; any
+other lookup, in whatever order, goes to the index and moves the cursor.
+index must provide overlaps(chrom, start, end) and getBounds(chrom), the
+sorted starts and ends of the intervals on the chromosome.
+"""
+
+
+class WindowCursor(object):
+    def __init__(self, index):
+        self.index = index
+        self.cursors = {}
+        self.hits = 0
+        self.misses = 0
+
+    def overlaps(self, chrom, start, end=None):
+        width = 0 if end is None else end - start
+        cursor = self.cursors.get(chrom)
+        if cursor is not None:
+            lo, hi, cursor_width, rows = cursor
+            if cursor_width == width and lo <= start <= hi:
+                self.hits = self.hits + 1
+                return list(rows)
+
+        self.misses = self.misses + 1
+        rows = self.index.overlaps(chrom, start, end)
+        lo, hi = getWindow(*self.index.getBounds(chrom), start, start + width)
+        self.cursors[chrom] = (lo, hi, width, rows)
+        return list(rows)
+
+
+"""Range of query starts over which [start, end] overlaps the same
+intervals, given their sorted starts and ends; unbounded sides are
+infinite
+"""
+
+
+def getWindow(starts, ends, start, end):
+    width = end - start
+    lo = float("-inf")
+    hi = float("inf")
+
+    # Bounded by the last start the query end has passed and the next one,
+    # and by the last end before the query start and the next one
+    k = int(np.searchsorted(starts, end, side="right"))
+    if k > 0:
+        lo = int(starts[k - 1]) - width
+    if k < len(starts):
+        hi = int(starts[k]) - 1 - width
+
+    j = int(np.searchsorted(ends, start, side="left"))
+    if j > 0:
+        lo = max(lo, int(ends[j - 1]) + 1)
+    if j < len(ends):
+        hi = min(hi, int(ends[j]))
+    return lo, hi
+
+
+### EOF
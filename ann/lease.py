@@ -0,0 +1,214 @@
+# lease.py
+# Leases on the job requests an annotator instance is running
+#
+# NOTE: This file lives on the AnnTools instance
+
+import os
+import time
+import socket
+import threading
+
+import boto3
+from botocore.client import Config
+from botocore.exceptions import ClientError
+
+# Seconds a job request stays hidden from other instances per heartbeat
+VISIBILITY = 300
+
+# Seconds between heartbeats; well inside VISIBILITY, so a missed beat or
+# two does not let the lease lapse
+HEARTBEAT = 60
+
+"""Names this process as the owner of the jobs it claims
+"""
+
+
+def getOwner():
+    return f"{socket.gethostname()}/{os.getpid()}"
+
+
+"""Leases on job requests, held from the moment a job is claimed until
+it is done
+
+claim() marks a job RUNNING in DynamoDB under this owner, with the time
+its lease expires, if the job is PENDING or its last owner let the lease
+expire. While the job runs, a heartbeat thread keeps the request message
+hidden on the queue and moves the lease expiry on, so a job that runs
+longer than the queue's visibility timeout is not picked up and run
+again by another instance. complete() deletes the message once the job
+has finished; release() hands a job that could not be started back to
+the queue, PENDING again.
+
+The clients come from a session of their own, not boto3's default one,
+so the heartbeat thread does not share client state with the threads
+handling requests. The heartbeat thread is why the worker pool must
+never fork this process (see workers.py).
+"""
+
+
+class LeaseManager(object):
+    def __init__(
+        self,
+        queue_url,
+        table_name,
+        region_name,
+        signature_version,
+        visibility=VISIBILITY,
+        heartbeat=HEARTBEAT,
+        owner=None,
+    ):
+        session = boto3.session.Session()
+        config = Config(signature_version=signature_version)
+        self.sqs = session.client("sqs", region_name=region_name, config=config)
+        self.dynamodb = session.client(
+            "dynamodb", region_name=region_name, config=config
+        )
+        self.queue_url = queue_url
+        self.table_name = table_name
+        self.visibility = visibility
+        self.heartbeat = heartbeat
+        self.owner = getOwner() if owner is None else owner
+
+        # Receipt handles of the messages of the jobs held, by job
+        self.leases = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.beat, daemon=True)
+        self.thread.start()
+
+    """Claims a job for this owner; returns True if it is ours to run
+    A request for a job that is no longer PENDING or RUNNING is deleted,
+    one held by a live lease elsewhere is left to reappear
+    """
+
+    def claim(self, job_id, receipt):
+        now = int(time.time())
+        try:
+            # Update table: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key={"job_id": {"S": job_id}},
+                ExpressionAttributeValues={
+                    ":RUNNING": {"S": "RUNNING"},
+                    ":PENDING": {"S": "PENDING"},
+                    ":owner": {"S": self.owner},
+                    ":expires": {"N": str(now + self.visibility)},
+                    ":now": {"N": str(now)},
+                },
+                UpdateExpression="SET job_status = :RUNNING, job_owner = :owner, "
+                + "lease_expires = :expires",
+                ConditionExpression="job_status = :PENDING OR "
+                + "(job_status = :RUNNING AND lease_expires < :now)",
+                ReturnValuesOnConditionCheckFailure="ALL_OLD",
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            item = e.response.get("Item", {})
+            status = item.get("job_status", {}).get("S")
+            owner = item.get("job_owner", {}).get("S")
+            with self.lock:
+                if owner == self.owner and job_id in self.leases:
+                    # Our own lease, on a message seen again
+                    self.leases[job_id] = receipt
+                    return False
+            if status is not None and status not in ("PENDING", "RUNNING"):
+                self.deleteMessage(receipt)
+            return False
+
+        with self.lock:
+            self.leases[job_id] = receipt
+        self.extend(job_id, receipt)
+        return True
+
+    def complete(self, job_id):
+        with self.lock:
+            receipt = self.leases.pop(job_id, None)
+        if receipt is not None:
+            self.deleteMessage(receipt)
+
+    def release(self, job_id):
+        with self.lock:
+            receipt = self.leases.pop(job_id, None)
+        if receipt is None:
+            return
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key={"job_id": {"S": job_id}},
+                ExpressionAttributeValues={
+                    ":RUNNING": {"S": "RUNNING"},
+                    ":PENDING": {"S": "PENDING"},
+                    ":owner": {"S": self.owner},
+                },
+                UpdateExpression="SET job_status = :PENDING "
+                + "REMOVE job_owner, lease_expires",
+                ConditionExpression="job_status = :RUNNING AND job_owner = :owner",
+            )
+        except ClientError as e:
+            print(f"error: failed to release job {job_id} - {e}")
+        try:
+            # Make the message visible again: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/change_message_visibility.html
+            self.sqs.change_message_visibility(
+                QueueUrl=self.queue_url, ReceiptHandle=receipt, VisibilityTimeout=0
+            )
+        except ClientError as e:
+            print(f"error: failed to release message of job {job_id} - {e}")
+
+    """Keeps the message of a job hidden, and its lease current, for
+    another visibility timeout
+    """
+
+    def extend(self, job_id, receipt):
+        try:
+            self.sqs.change_message_visibility(
+                QueueUrl=self.queue_url,
+                ReceiptHandle=receipt,
+                VisibilityTimeout=self.visibility,
+            )
+        except ClientError as e:
+            print(f"error: failed to extend message of job {job_id} - {e}")
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key={"job_id": {"S": job_id}},
+                ExpressionAttributeValues={
+                    ":RUNNING": {"S": "RUNNING"},
+                    ":owner": {"S": self.owner},
+                    ":expires": {"N": str(int(time.time()) + self.visibility)},
+                },
+                UpdateExpression="SET lease_expires = :expires",
+                ConditionExpression="job_status = :RUNNING AND job_owner = :owner",
+            )
+        except ClientError as e:
+            # A job that has just completed is no longer RUNNING
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                print(f"error: failed to extend lease of job {job_id} - {e}")
+
+    def beat(self):
+        while not self.stopped.wait(self.heartbeat):
+            with self.lock:
+                leases = list(self.leases.items())
+            for job_id, receipt in leases:
+                self.extend(job_id, receipt)
+
+    def deleteMessage(self, receipt):
+        try:
+            # SQS delete message: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/delete_message.html
+            self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+        except ClientError as e:
+            print(f"Failed to delete message: {e}")
+
+    """Stops the heartbeat and hands the jobs still held back to the queue
+    """
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        with self.lock:
+            jobs = list(self.leases)
+        for job_id in jobs:
+            self.release(job_id)
+
+
+### EOF
@@ -0,0 +1,392 @@
+# panel.py
+# Precomputed annotations of the common dbSNP variants, built into a
+# reference snapshot and consulted before any live lookup
+#
+# Build:  python panel.py <snapshot_dir> [min_gmaf] [workers]
+
+import sys
+import os
+import json
+import heapq
+import shutil
+import multiprocessing
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import utils as u
+import annotate as ann
+import driver
+import dbsnp
+import snapshot as sn
+import varcache as vc
+
+FORMAT = 1
+
+# Variants with a global minor allele frequency of at least this are common
+MIN_GMAF = 0.001
+
+# Variants annotated per part; parts are the unit of parallelism and resume
+PART_SIZE = 50000
+
+"""INFO columns each variant is annotated under: the stages add to an
+empty (".") INFO differently than to one that holds something already,
+so the panel keeps a delta for both (see varcache.getKey)
+"""
+SHAPES = [".", "PANEL"]
+
+"""Common variants as (chrom, pos, ref, alt), one per alternate allele,
+streamed from dbSNP in table order
+"""
+
+
+def getVariants(conn, min_gmaf=MIN_GMAF):
+    cursor = dbsnp.getStreamingCursor(conn)
+    cursor.execute("select CHR, POS, REF, ALT, GMAF from dbSNP;")
+    while True:
+        rows = cursor.fetchmany(dbsnp.FETCH_SIZE)
+        if len(rows) == 0:
+            break
+        for chrom, pos, ref, alt, gmaf in rows:
+            if chrom is None or pos is None or ref is None or alt is None:
+                continue
+            try:
+                if float(gmaf) < min_gmaf:
+                    continue
+            except (TypeError, ValueError):
+                continue
+            for allele in str(alt).split(","):
+                yield (str(chrom).strip(), int(pos), str(ref).strip(), allele.strip())
+    cursor.close()
+
+
+"""Writes the common variants into path as VCF parts of PART_SIZE
+variants, then a DONE marker; a selection cut short is started over
+"""
+
+
+def writeParts(path, min_gmaf=MIN_GMAF):
+    if os.path.exists(os.path.join(path, "DONE")):
+        return sorted([f for f in os.listdir(path) if f.endswith(".vcf")])
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    parts = []
+    conn = u.db_connect()
+    variants = []
+    for variant in getVariants(conn, min_gmaf=min_gmaf):
+        variants.append(variant)
+        if len(variants) == PART_SIZE:
+            parts.append(writePart(path, len(parts), variants))
+            variants = []
+    if len(variants) > 0:
+        parts.append(writePart(path, len(parts), variants))
+    conn.close()
+
+    open(os.path.join(path, "DONE"), "w").close()
+    return parts
+
+
+def writePart(path, number, variants):
+    name = f"{number:06d}.vcf"
+    with open(os.path.join(path, name), "w") as fh:
+        for chrom, pos, ref, alt in dict.fromkeys(variants):
+            for info in SHAPES:
+                fh.write(f"{chrom}\t{pos}\t.\t{ref}\t{alt}\t.\t.\t{info}\n")
+    return name
+
+
+"""Collects the delta of every record a part runs through the stages;
+takes the place of the variant cache in annotate.runStages
+"""
+
+
+class PartCollector(object):
+    def __init__(self):
+        self.deltas = {}
+
+    def resolve(self, batch, stages):
+        vc.fillBatch(batch, vc.getKeys(batch, stages), {})
+
+    def store(self, batch, stages):
+        self.deltas.update(vc.getDeltas(batch, stages))
+
+
+"""Annotates one part in a worker process, writing its deltas sorted by
+key as "key<TAB>delta" lines (the tab sorts before any character of a
+key, so the lines sort as their keys); the output appears only once
+complete
+"""
+
+
+def annotatePart(part):
+    infile, outfile, snapshot_dir, version, options = part
+    reference = sn.Snapshot(snapshot_dir, version)
+
+    stores, _ = driver.openStores(
+        options["backend"], options["backend_path"], snapshot=reference
+    )
+    stages = driver.getStages(stores, "vcf", index=True, snapshot=reference)
+    collector = PartCollector()
+    ann.runStages(
+        infile,
+        os.devnull,
+        stages,
+        batch_size=options["batch_size"],
+        cache=collector,
+    )
+    driver.closeStores(stores)
+
+    with open(outfile + ".tmp", "w") as fh:
+        for key in sorted(collector.deltas):
+            delta = json.dumps(collector.deltas[key], separators=(",", ":"))
+            fh.write(key + "\t" + delta + "\n")
+    os.replace(outfile + ".tmp", outfile)
+    return len(collector.deltas)
+
+
+"""Strings written one after another to a heap, with an offsets array
+"""
+
+
+class HeapWriter(object):
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.fh = open(os.path.join(path, name + ".heap"), "wb")
+        self.offsets = array("q", [0])
+
+    def write(self, value):
+        self.fh.write(value.encode("utf-8"))
+        self.offsets.append(self.fh.tell())
+
+    def close(self):
+        self.fh.close()
+        offsets = np.frombuffer(self.offsets, dtype=np.int64)
+        dtype = np.uint32 if offsets[-1] < 2**32 else np.uint64
+        np.save(
+            os.path.join(self.path, self.name + ".offsets.npy"), offsets.astype(dtype)
+        )
+
+
+"""Merges the sorted part outputs into the key and delta heaps; a key
+annotated by more than one part is kept once
+"""
+
+
+def mergeParts(path, outputs):
+    keys = HeapWriter(path, "keys")
+    values = HeapWriter(path, "values")
+    files = [open(output) for output in outputs]
+    last = None
+    for line in heapq.merge(*files):
+        key, delta = line.rstrip("\n").rsplit("\t", 1)
+        if key == last:
+            continue
+        keys.write(key)
+        values.write(delta)
+        last = key
+    for fh in files:
+        fh.close()
+    keys.close()
+    values.close()
+    return len(keys.offsets) - 1
+
+
+def readJson(path):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+"""Builds the panel of the snapshot at snapshot_dir (the version named in
+CURRENT, unless given) into <version>/panel, so it is only ever used with
+the reference it was annotated against
+
+Variants are selected and split into parts first, then the parts are
+annotated by the fused pipeline in up to workers processes, reading the
+snapshot and, for anything else, the backend store. Everything is written
+under panel.building, so a build that stops is resumed by running it
+again: finished parts are kept and only the rest are annotated.
+"""
+
+
+def build(
+    snapshot_dir,
+    version=None,
+    min_gmaf=MIN_GMAF,
+    workers=1,
+    backend="mysql",
+    backend_path=None,
+    batch_size=ann.BATCH_SIZE,
+):
+    reference = sn.Snapshot(snapshot_dir, version)
+    path = os.path.join(reference.path, "panel")
+    if os.path.exists(path):
+        raise FileExistsError(f"Panel {path} already exists")
+
+    # A build with other settings cannot be resumed
+    building = path + ".building"
+    settings = {"format": FORMAT, "version": reference.version, "min_gmaf": min_gmaf}
+    settings_file = os.path.join(building, "settings.json")
+    if os.path.exists(building):
+        if not os.path.exists(settings_file) or readJson(settings_file) != settings:
+            shutil.rmtree(building)
+    if not os.path.exists(building):
+        os.makedirs(building)
+        with open(settings_file, "w") as fh:
+            json.dump(settings, fh)
+
+    variants_dir = os.path.join(building, "variants")
+    parts = writeParts(variants_dir, min_gmaf=min_gmaf)
+    print(f"{len(parts)} parts of up to {PART_SIZE} variants")
+
+    deltas_dir = os.path.join(building, "deltas")
+    os.makedirs(deltas_dir, exist_ok=True)
+    options = dict(backend=backend, backend_path=backend_path, batch_size=batch_size)
+    todo = []
+    outputs = []
+    for name in parts:
+        output = os.path.join(deltas_dir, name[: -len(".vcf")] + ".tsv")
+        outputs.append(output)
+        if not os.path.exists(output):
+            todo.append(
+                (
+                    os.path.join(variants_dir, name),
+                    output,
+                    snapshot_dir,
+                    reference.version,
+                    options,
+                )
+            )
+    print(f"{len(parts) - len(todo)} parts already annotated")
+
+    if len(todo) > 0:
+        with ProcessPoolExecutor(
+            max_workers=max(1, min(workers, len(todo))),
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=u.resetPool,
+        ) as executor:
+            for k, _ in enumerate(executor.map(annotatePart, todo)):
+                print(f"Part {k + 1} of {len(todo)} - done.")
+
+    entries = mergeParts(building, outputs)
+    shutil.rmtree(variants_dir)
+    shutil.rmtree(deltas_dir)
+    os.remove(settings_file)
+
+    manifest = dict(settings, entries=entries, shapes=SHAPES)
+    with open(os.path.join(building, "manifest.json"), "w") as fh:
+        json.dump(manifest, fh, indent=1)
+    os.rename(building, path)
+    return entries
+
+
+"""Read-only view of a panel, with the interface of varcache.VariantCache
+Keys and deltas are memory-mapped heaps, sorted by key, so the processes
+on an instance share them and a lookup is a binary search. resolve()
+fills in the records of a batch the panel holds; store() keeps nothing,
+the panel is only written by build().
+"""
+
+
+class Panel(object):
+    def __init__(self, path):
+        self.path = path
+        self.manifest = readJson(os.path.join(path, "manifest.json"))
+        if self.manifest["format"] != FORMAT:
+            raise ValueError(
+                f"Panel {path} has format {self.manifest['format']}, "
+                + f"expected {FORMAT}"
+            )
+        self.version = self.manifest["version"]
+        self.keys = dbsnp.Heap(path, "keys")
+        self.values = dbsnp.Heap(path, "values")
+        self.count = self.manifest["entries"]
+        self.hits = 0
+        self.misses = 0
+
+    # Shards reopen the panel in their own process
+    def __reduce__(self):
+        return (Panel, (self.path,))
+
+    def __len__(self):
+        return self.count
+
+    # Keys as bisect sees them
+    def __getitem__(self, i):
+        return self.keys.get(i)
+
+    def get(self, key):
+        i = bisect_left(self, key)
+        if i < self.count and self.keys.get(i) == key:
+            return json.loads(self.values.get(i))
+        return None
+
+    def resolve(self, batch, stages):
+        keys = vc.getKeys(batch, stages)
+        found = {}
+        for key in keys:
+            delta = self.get(key)
+            if delta is not None:
+                found[key] = delta
+        hits, misses = vc.fillBatch(batch, keys, found)
+        self.hits = self.hits + hits
+        self.misses = self.misses + misses
+
+    def store(self, batch, stages):
+        pass
+
+    def getCounts(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def addCounts(self, counts):
+        self.hits = self.hits + counts["hits"]
+        self.misses = self.misses + counts["misses"]
+
+    def resetCounts(self):
+        self.hits = 0
+        self.misses = 0
+
+    def writeLog(self, fh_log):
+        total = self.hits + self.misses
+        ratio = (self.hits / float(total)) * 100 if total > 0 else 0.0
+        fh_log.write(
+            f"Variant panel: {str(self.hits)} hits, {str(self.misses)} misses "
+            + f"({str(ratio)}% hit rate)\n"
+        )
+
+    def close(self):
+        pass
+
+
+"""Opens the panel built into a snapshot, or returns None if it has none
+"""
+
+
+def openPanel(reference):
+    path = os.path.join(reference.path, "panel")
+    if not os.path.exists(os.path.join(path, "manifest.json")):
+        return None
+    return Panel(path)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python panel.py <snapshot_dir> [min_gmaf] [workers]")
+        sys.exit(1)
+
+    entries = build(
+        sys.argv[1],
+        min_gmaf=float(sys.argv[2]) if len(sys.argv) > 2 else MIN_GMAF,
+        workers=int(sys.argv[3]) if len(sys.argv) > 3 else 1,
+    )
+    print(f"Panel of {entries} annotations written to {sys.argv[1]}")
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
@@ -0,0 +1,624 @@
+# reference.py
+# Reference table lookups for the annotation stages
+#
+# Build a SQLite store:  python reference.py <sqlite_path>
+
+import sys
+import os
+import sqlite3
+
+import utils as u
+import intervals as iv
+import snapshot as sn
+
+BATCH_SIZE = 500
+
+"""Lookups the annotation stages make against the reference tables
+
+Every lookup takes a batch of queries and returns one list of rows per
+query, each in the order the table returns them:
+    overlaps(table, chrom, positions)   rows with start <= pos <= end
+    spans(table, chrom, ranges)         rows overlapping [lo, hi]
+    exact(table, keys, key_columns)     rows whose key columns equal key
+    transcripts(chrom, pos_range)       refGene rows overlapping the range
+    rows(table, chrom)                  every row on the chromosome
+chrom=None means the table has no chromosome column to filter on, as with
+the per-chromosome tfbsConsSites tables. columns picks which columns each
+row holds, in order; None means all of them.
+"""
+
+
+class ReferenceStore(object):
+    def columns(self, table):
+        raise NotImplementedError
+
+    def spans(
+        self,
+        table,
+        chrom,
+        ranges,
+        start_column="chromStart",
+        end_column="chromEnd",
+        chrom_column="chrom",
+        columns=None,
+    ):
+        raise NotImplementedError
+
+    def exact(self, table, keys, key_columns, columns=None):
+        raise NotImplementedError
+
+    def rows(self, table, chrom, chrom_column="chrom", columns=None):
+        raise NotImplementedError
+
+    def overlaps(
+        self,
+        table,
+        chrom,
+        positions,
+        start_column="chromStart",
+        end_column="chromEnd",
+        chrom_column="chrom",
+        columns=None,
+    ):
+        return self.spans(
+            table,
+            chrom,
+            [(pos, pos) for pos in positions],
+            start_column=start_column,
+            end_column=end_column,
+            chrom_column=chrom_column,
+            columns=columns,
+        )
+
+    def transcripts(self, chrom, pos_range, table="refGene"):
+        return self.spans(
+            table, chrom, [pos_range], start_column="txStart", end_column="txEnd"
+        )[0]
+
+    def getColumnNames(self, table, columns=None):
+        if columns is None:
+            return self.columns(table)
+        return list(columns)
+
+    def close(self):
+        pass
+
+
+"""Normalizes key values the way MySQL compares them: case-insensitive,
+ignoring trailing spaces
+"""
+
+
+def getKey(values):
+    return tuple([str(v).upper().rstrip() for v in values])
+
+
+def quote(value):
+    if isinstance(value, int):
+        return str(value)
+    return '"' + str(value) + '"'
+
+
+"""Reference tables in RDS, read over pymysql
+A batch becomes a single statement: overlap lookups are sent as a UNION ALL
+of per-query selects tagged with the query number, exact lookups as one
+IN list over the key columns. Without a connection of its own the store
+borrows one from the process pool (utils.getPool()) on its first query, so
+a store that is never queried (e.g. behind a snapshot) never contacts
+RDS, and returns it on close
+"""
+
+
+class MySQLStore(ReferenceStore):
+    def __init__(self, conn=None):
+        self.pooled = conn is None
+        self.conn = conn
+        self.cursor = None
+        self.names = {}
+
+    def getCursor(self):
+        if self.cursor is None:
+            if self.conn is None:
+                self.conn = u.getPool().acquire()
+            self.cursor = self.conn.cursor()
+        return self.cursor
+
+    def close(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+        if self.conn is None:
+            return
+        if self.pooled:
+            u.getPool().release(self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+    def query(self, sql):
+        cursor = self.getCursor()
+        cursor.execute(sql)
+        return cursor.fetchall()
+
+    def columns(self, table):
+        if table not in self.names:
+            cursor = self.getCursor()
+            cursor.execute("select * from " + table + " limit 0;")
+            self.names[table] = [str(d[0]) for d in cursor.description]
+            cursor.fetchall()
+        return self.names[table]
+
+    def getSelectList(self, table, columns):
+        if columns is None:
+            return table + ".*"
+        return ", ".join(columns)
+
+    def spans(
+        self,
+        table,
+        chrom,
+        ranges,
+        start_column="chromStart",
+        end_column="chromEnd",
+        chrom_column="chrom",
+        columns=None,
+    ):
+        results = [[] for _ in ranges]
+        select = self.getSelectList(table, columns)
+
+        for first in range(0, len(ranges), BATCH_SIZE):
+            selects = []
+            for q in range(first, min(first + BATCH_SIZE, len(ranges))):
+                lo, hi = ranges[q]
+                where = []
+                if chrom is not None:
+                    where.append(chrom_column + "=" + quote(chrom))
+                where.append(
+                    "("
+                    + start_column
+                    + " <= "
+                    + str(hi)
+                    + " AND "
+                    + str(lo)
+                    + " <= "
+                    + end_column
+                    + ")"
+                )
+                selects.append(
+                    "select "
+                    + str(q)
+                    + " as q, "
+                    + select
+                    + " from "
+                    + table
+                    + " where "
+                    + " AND ".join(where)
+                )
+
+            for row in self.query(" union all ".join(selects) + ";"):
+                results[row[0]].append(tuple(row[1:]))
+
+        return results
+
+    def exact(self, table, keys, key_columns, columns=None):
+        results = [[] for _ in keys]
+        select = self.getSelectList(table, columns)
+        width = len(key_columns)
+
+        for first in range(0, len(keys), BATCH_SIZE):
+            slots = {}
+            for q in range(first, min(first + BATCH_SIZE, len(keys))):
+                slots.setdefault(getKey(keys[q]), []).append(q)
+
+            values = [
+                "(" + ", ".join([quote(v) for v in keys[q[0]]]) + ")"
+                for q in slots.values()
+            ]
+            sql = (
+                "select "
+                + ", ".join(key_columns)
+                + ", "
+                + select
+                + " from "
+                + table
+                + " where ("
+                + ", ".join(key_columns)
+                + ") in ("
+                + ", ".join(values)
+                + ");"
+            )
+
+            for row in self.query(sql):
+                for q in slots.get(getKey(row[:width]), []):
+                    results[q].append(tuple(row[width:]))
+
+        return results
+
+    def rows(self, table, chrom, chrom_column="chrom", columns=None):
+        sql = "select " + self.getSelectList(table, columns) + " from " + table
+        if chrom is not None:
+            sql = sql + " where " + chrom_column + "=" + quote(chrom)
+        return [tuple(row) for row in self.query(sql + ";")]
+
+
+"""Reference tables exported to a local SQLite database (see buildSQLite)
+Range lookups go through integer R*Tree tables keyed on (chromosome,
+start, end); exact lookups and whole-chromosome reads use ordinary indexes.
+Rows keep the order they were exported in.
+"""
+
+
+class SQLiteStore(ReferenceStore):
+    def __init__(self, path):
+        # Stages may read from a pool thread; each store is used by one
+        # thread at a time
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.names = {}
+        self.chroms = dict(self.conn.execute("select name, id from _chroms;"))
+        self.rtrees = {}
+        for table, chrom_column, start, end, name in self.conn.execute(
+            "select tbl, chrom_column, start_column, end_column, name from _rtrees;"
+        ):
+            self.rtrees[(table, start, end)] = (chrom_column, name)
+
+    def close(self):
+        self.conn.close()
+
+    def columns(self, table):
+        if table not in self.names:
+            cursor = self.conn.execute("select * from " + getName(table) + " limit 0;")
+            self.names[table] = [str(d[0]) for d in cursor.description]
+        return self.names[table]
+
+    def getSelectList(self, columns, alias="t"):
+        if columns is None:
+            return alias + ".*"
+        return ", ".join([alias + "." + getName(c) for c in columns])
+
+    def spans(
+        self,
+        table,
+        chrom,
+        ranges,
+        start_column="chromStart",
+        end_column="chromEnd",
+        chrom_column="chrom",
+        columns=None,
+    ):
+        select = self.getSelectList(columns)
+        rtree_column, rtree = self.rtrees.get(
+            (table, start_column, end_column), (None, None)
+        )
+        if chrom is not None and rtree_column != chrom_column:
+            rtree = None
+
+        if rtree is not None:
+            if chrom is not None and chrom not in self.chroms:
+                return [[] for _ in ranges]
+            lo_id = self.chroms.get(chrom, -(2**31))
+            hi_id = self.chroms.get(chrom, 2**31 - 1)
+            sql = (
+                "select "
+                + select
+                + " from "
+                + getName(table)
+                + " t join "
+                + getName(rtree)
+                + " r on t.rowid = r.id"
+                + " where r.chrom_lo <= ? and r.chrom_hi >= ?"
+                + " and r.pos_start <= ? and r.pos_end >= ? order by t.rowid;"
+            )
+            return [
+                self.conn.execute(sql, (hi_id, lo_id, hi, lo)).fetchall()
+                for lo, hi in ranges
+            ]
+
+        where = getName(start_column) + " <= ? and ? <= " + getName(end_column)
+        if chrom is not None:
+            where = getName(chrom_column) + " = ? and " + where
+        sql = (
+            "select "
+            + select
+            + " from "
+            + getName(table)
+            + " t where "
+            + where
+            + " order by t.rowid;"
+        )
+        prefix = (chrom,) if chrom is not None else ()
+        return [
+            self.conn.execute(sql, prefix + (hi, lo)).fetchall() for lo, hi in ranges
+        ]
+
+    def exact(self, table, keys, key_columns, columns=None):
+        results = [[] for _ in keys]
+        width = len(key_columns)
+        names = ", ".join(["t." + getName(c) for c in key_columns])
+
+        for first in range(0, len(keys), BATCH_SIZE):
+            slots = {}
+            for q in range(first, min(first + BATCH_SIZE, len(keys))):
+                slots.setdefault(getKey(keys[q]), []).append(q)
+
+            batch = [keys[q[0]] for q in slots.values()]
+            row_value = "(" + ", ".join(["?"] * width) + ")"
+            sql = (
+                "select "
+                + names
+                + ", "
+                + self.getSelectList(columns)
+                + " from "
+                + getName(table)
+                + " t where ("
+                + names
+                + ") in (values "
+                + ", ".join([row_value] * len(batch))
+                + ") order by t.rowid;"
+            )
+            params = [v for key in batch for v in key]
+
+            for row in self.conn.execute(sql, params):
+                for q in slots.get(getKey(row[:width]), []):
+                    results[q].append(tuple(row[width:]))
+
+        return results
+
+    def rows(self, table, chrom, chrom_column="chrom", columns=None):
+        sql = "select " + self.getSelectList(columns) + " from " + getName(table) + " t"
+        if chrom is None:
+            return self.conn.execute(sql + " order by t.rowid;").fetchall()
+        sql = sql + " where " + getName(chrom_column) + " = ? order by t.rowid;"
+        return self.conn.execute(sql, (chrom,)).fetchall()
+
+
+def getName(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+"""Reference tables cached in process, one chromosome at a time
+Each (table, chromosome) is read from the source store once and kept;
+range lookups go through interval indexes and exact lookups through hash
+maps built on first use. exact() keys must start with the chromosome
+column, which is how the whole chromosome is picked to load.
+"""
+
+
+class MemoryStore(ReferenceStore):
+    def __init__(self, source):
+        self.source = source
+        self.loaded = {}
+        self.indexes = {}
+        self.lookups = {}
+
+    def close(self):
+        self.source.close()
+
+    def columns(self, table):
+        return self.source.columns(table)
+
+    def project(self, table, rows, columns):
+        if columns is None:
+            return rows
+        names = self.columns(table)
+        picks = [names.index(c) for c in columns]
+        return [tuple([row[i] for i in picks]) for row in rows]
+
+    def getRows(self, table, chrom, chrom_column):
+        key = (table, chrom, chrom_column)
+        if key not in self.loaded:
+            self.loaded[key] = self.source.rows(table, chrom, chrom_column=chrom_column)
+        return self.loaded[key]
+
+    def rows(self, table, chrom, chrom_column="chrom", columns=None):
+        return self.project(table, self.getRows(table, chrom, chrom_column), columns)
+
+    def spans(
+        self,
+        table,
+        chrom,
+        ranges,
+        start_column="chromStart",
+        end_column="chromEnd",
+        chrom_column="chrom",
+        columns=None,
+    ):
+        key = (table, chrom_column, start_column, end_column)
+        if key not in self.indexes:
+            self.indexes[key] = iv.TableIndex(
+                lambda c: (self.columns(table), self.getRows(table, c, chrom_column)),
+                start_column=start_column,
+                end_column=end_column,
+            )
+        index = self.indexes[key]
+        return [
+            self.project(table, index.overlaps(chrom, lo, hi), columns)
+            for lo, hi in ranges
+        ]
+
+    def exact(self, table, keys, key_columns, columns=None):
+        names = self.columns(table)
+        picks = [names.index(c) for c in key_columns]
+        results = []
+
+        for key in keys:
+            lookup_key = (table, tuple(key_columns), key[0])
+            if lookup_key not in self.lookups:
+                lookup = {}
+                for row in self.getRows(table, key[0], key_columns[0]):
+                    lookup.setdefault(getKey([row[i] for i in picks]), []).append(row)
+                self.lookups[lookup_key] = lookup
+            rows = self.lookups[lookup_key].get(getKey(key), [])
+            results.append(self.project(table, rows, columns))
+
+        return results
+
+
+"""Opens a store for the configured backend
+    mysql   RDS over pymysql
+    sqlite  local SQLite database at path
+    memory  RDS, cached in process per chromosome
+"""
+
+
+def connect(backend="mysql", path=None):
+    if backend == "mysql":
+        return MySQLStore()
+    if backend == "sqlite":
+        return SQLiteStore(path)
+    if backend == "memory":
+        return MemoryStore(MySQLStore())
+    raise ValueError(f"Unknown reference backend: {backend}")
+
+
+"""Tables exported to a SQLite store: (name, query, chromosome column,
+range indexes, key indexes). These are the snapshot tables, with
+tfbsConsSites kept as one table per chromosome, plus dbSNP
+"""
+
+
+def getExports():
+    exports = [
+        (name, sql, chrom_column, indexes, [(chrom_column, indexes[0][0])])
+        for name, sql, chrom_column, indexes in sn.TABLES
+    ]
+    for c in sn.TFBS_CHROMS:
+        exports.append(
+            (
+                "tfbsConsSites" + c,
+                sn.getTfbsSql(c),
+                "chrom",
+                sn.TFBS_INDEXES,
+                [("chromStart",)],
+            )
+        )
+    exports.append(("dbSNP", "select * from dbSNP;", "CHR", [], [("CHR", "POS")]))
+    return exports
+
+
+def getValue(value):
+    if value is None or isinstance(value, (int, float, str, bytes)):
+        return value
+    if isinstance(value, bytearray):
+        return bytes(value)
+    # Decimals and dates are only ever printed, so their text form is kept
+    return str(value)
+
+
+def exportTable(cursor, conn, name, sql, chrom_column, indexes, keys):
+    cursor.execute(sql)
+    columns = [str(d[0]) for d in cursor.description]
+    conn.execute(
+        "create table "
+        + getName(name)
+        + " ("
+        + ", ".join([getName(c) for c in columns])
+        + ");"
+    )
+
+    insert = (
+        "insert into "
+        + getName(name)
+        + " values ("
+        + ", ".join(["?"] * len(columns))
+        + ");"
+    )
+    while True:
+        rows = cursor.fetchmany(10000)
+        if len(rows) == 0:
+            break
+        conn.executemany(insert, [[getValue(v) for v in row] for row in rows])
+
+    for k, key in enumerate(keys):
+        conn.execute(
+            "create index "
+            + getName(name + "__key" + str(k))
+            + " on "
+            + getName(name)
+            + " ("
+            + ", ".join([getName(c) for c in key])
+            + ");"
+        )
+
+    conn.execute(
+        "insert or ignore into _chroms(name) select distinct "
+        + getName(chrom_column)
+        + " from "
+        + getName(name)
+        + " where "
+        + getName(chrom_column)
+        + " is not null;"
+    )
+
+    for start_column, end_column in indexes:
+        rtree = name + "__rtree__" + start_column + "__" + end_column
+        conn.execute(
+            "create virtual table "
+            + getName(rtree)
+            + " using rtree_i32(id, chrom_lo, chrom_hi, pos_start, pos_end);"
+        )
+        conn.execute(
+            "insert into "
+            + getName(rtree)
+            + " select t.rowid, c.id, c.id, t."
+            + getName(start_column)
+            + ", t."
+            + getName(end_column)
+            + " from "
+            + getName(name)
+            + " t join _chroms c on c.name = t."
+            + getName(chrom_column)
+            + " where t."
+            + getName(start_column)
+            + " <= t."
+            + getName(end_column)
+            + ";"
+        )
+        conn.execute(
+            "insert into _rtrees values (?, ?, ?, ?, ?);",
+            (name, chrom_column, start_column, end_column, rtree),
+        )
+
+
+"""Exports the reference tables from RDS into a new SQLite database
+"""
+
+
+def buildSQLite(path):
+    if os.path.exists(path):
+        raise FileExistsError(f"{path} already exists")
+
+    building = path + ".building"
+    if os.path.exists(building):
+        os.remove(building)
+
+    source = u.db_connect()
+    cursor = source.cursor()
+    conn = sqlite3.connect(building)
+    conn.execute("create table _chroms (id integer primary key, name text unique);")
+    conn.execute(
+        "create table _rtrees " + "(tbl, chrom_column, start_column, end_column, name);"
+    )
+
+    for name, sql, chrom_column, indexes, keys in getExports():
+        exportTable(cursor, conn, name, sql, chrom_column, indexes, keys)
+        conn.commit()
+        print(f"{name} - done.")
+
+    conn.close()
+    source.close()
+    os.rename(building, path)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python reference.py <sqlite_path>")
+        sys.exit(1)
+
+    buildSQLite(sys.argv[1])
+    print(f"Reference tables written to {sys.argv[1]}")
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
@@ -6,11 +6,26 @@
 import sys
 import time
 import driver
+import snapshot
+import s3stream
+import bgzf
+import varcache
+import panel
 import os
+import json
+import shutil
+import hashlib
 import boto3
-from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError, ParamValidationError
 from botocore.config import Config
 
+# Import the message types shared with the utility services
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, "util")
+)
+import messages
+
 # Get configuration
 from configparser import ConfigParser, ExtendedInterpolation
 
@@ -40,149 +55,439 @@ class Timer(object):
             print(f"Approximate runtime: {self.secs:.2f} seconds")
 
 
-def main():
+"""Clients and reference handles shared by the jobs a process runs
+Opened once by each annotator worker (see workers.py), so its jobs skip
+the client setup and find the snapshot and variant lookups already open
+"""
 
-    # Get job parameters
-    jid = sys.argv[1]
-    in_file = sys.argv[2]
-    user_id = sys.argv[3]
-    run_file = f"{JOBS_DIR}/{jid}~{in_file}"
-
-    # Run the AnnTools pipeline
-    with Timer():
-        driver.run(run_file, "vcf")
-        # Open a connection to s3
-        s3_client = boto3.client(
-            "s3",
-            region_name=config["aws"]["AwsRegionName"],
-            config=Config(signature_version=config["aws"]["AwsSignatureVersion"]),
+
+class JobContext(object):
+    def __init__(self):
+        # Reference tables are read from a local snapshot when one is configured
+        self.reference = None
+        if config.get("ann", "SnapshotDir", fallback=""):
+            self.reference = snapshot.Snapshot(config.get("ann", "SnapshotDir"))
+            print(f"Using reference snapshot {self.reference.version}")
+        self.version = config.get("ann", "ReferenceVersion", fallback="rds")
+        if self.reference is not None:
+            self.version = self.reference.version
+
+        self.s3 = self.client("s3")
+        self.dynamodb = self.client("dynamodb")
+        self.sns = self.client("sns")
+
+        self.options = dict(
+            sweep=config.getboolean("ann", "SweepJoin", fallback=False),
+            index=config.getboolean("ann", "IntervalIndex", fallback=False),
+            snapshot=self.reference,
+            backend=config.get("ann", "Backend", fallback="mysql"),
+            backend_path=config.get("ann", "SQLitePath", fallback=""),
+            batch_size=config.getint("ann", "BatchSize", fallback=1000),
+            concurrent=config.getboolean("ann", "ConcurrentStages", fallback=False),
+            engine=config.get("ann", "Engine", fallback="batch"),
+            window=config.getint("ann", "AsyncWindow", fallback=4),
+            cache=self.openCache(),
         )
-        s3_results_bucket = config["s3"]["ResultsBucketName"]
-        cnet = config["DEFAULT"]["CnetId"]
-        completed_jobs_id = set() # Used set to prevent duplicate jobs update just in case
-        # Get all files in directory: https://www.geeksforgeeks.org/python-os-listdir-method/
-        for file_name in os.listdir(JOBS_DIR):
-            file_path = os.path.join(JOBS_DIR, file_name)
-            key = f"{cnet}/{user_id}/{file_name}"
-            job_id, f = file_name.split('~')
-            fn_without_ext = f.split('.')[0]
-            if file_name.endswith('.annot.vcf'):
-                try:
-                    # Upload files to AWS: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
-                    response = s3_client.upload_file(file_path, s3_results_bucket, key)
-                except ClientError as e:
-                    print(f"error: failure to upload results file {file_name} - {e}")
-                else:
-                    # Add to completed job only if the file has been successfully uploaded
-                    completed_jobs_id.add((job_id, fn_without_ext))
-            elif file_name.endswith('.count.log'):
-                try:
-                    response = s3_client.upload_file(file_path, s3_results_bucket, key)
-                except ClientError as e:
-                    print(f"error: failure to upload log file {file_name} - {e}")
-                else:
-                    completed_jobs_id.add((job_id, fn_without_ext))
-
-            if os.path.exists(file_path):
-                # If file exists, delete file in instance
-                try:
-                    os.remove(file_path)
-                except OSError as e:
-                    print(f"error: failed to remove local job files: {e}")
-
-        # Update jobs in DynamoDB
-        db_client = boto3.client(
-            "dynamodb",
+        self.compress = config.getboolean("ann", "CompressResults", fallback=False)
+
+    def client(self, service):
+        return boto3.client(
+            service,
             region_name=config["aws"]["AwsRegionName"],
             config=Config(signature_version=config["aws"]["AwsSignatureVersion"]),
         )
-        # Check if table exists first
-        table_name = config["gas"]["AnnotationsTable"]
-        try:
-            # Check if table exists: https://stackoverflow.com/questions/42485616/how-to-check-if-dynamodb-table-exists
-            response = db_client.describe_table(TableName=table_name)
-        except ClientError as e:
-            print("error: table not found - {e}")
-        # Update job info for each job
-        job_completion_times = {}
-        for job_id, fn_without_ext in completed_jobs_id:
-            try:
-                s3_key_result_file = f"{cnet}/{user_id}/{job_id}~{fn_without_ext}.annot.vcf"
-                s3_key_log_file = f"{cnet}/{user_id}/{job_id}~{fn_without_ext}.vcf.count.log"
-                complete_time = int(time.time())
-                job_completion_times[job_id] = complete_time
-                # Update table: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
-                # Example of updating table on conditional: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.UpdateItem.html
-                response = db_client.update_item(
-                    TableName=table_name,
-                    Key={'job_id': {'S': job_id}},                        
-                    ExpressionAttributeValues={
-                        ':job_status': {'S': 'COMPLETED'},
-                        ':s3_results_bucket': {'S': s3_results_bucket},
-                        ':s3_key_result_file': {'S': s3_key_result_file},
-                        ':s3_key_log_file': {'S': s3_key_log_file},
-                        ':complete_time': {'N': str(complete_time)},
-                    },
-                    UpdateExpression=
-                        'SET job_status = :job_status, \
-                        s3_results_bucket = if_not_exists(s3_results_bucket, :s3_results_bucket), \
-                        s3_key_result_file = if_not_exists(s3_key_result_file, :s3_key_result_file), \
-                        s3_key_log_file = if_not_exists(s3_key_log_file, :s3_key_log_file), \
-                        complete_time = if_not_exists(complete_time, :complete_time)', 
-                    ReturnValues="ALL_NEW"
+
+    """Annotations looked up before the stages run: the panel of common
+    variants built into the snapshot, then those of variants seen by
+    earlier jobs, kept per reference version
+    """
+
+    def openCache(self):
+        tiers = []
+        bypass = config.getboolean("ann", "VariantCacheBypass", fallback=False)
+        if self.reference is not None and not bypass:
+            if config.getboolean("ann", "UsePanel", fallback=True):
+                common = panel.openPanel(self.reference)
+                if common is not None:
+                    print(f"Using variant panel of {len(common)} annotations")
+                    tiers.append(common)
+        cache_path = config.get("ann", "VariantCachePath", fallback="")
+        if cache_path and not bypass:
+            tiers.append(
+                varcache.VariantCache(
+                    cache_path,
+                    self.version,
+                    max_entries=config.getint(
+                        "ann", "VariantCacheEntries", fallback=varcache.MAX_ENTRIES
+                    ),
                 )
-            except ClientError as e:
-                # Trap failure to update job info to DynamoDB
-                print(f"error: failed to update job info in database - {e}")
+            )
+        if len(tiers) == 0:
+            return None
+        if len(tiers) == 1:
+            return tiers[0]
+        return varcache.Tiers(tiers)
 
-        # Open a connection to sns
-        sns_client = boto3.client(
-            "sns",
-            region_name=config["aws"]["AwsRegionName"],
-            config=Config(signature_version=config["aws"]["AwsSignatureVersion"]),
+    def close(self):
+        if self.options["cache"] is not None:
+            self.options["cache"].close()
+
+
+"""Scratch directory of a job, holding its input and everything the
+pipeline writes for it, so concurrent jobs never see each other's files
+"""
+
+
+def getScratchDir(jid):
+    return os.path.join(JOBS_DIR, jid)
+
+
+"""Artifacts a job produces in its scratch directory, as {kind: path}:
+the results (unless streamed, when they are already in S3), the count
+log and, for compressed results, the tabix index if one was written
+"""
+
+
+def getManifest(run_file, compress=False, stream=False):
+    result_file, log_file = driver.getOutputNames(run_file, compress=compress)
+    manifest = {"log": log_file}
+    if not stream:
+        manifest["result"] = result_file
+    if compress and os.path.exists(result_file + ".tbi"):
+        manifest["index"] = result_file + ".tbi"
+    return manifest
+
+
+def uploadFile(s3_client, file_path, bucket, key):
+    try:
+        # Upload files to AWS: https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
+        s3_client.upload_file(file_path, bucket, key)
+    except ClientError as e:
+        print(f"error: failure to upload {os.path.basename(file_path)} - {e}")
+        return False
+    return True
+
+
+def publish(sns_client, target, message_type, data):
+    try:
+        # Publish message to sns: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
+        sns_client.publish(
+            # Use TargetArn for a specific target, TopicArn for multiple subscribers
+            TargetArn=target,
+            Message=message_type.encode(data),
         )
-        sns_results_target = config["sns"]["ResultsTopic"]
-        sns_archive_target = config["sns"]["ArchiveTopic"]
-        for job_id, _ in completed_jobs_id:
-            # Pass data needed for notification email
-            notify_data = {
-                "job_id": {"S": job_id}, 
-                "complete_time": {"N": str(job_completion_times[job_id])},
-                "user_id": {"S": user_id}, 
-            }
-            try:
-                # Publish message to sns: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
-                response = sns_client.publish(
-                                # Use TargetArn for a specific target, TopicArn for multiple subscribers
-                                TargetArn=sns_results_target,
-                                Message=str(notify_data), 
-                            )
-            except ParamValidationError as e:
-                # Trap parameter validation error
-                print(f"Invalid parameter error: {e}")
-            except ClientError as e:
-                # Trap failure to publish notification to SNS service
-                print(f"Failed to publish message: {e}")
-
-            # Pass data needed for archival
-            archive_data = {
-                "job_id": {"S": job_id}, 
-                "user_id": {"S": user_id}, 
-                "results_key": {"S": s3_key_result_file},
+    except messages.EncodeError as e:
+        # Trap a message that does not match its type
+        print(f"Invalid message: {e}")
+    except ParamValidationError as e:
+        # Trap parameter validation error
+        print(f"Invalid parameter error: {e}")
+    except ClientError as e:
+        # Trap failure to publish notification to SNS service
+        print(f"Failed to publish message: {e}")
+
+
+"""Names a job's input by its content: the S3 ETag of a streamed input,
+the SHA-256 of a downloaded one. Under the reference version and result
+format, identical inputs get the same name, and so the same results
+"""
+
+
+def getInputDigest(context, run_file, input_bucket=None, input_key=None):
+    if input_bucket is not None:
+        response = context.s3.head_object(Bucket=input_bucket, Key=input_key)
+        digest = "etag-" + response["ETag"].strip('"')
+    else:
+        sha256 = hashlib.sha256()
+        with open(run_file, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b""):
+                sha256.update(chunk)
+        digest = "sha256-" + sha256.hexdigest()
+    format = "vcf.gz" if context.compress else "vcf"
+    return f"{context.version}/{format}/{digest}"
+
+
+"""Results of earlier jobs, by input digest, as small JSON records in the
+results bucket naming the S3 keys of each artifact
+"""
+
+
+def getResultsRecordKey(digest):
+    return f"{config['DEFAULT']['CnetId']}/inputs/{digest}.json"
+
+
+def findResults(context, digest):
+    try:
+        response = context.s3.get_object(
+            Bucket=config["s3"]["ResultsBucketName"], Key=getResultsRecordKey(digest)
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+            print(f"error: failed to look up earlier results - {e}")
+        return None
+    return json.loads(response["Body"].read())
+
+
+def recordResults(context, digest, jid, keys):
+    try:
+        context.s3.put_object(
+            Bucket=config["s3"]["ResultsBucketName"],
+            Key=getResultsRecordKey(digest),
+            Body=json.dumps(dict(job_id=jid, keys=keys)).encode("utf-8"),
+        )
+    except ClientError as e:
+        print(f"error: failed to record results of job {jid} - {e}")
+
+
+def copyFile(s3_client, bucket, source, key):
+    try:
+        # Server-side (multipart, for large results) copy: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/copy.html
+        s3_client.copy({"Bucket": bucket, "Key": source}, bucket, key)
+    except ClientError as e:
+        print(f"error: failure to copy {source} - {e}")
+        return False
+    return True
+
+
+"""Runs one job and uploads its results; the input is read from
+jobs/<jid>/<jid>~<in_file>, or streamed from S3 when its bucket and key
+are given. Duplicate requests for the same job never get here: the job
+is only run by the instance that claimed it (see lease.py).
+
+A job whose input was annotated before, against the same reference, is
+given copies of the earlier results and log, made in S3 without running
+the pipeline; if the copies fail (e.g. the results were archived since)
+it runs as usual. Otherwise only the artifacts in the job's manifest are
+uploaded, each in a thread of its own. The job is marked COMPLETED as
+soon as its results and log are in S3, while the index upload and the
+notifications go on. The scratch directory is removed once the job is
+done with it.
+Returns True if the job completed
+"""
+
+
+def runJob(context, jid, in_file, user_id, input_bucket=None, input_key=None):
+    scratch_dir = getScratchDir(jid)
+    run_file = os.path.join(scratch_dir, f"{jid}~{in_file}")
+
+    cache = context.options["cache"]
+    if cache is not None:
+        cache.resetCounts()
+
+    try:
+        with Timer():
+            return processJob(context, jid, user_id, run_file, input_bucket, input_key)
+    finally:
+        try:
+            shutil.rmtree(scratch_dir)
+        except OSError as e:
+            print(f"error: failed to remove local job files: {e}")
+
+
+def processJob(context, jid, user_id, run_file, input_bucket=None, input_key=None):
+    s3_client = context.s3
+    s3_results_bucket = config["s3"]["ResultsBucketName"]
+    cnet = config["DEFAULT"]["CnetId"]
+    compress = context.compress
+    result_file, log_file = driver.getOutputNames(run_file, compress=compress)
+    s3_key_result_file = f"{cnet}/{user_id}/{os.path.basename(result_file)}"
+    s3_key_log_file = f"{cnet}/{user_id}/{os.path.basename(log_file)}"
+
+    # Results of an identical input, if it was annotated before
+    digest = None
+    previous = None
+    if config.getboolean("ann", "ReuseResults", fallback=False):
+        try:
+            digest = getInputDigest(context, run_file, input_bucket, input_key)
+        except (ClientError, OSError) as e:
+            print(f"error: failed to read input digest - {e}")
+        if digest is not None:
+            previous = findResults(context, digest)
+
+    db_client = context.dynamodb
+    table_name = config["gas"]["AnnotationsTable"]
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        # Check if table exists first, while the files upload
+        # Check if table exists: https://stackoverflow.com/questions/42485616/how-to-check-if-dynamodb-table-exists
+        table = executor.submit(db_client.describe_table, TableName=table_name)
+
+        completed = False
+        if previous is not None:
+            print(f"Reusing the results of job {previous['job_id']}")
+            keys = {
+                "result": s3_key_result_file,
+                "log": s3_key_log_file,
+                "index": s3_key_result_file + ".tbi",
             }
-            try:
-                # Publish message to sns: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
-                response = sns_client.publish(
-                                # Use TargetArn for a specific target, TopicArn for multiple subscribers
-                                TargetArn=sns_archive_target,
-                                Message=str(archive_data), 
-                            )
-            except ParamValidationError as e:
-                # Trap parameter validation error
-                print(f"Invalid parameter error: {e}")
-            except ClientError as e:
-                # Trap failure to publish notification to SNS service
-                print(f"Failed to publish message: {e}")
+            keys = dict([(kind, keys[kind]) for kind in previous["keys"]])
+            transfers = dict(
+                [
+                    (
+                        kind,
+                        executor.submit(
+                            copyFile,
+                            s3_client,
+                            s3_results_bucket,
+                            previous["keys"][kind],
+                            keys[kind],
+                        ),
+                    )
+                    for kind in keys
+                ]
+            )
+            completed = transfers["result"].result() and transfers["log"].result()
+
+        if not completed:
+            # Run the AnnTools pipeline
+            manifest = annotateJob(
+                context, run_file, s3_key_result_file, input_bucket, input_key
+            )
+            keys = dict(
+                [
+                    (kind, f"{cnet}/{user_id}/{os.path.basename(path)}")
+                    for kind, path in manifest.items()
+                ]
+            )
+            transfers = dict(
+                [
+                    (
+                        kind,
+                        executor.submit(
+                            uploadFile,
+                            s3_client,
+                            path,
+                            s3_results_bucket,
+                            keys[kind],
+                        ),
+                    )
+                    for kind, path in manifest.items()
+                ]
+            )
+
+            # The job is complete once its results and log are in S3
+            completed = transfers["log"].result()
+            if "result" in transfers:
+                completed = transfers["result"].result() and completed
+            if not completed:
+                return False
+            if digest is not None:
+                keys["result"] = s3_key_result_file
+                executor.submit(recordResults, context, digest, jid, keys)
+        try:
+            table.result()
+        except ClientError as e:
+            print(f"error: table not found - {e}")
+
+        # Update job info in DynamoDB
+        complete_time = int(time.time())
+        try:
+            # Update table: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
+            # Example of updating table on conditional: https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.UpdateItem.html
+            db_client.update_item(
+                TableName=table_name,
+                Key={"job_id": {"S": jid}},
+                ExpressionAttributeValues={
+                    ":job_status": {"S": "COMPLETED"},
+                    ":s3_results_bucket": {"S": s3_results_bucket},
+                    ":s3_key_result_file": {"S": s3_key_result_file},
+                    ":s3_key_log_file": {"S": s3_key_log_file},
+                    ":complete_time": {"N": str(complete_time)},
+                },
+                UpdateExpression="SET job_status = :job_status, \
+                    s3_results_bucket = if_not_exists(s3_results_bucket, :s3_results_bucket), \
+                    s3_key_result_file = if_not_exists(s3_key_result_file, :s3_key_result_file), \
+                    s3_key_log_file = if_not_exists(s3_key_log_file, :s3_key_log_file), \
+                    complete_time = if_not_exists(complete_time, :complete_time)",
+                ReturnValues="ALL_NEW",
+            )
+        except ClientError as e:
+            # Trap failure to update job info to DynamoDB
+            print(f"error: failed to update job info in database - {e}")
+
+        # Pass data needed for notification email
+        notify_data = {
+            "job_id": jid,
+            "complete_time": complete_time,
+            "user_id": user_id,
+        }
+        # Pass data needed for archival
+        archive_data = {
+            "job_id": jid,
+            "user_id": user_id,
+            "results_key": s3_key_result_file,
+        }
+        sns_client = context.sns
+        executor.submit(
+            publish,
+            sns_client,
+            config["sns"]["ResultsTopic"],
+            messages.RESULT,
+            notify_data,
+        )
+        executor.submit(
+            publish,
+            sns_client,
+            config["sns"]["ArchiveTopic"],
+            messages.ARCHIVE,
+            archive_data,
+        )
+    return True
+
+
+"""Runs the AnnTools pipeline over a job's input; returns the manifest
+of the artifacts left to upload (see getManifest)
+"""
+
+
+def annotateJob(context, run_file, s3_key_result_file, input_bucket, input_key):
+    s3_client = context.s3
+    options = context.options
+    compress = context.compress
+    result_file, log_file = driver.getOutputNames(run_file, compress=compress)
+
+    # annotator.py passes the input's bucket and key instead of downloading
+    # it when the job is streamed
+    stream = input_bucket is not None
+    if stream:
+        # Read the input straight from S3 and upload the results in
+        # parts as they are written; only the count log is kept locally
+        os.makedirs(os.path.dirname(run_file), exist_ok=True)
+        reader = s3stream.S3LineReader(s3_client, input_bucket, input_key)
+        with s3stream.S3MultipartWriter(
+            s3_client,
+            config["s3"]["ResultsBucketName"],
+            s3_key_result_file,
+            part_size=config.getint("ann", "StreamPartSize", fallback=8) << 20,
+        ) as writer:
+            if compress:
+                # The index is uploaded with the log below
+                tbi = bgzf.TabixIndex()
+                writer = bgzf.BgzfWriter(writer, index=tbi)
+            driver.runStream(reader, writer, log_file, "vcf", **options)
+            if compress:
+                writer.close()
+        if compress and not tbi.write(result_file + ".tbi"):
+            print("Results are not sorted by position - no index written")
+    else:
+        driver.run(
+            run_file,
+            "vcf",
+            fused=config.getboolean("ann", "FusedPipeline", fallback=False),
+            workers=config.getint("ann", "Workers", fallback=1),
+            compress=compress,
+            **options,
+        )
+    return getManifest(run_file, compress=compress, stream=stream)
+
+
+def main():
+
+    # Get job parameters: job id, input file name, user id and, for a
+    # streamed job, the input's bucket and key
+    context = JobContext()
+    completed = runJob(context, *sys.argv[1:6])
+    context.close()
+    sys.exit(0 if completed else 1)
 
 
 if __name__ == "__main__":
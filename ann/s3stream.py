@@ -0,0 +1,172 @@
+# s3stream.py
+# Streams annotation input from S3 and results back to it
+
+from concurrent.futures import ThreadPoolExecutor
+import bgzf
+from botocore.exceptions import BotoCoreError, ClientError
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+"""Lines of an S3 object, read with a streaming GET as they are consumed
+
+Lines keep their newline, as when iterating over a file. gzip and BGZF
+objects are decompressed as they arrive. If the stream breaks, the object
+is fetched again from the first byte not yet read with a ranged GET, up
+to retries times.
+"""
+
+
+class S3LineReader(object):
+    def __init__(self, s3, bucket, key, chunk_size=1024 * 1024, retries=3):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.bytes_read = 0
+
+    def open(self, offset):
+        if offset == 0:
+            return self.s3.get_object(Bucket=self.bucket, Key=self.key)["Body"]
+        return self.s3.get_object(
+            Bucket=self.bucket, Key=self.key, Range=f"bytes={offset}-"
+        )["Body"]
+
+    def __iter__(self):
+        pending = b""
+        attempts = 0
+        inflater = None
+        while True:
+            try:
+                body = self.open(self.bytes_read)
+                for chunk in body.iter_chunks(self.chunk_size):
+                    if self.bytes_read == 0 and chunk.startswith(bgzf.GZIP_MAGIC):
+                        inflater = bgzf.Inflater()
+                    self.bytes_read = self.bytes_read + len(chunk)
+                    if inflater is not None:
+                        chunk = inflater.decompress(chunk)
+                    lines = (pending + chunk).split(b"\n")
+                    pending = lines.pop()
+                    for line in lines:
+                        yield line.decode("utf-8") + "\n"
+                break
+            except BotoCoreError:
+                attempts = attempts + 1
+                if attempts > self.retries:
+                    raise
+        if len(pending) > 0:
+            yield pending.decode("utf-8")
+
+
+"""Writes text or bytes to an S3 object through a multipart upload
+
+Parts are sent as soon as part_size bytes have been written, at most
+threads at a time, so the upload keeps pace with the writer. close()
+completes the upload (a plain PUT if no part filled up); abort() drops the
+parts sent so far. Used as a context manager, the upload is aborted if the
+block raises.
+"""
+
+
+class S3MultipartWriter(object):
+    def __init__(self, s3, bucket, key, part_size=8 * 1024 * 1024, threads=4):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(int(part_size), MIN_PART_SIZE)
+        self.threads = threads
+
+        self.buffer = []
+        self.buffered = 0
+        self.bytes_written = 0
+        self.upload_id = None
+        self.parts = []
+        self.pending = []
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.buffer.append(data)
+        self.buffered = self.buffered + len(data)
+        self.bytes_written = self.bytes_written + len(data)
+        if self.buffered >= self.part_size:
+            self.flushPart()
+
+    def uploadPart(self, number, body):
+        response = self.s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=number,
+            Body=body,
+        )
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def flushPart(self):
+        if self.upload_id is None:
+            response = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            self.upload_id = response["UploadId"]
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+
+        # Bound the parts held in memory to those being uploaded
+        while len(self.pending) >= self.threads:
+            self.parts.append(self.pending.pop(0).result())
+
+        body = b"".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        number = len(self.parts) + len(self.pending) + 1
+        self.pending.append(self.executor.submit(self.uploadPart, number, body))
+
+    def close(self):
+        if self.upload_id is None:
+            self.s3.put_object(
+                Bucket=self.bucket, Key=self.key, Body=b"".join(self.buffer)
+            )
+            self.buffer = []
+            return
+
+        try:
+            if self.buffered > 0:
+                self.flushPart()
+            for future in self.pending:
+                self.parts.append(future.result())
+            self.pending = []
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+        except (BotoCoreError, ClientError):
+            self.abort()
+            raise
+        finally:
+            self.executor.shutdown()
+
+    def abort(self):
+        if self.upload_id is None:
+            return
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown()
+        try:
+            self.s3.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+        except ClientError as e:
+            print(f"error: failed to abort upload of {self.key} - {e}")
+        self.upload_id = None
+
+
+### EOF
@@ -0,0 +1,505 @@
+# snapshot.py
+# Memory-mapped reference snapshot of the annotator database
+#
+# Build:  python snapshot.py <snapshot_dir> [version]
+
+import sys
+import os
+import json
+import mmap
+import shutil
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import numpy as np
+
+import utils as u
+import intervals as iv
+import dbsnp
+
+FORMAT = 1
+
+"""Tables exported to a snapshot: (name, query, partition column, indexes)
+Each table is split into one partition per chromosome, sorted by the start
+column of its first index. Every (start, end) pair listed gets a prebuilt
+interval index. Queries match the columns the stages read from them.
+"""
+TABLES = [
+    ("refGene", "select * from refGene;", "chrom", [("txStart", "txEnd")]),
+    (
+        "cpgIslandExt",
+        "select chrom, chromStart, chromEnd, name from cpgIslandExt;",
+        "chrom",
+        [("chromStart", "chromEnd")],
+    ),
+    ("cytoBand", "select * from cytoBand;", "chrom", [("chromStart", "chromEnd")]),
+    ("gadAll", "select * from gadAll;", "chromosome", [("chromStart", "chromEnd")]),
+    (
+        "gwasCatalog",
+        "select * from gwasCatalog;",
+        "chrom",
+        [("chromEnd", "chromEnd")],
+    ),
+    ("hugo", "select * from hugo;", "chrom", [("chromStart", "chromEnd")]),
+    ("dgv_Cnv", "select * from dgv_Cnv;", "chrom", [("chromStart", "chromEnd")]),
+    ("conrad_Cnv", "select * from conrad_Cnv;", "chrom", [("chromStart", "chromEnd")]),
+    (
+        "mcCarroll_Cnv",
+        "select * from mcCarroll_Cnv;",
+        "chrom",
+        [("chromStart", "chromEnd")],
+    ),
+    (
+        "abParts_IG_T_CelReceptors",
+        "select * from abParts_IG_T_CelReceptors;",
+        "chrom",
+        [("chromStart", "chromEnd")],
+    ),
+    (
+        "genomicSuperDups",
+        "select * from genomicSuperDups;",
+        "chrom",
+        [("chromStart", "chromEnd")],
+    ),
+    (
+        "targetScanS",
+        "select * from targetScanS;",
+        "chrom",
+        [("chromStart", "chromEnd")],
+    ),
+    (
+        "chrom_pos_equal_base",
+        "select * from chrom_pos_equal_base;",
+        "CHR",
+        [("start", "start")],
+    ),
+    (
+        "chrom_pos_equal_nobase",
+        "select * from chrom_pos_equal_nobase;",
+        "CHR",
+        [("start", "start")],
+    ),
+    (
+        "chrom_pos_unequal",
+        "select * from chrom_pos_unequal;",
+        "CHR",
+        [("start", "end")],
+    ),
+]
+
+"""tfbsConsSites is stored as one table per chromosome; the snapshot keeps
+it as a single table partitioned by the same chromosome suffix
+"""
+TFBS_CHROMS = [str(c) for c in range(1, 23)] + ["X", "Y"]
+TFBS_INDEXES = [("chromStart", "chromEnd")]
+
+
+def getTfbsSql(chrIndex):
+    return (
+        "select chrom, chromStart, chromEnd, name from tfbsConsSites" + chrIndex + ";"
+    )
+
+
+"""Column kinds, picked from the values MySQL returned
+Integers and floats are stored as int64/float64 arrays, strings and blobs
+in a string heap with an int64 offsets array; any other type is kept as
+its string form. Columns with NULLs carry a null mask alongside.
+"""
+
+
+def getKind(values):
+    kinds = set()
+    for v in values:
+        if v is None:
+            continue
+        elif isinstance(v, int):
+            kinds.add("int")
+        elif isinstance(v, float):
+            kinds.add("float")
+        elif isinstance(v, (bytes, bytearray)):
+            kinds.add("bytes")
+        elif isinstance(v, str):
+            kinds.add("str")
+        elif isinstance(v, Decimal):
+            kinds.add("decimal")
+        else:
+            kinds.add("text")
+
+    if len(kinds) == 0:
+        return "str"
+    if len(kinds) == 1:
+        return kinds.pop()
+    if kinds == set(["int", "float"]):
+        return "float"
+    return "text"
+
+
+def encodeValue(kind, value):
+    if kind == "bytes":
+        return bytes(value)
+    return str(value).encode("utf-8")
+
+
+def decodeValue(kind, value):
+    if kind == "bytes":
+        return value
+    value = value.decode("utf-8")
+    if kind == "decimal":
+        return Decimal(value)
+    return value
+
+
+def writeColumn(path, name, kind, values):
+    nulls = np.fromiter((v is None for v in values), dtype=bool, count=len(values))
+    if nulls.any():
+        np.save(os.path.join(path, name + ".nulls.npy"), nulls)
+
+    if kind in ("int", "float"):
+        dtype = np.int64 if kind == "int" else np.float64
+        data = np.fromiter(
+            (0 if v is None else v for v in values), dtype=dtype, count=len(values)
+        )
+        np.save(os.path.join(path, name + ".npy"), data)
+        return
+
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    with open(os.path.join(path, name + ".heap"), "wb") as fh:
+        for i, v in enumerate(values):
+            if v is not None:
+                fh.write(encodeValue(kind, v))
+            offsets[i + 1] = fh.tell()
+    np.save(os.path.join(path, name + ".offsets.npy"), offsets)
+
+
+"""Writes one partition: columns sorted by the first index's start column,
+the original row order, and a prebuilt interval index per (start, end)
+"""
+
+
+def writePartition(path, columns, kinds, rows, indexes):
+    os.makedirs(path)
+
+    rowid = np.arange(len(rows), dtype=np.int64)
+    if len(indexes) > 0:
+        start_index = columns.index(indexes[0][0])
+        keys = [row[start_index] for row in rows]
+        if kinds[start_index] in ("int", "float") and None not in keys:
+            rowid = np.argsort(np.asarray(keys), kind="stable").astype(np.int64)
+    rows = [rows[i] for i in rowid.tolist()]
+    np.save(os.path.join(path, "rowid.npy"), rowid)
+
+    for c, name in enumerate(columns):
+        writeColumn(path, name, kinds[c], [row[c] for row in rows])
+
+    roots = {}
+    for start_column, end_column in indexes:
+        key = start_column + "-" + end_column
+        layout = buildPartitionLayout(path, start_column, end_column)
+        for name, array in zip(INDEX_ARRAYS, layout[:-1]):
+            np.save(os.path.join(path, key + "." + name + ".npy"), array)
+        roots[key] = [int(x) for x in layout[-1]]
+    return roots
+
+
+def buildPartitionLayout(path, start_column, end_column):
+    starts = loadArray(path, start_column)
+    ends = loadArray(path, end_column)
+    valid = ~(loadNulls(path, start_column, len(starts)))
+    valid &= ~(loadNulls(path, end_column, len(ends)))
+
+    # Rows with a NULL bound never match a range query
+    positions = np.flatnonzero(valid).astype(np.int64)
+    layout = list(iv.buildLayout(starts[positions], ends[positions]))
+    layout[2] = positions[layout[2]]
+    return layout
+
+
+INDEX_ARRAYS = ["starts", "ends", "ids", "sub_start", "sub_len"]
+EMPTY_BOUNDS = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+
+def loadArray(path, name):
+    return np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+
+
+def loadNulls(path, name, count):
+    filename = os.path.join(path, name + ".nulls.npy")
+    if os.path.exists(filename):
+        return np.load(filename, mmap_mode="r")
+    return np.zeros(count, dtype=bool)
+
+
+def exportTable(cursor, sql, partition, partition_name=None):
+    cursor.execute(sql)
+    columns = [str(d[0]) for d in cursor.description]
+    rows = cursor.fetchall()
+    kinds = [getKind([row[c] for row in rows]) for c in range(len(columns))]
+
+    groups = {}
+    if partition_name is not None:
+        if len(rows) > 0:
+            groups[partition_name] = list(rows)
+    else:
+        p = columns.index(partition)
+        for row in rows:
+            groups.setdefault(str(row[p]), []).append(row)
+
+    return columns, kinds, groups
+
+
+"""Exports the reference tables into snapshot_dir/<version> and points
+snapshot_dir/CURRENT at it once the whole snapshot has been written
+"""
+
+
+def build(snapshot_dir, version=None):
+    if version is None:
+        version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+    path = os.path.join(snapshot_dir, version)
+    if os.path.exists(path):
+        raise FileExistsError(f"Snapshot {path} already exists")
+
+    building = path + ".building"
+    if os.path.exists(building):
+        shutil.rmtree(building)
+    os.makedirs(building)
+
+    manifest = {"format": FORMAT, "version": version, "tables": {}}
+    conn = u.db_connect()
+    cursor = conn.cursor()
+
+    exports = [
+        (name, [(sql, partition, None)], indexes)
+        for name, sql, partition, indexes in TABLES
+    ]
+    exports.append(
+        (
+            "tfbsConsSites",
+            [(getTfbsSql(c), None, c) for c in TFBS_CHROMS],
+            TFBS_INDEXES,
+        )
+    )
+
+    for name, queries, indexes in exports:
+        table = {"partitions": {}, "indexes": [list(x) for x in indexes]}
+        for sql, partition, partition_name in queries:
+            columns, kinds, groups = exportTable(cursor, sql, partition, partition_name)
+            table["columns"] = columns
+
+            for chrom in sorted(groups):
+                entry = str(len(table["partitions"]))
+                roots = writePartition(
+                    os.path.join(building, name, entry),
+                    columns,
+                    kinds,
+                    groups[chrom],
+                    indexes,
+                )
+                table["partitions"][chrom] = {
+                    "path": entry,
+                    "rows": len(groups[chrom]),
+                    "kinds": kinds,
+                    "roots": roots,
+                }
+
+        manifest["tables"][name] = table
+        print(f"{name} - {len(table['partitions'])} partitions")
+
+    # dbSNP is too large for the generic layout and gets its own index
+    manifest["dbSNP"] = dbsnp.build(os.path.join(building, "dbSNP"), conn)
+    print(f"dbSNP - {len(manifest['dbSNP']['chroms'])} chromosomes")
+
+    conn.close()
+
+    with open(os.path.join(building, "manifest.json"), "w") as fh:
+        json.dump(manifest, fh, indent=1)
+    os.rename(building, path)
+
+    current = os.path.join(snapshot_dir, "CURRENT")
+    with open(current + ".tmp", "w") as fh:
+        fh.write(version + "\n")
+    os.replace(current + ".tmp", current)
+
+    return version
+
+
+"""Read-only view of a snapshot
+Every array and string heap is memory-mapped, so processes on the same
+instance share the page-cached data and nothing is loaded up front.
+Without a version, the one named in snapshot_dir/CURRENT is opened.
+"""
+
+
+class Snapshot(object):
+    def __init__(self, snapshot_dir, version=None):
+        if version is None:
+            with open(os.path.join(snapshot_dir, "CURRENT")) as fh:
+                version = fh.read().strip()
+
+        self.snapshot_dir = snapshot_dir
+        self.path = os.path.join(snapshot_dir, version)
+        with open(os.path.join(self.path, "manifest.json")) as fh:
+            self.manifest = json.load(fh)
+
+        if self.manifest["format"] != FORMAT:
+            raise ValueError(
+                f"Snapshot {self.path} has format {self.manifest['format']}, "
+                + f"expected {FORMAT}"
+            )
+        self.version = self.manifest["version"]
+        self.tables = {}
+        self.dbsnp_index = None
+
+    def hasTable(self, name):
+        return name in self.manifest["tables"]
+
+    def table(self, name):
+        if name not in self.tables:
+            self.tables[name] = SnapshotTable(
+                os.path.join(self.path, name), self.manifest["tables"][name]
+            )
+        return self.tables[name]
+
+    def index(self, name, start_column="chromStart", end_column="chromEnd"):
+        return SnapshotIndex(self.table(name), start_column, end_column)
+
+    """Returns the dbSNP index, or None for snapshots built without one
+    """
+
+    def dbsnp(self):
+        if "dbSNP" not in self.manifest:
+            return None
+        if self.dbsnp_index is None:
+            self.dbsnp_index = dbsnp.DbSnpIndex(
+                os.path.join(self.path, "dbSNP"), self.manifest["dbSNP"]
+            )
+        return self.dbsnp_index
+
+
+class SnapshotTable(object):
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.columns = meta["columns"]
+        self.partitions = {}
+
+    def partition(self, chrom):
+        if chrom not in self.partitions:
+            entry = self.meta["partitions"].get(chrom)
+            self.partitions[chrom] = None
+            if entry is not None:
+                self.partitions[chrom] = SnapshotPartition(
+                    os.path.join(self.path, entry["path"]), self.columns, entry
+                )
+        return self.partitions[chrom]
+
+
+class SnapshotPartition(object):
+    def __init__(self, path, columns, entry):
+        self.path = path
+        self.columns = columns
+        self.kinds = entry["kinds"]
+        self.count = entry["rows"]
+        self.roots = entry["roots"]
+        self.rowid = loadArray(path, "rowid")
+        self.indexes = {}
+        self.readers = None
+
+    def __len__(self):
+        return self.count
+
+    def openColumn(self, c):
+        name = self.columns[c]
+        kind = self.kinds[c]
+        nulls = None
+        if os.path.exists(os.path.join(self.path, name + ".nulls.npy")):
+            nulls = loadNulls(self.path, name, self.count)
+
+        if kind in ("int", "float"):
+            data = loadArray(self.path, name)
+            cast = int if kind == "int" else float
+
+            def read(i):
+                if nulls is not None and nulls[i]:
+                    return None
+                return cast(data[i])
+
+            return read
+
+        offsets = loadArray(self.path, name + ".offsets")
+        heap = b""
+        if offsets[-1] > 0:
+            with open(os.path.join(self.path, name + ".heap"), "rb") as fh:
+                heap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        def read(i):
+            if nulls is not None and nulls[i]:
+                return None
+            return decodeValue(kind, heap[offsets[i] : offsets[i + 1]])
+
+        return read
+
+    """Returns row i (in start order) as the tuple MySQL would return
+    """
+
+    def row(self, i):
+        if self.readers is None:
+            self.readers = [self.openColumn(c) for c in range(len(self.columns))]
+        return tuple([read(i) for read in self.readers])
+
+    def index(self, start_column, end_column):
+        key = start_column + "-" + end_column
+        if key not in self.indexes:
+            if key in self.roots:
+                arrays = [loadArray(self.path, key + "." + n) for n in INDEX_ARRAYS]
+                self.indexes[key] = iv.IntervalIndex(*arrays, self.roots[key])
+            else:
+                self.indexes[key] = iv.IntervalIndex(
+                    *buildPartitionLayout(self.path, start_column, end_column)
+                )
+        return self.indexes[key]
+
+
+"""Overlap lookups against one snapshot table, with the same interface as
+intervals.TableIndex: rows come back in the order the table returned them
+"""
+
+
+class SnapshotIndex(object):
+    def __init__(self, table, start_column="chromStart", end_column="chromEnd"):
+        self.table = table
+        self.start_column = start_column
+        self.end_column = end_column
+
+    def overlaps(self, chrom, start, end=None):
+        partition = self.table.partition(chrom)
+        if partition is None:
+            return []
+
+        hits = partition.index(self.start_column, self.end_column).overlaps(start, end)
+        if len(hits) > 1:
+            rowid = partition.rowid
+            hits.sort(key=lambda i: rowid[i])
+        return [partition.row(i) for i in hits]
+
+    def getBounds(self, chrom):
+        partition = self.table.partition(chrom)
+        if partition is None:
+            return EMPTY_BOUNDS
+        return partition.index(self.start_column, self.end_column).getBounds()
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python snapshot.py <snapshot_dir> [version]")
+        sys.exit(1)
+
+    version = build(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    print(f"Snapshot {version} written to {sys.argv[1]}")
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
@@ -0,0 +1,98 @@
+# sweep.py
+# Sorted sweep-line join of VCF positions against reference range tables
+
+import heapq
+
+"""Raised when positions stop arriving in coordinate order
+"""
+
+
+class UnsortedInputError(Exception):
+    pass
+
+
+"""Merge-joins a coordinate-sorted VCF with one range table
+
+Rows for a chromosome are read once with a single query and visited in
+start order. As the VCF position advances, rows whose start has been
+reached are pushed onto an active heap keyed by end, and rows that end
+before the position are popped, so the heap always holds exactly the rows
+with start <= pos <= end. Rows are returned in the order the table
+returned them, the same order a per-variant query would give.
+
+load(chrom) must return the column names and every row on the
+chromosome; rows with a NULL bound never match.
+"""
+
+
+class SweepJoin(object):
+    def __init__(self, load, start_column="chromStart", end_column="chromEnd"):
+        self.load_rows = load
+        self.start_column = start_column
+        self.end_column = end_column
+
+        self.seen = set()
+        self.chrom = None
+        self.pos = None
+        self.rows = []
+        self.order = []
+        self.next = 0
+        self.heap = []
+        self.active = []
+
+    def load(self, chrom):
+        names, self.rows = self.load_rows(chrom)
+        self.start_index = names.index(self.start_column)
+        self.end_index = names.index(self.end_column)
+
+        valid = [
+            i
+            for i, row in enumerate(self.rows)
+            if row[self.start_index] is not None and row[self.end_index] is not None
+        ]
+        self.order = sorted(valid, key=lambda i: self.rows[i][self.start_index])
+        self.next = 0
+        self.heap = []
+        self.active = []
+        self.chrom = chrom
+        self.seen.add(chrom)
+
+    """Returns the rows overlapping pos on chrom
+    Raises UnsortedInputError if chrom was already left behind or pos is
+    behind the previous position on the same chromosome
+    """
+
+    def overlaps(self, chrom, pos):
+        if chrom != self.chrom:
+            if chrom in self.seen:
+                raise UnsortedInputError(f"{chrom} is not contiguous")
+            self.load(chrom)
+        elif pos < self.pos:
+            raise UnsortedInputError(f"{chrom}:{pos} follows {chrom}:{self.pos}")
+        self.pos = pos
+
+        changed = False
+        rows = self.rows
+        order = self.order
+        start = self.start_index
+        end = self.end_index
+
+        # Admit rows whose start has been reached
+        while self.next < len(order) and rows[order[self.next]][start] <= pos:
+            i = order[self.next]
+            heapq.heappush(self.heap, (rows[i][end], i))
+            self.next = self.next + 1
+            changed = True
+
+        # Retire rows that end before pos
+        while len(self.heap) > 0 and self.heap[0][0] < pos:
+            heapq.heappop(self.heap)
+            changed = True
+
+        if changed:
+            self.active = [rows[i] for i in sorted([i for _, i in self.heap])]
+
+        return self.active
+
+
+### EOF
@@ -0,0 +1,98 @@
+# transcripts.py
+# Parsed refGene transcript models shared by the gene structure stages
+
+import numpy as np
+
+"""One refGene row, parsed once
+
+Bounds, strand and promoter windows are read from the row up front; the
+exonStarts/exonEnds blobs are decoded into int64 arrays the first time a
+position is tested against them. Exon boundaries are closed on both ends,
+as in utils.isBetween.
+"""
+
+
+class TranscriptModel(object):
+    def __init__(self, row, promoter_offset=500):
+        self.row = row
+        self.strand = str(row[3])
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+
+        self.promoter_plus = self.txStart - int(promoter_offset)
+        self.promoter_minus = self.txEnd + int(promoter_offset)
+
+        self.exonStarts = None
+        self.exonEnds = None
+        self.ordered = False
+
+    def parseExons(self):
+        exonsSt = str(self.row[9].decode("utf-8")).split(",")
+        exonsEn = str(self.row[10].decode("utf-8")).split(",")
+        self.exonStarts = np.asarray(
+            [int(exonsSt[e]) for e in range(0, self.exonCount)], dtype=np.int64
+        )
+        self.exonEnds = np.asarray(
+            [int(exonsEn[e]) for e in range(0, self.exonCount)], dtype=np.int64
+        )
+
+        # refGene exons are sorted and disjoint, so the exons holding a
+        # position are a contiguous run found by two binary searches
+        self.ordered = bool(
+            np.all(self.exonStarts[1:] >= self.exonStarts[:-1])
+            and np.all(self.exonEnds[1:] >= self.exonEnds[:-1])
+        )
+
+    """Returns the (0-based) numbers of the exons containing pos, in order
+    """
+
+    def getExons(self, pos):
+        if self.exonStarts is None:
+            self.parseExons()
+
+        if self.ordered:
+            first = int(np.searchsorted(self.exonEnds, pos, side="left"))
+            last = int(np.searchsorted(self.exonStarts, pos, side="right"))
+            return range(first, max(first, last))
+
+        inside = (self.exonStarts <= pos) & (pos <= self.exonEnds)
+        return np.flatnonzero(inside).tolist()
+
+    """Exon label for exon e, numbered along the transcript's strand
+    """
+
+    def getExonLabel(self, e):
+        exnum = e + 1
+        if self.strand == "-":
+            exnum = self.exonCount - e
+        return "ex" + str(exnum) + "/" + str(self.exonCount)
+
+
+"""Transcript models for the life of a job, keyed by the row they were
+parsed from, so each transcript is parsed once however many variants
+fall in it
+"""
+
+
+class TranscriptModels(object):
+    def __init__(self, promoter_offset=500):
+        self.promoter_offset = promoter_offset
+        self.models = {}
+
+    def get(self, row):
+        try:
+            model = self.models.get(row)
+        except TypeError:
+            # Rows with unhashable values are parsed every time
+            return TranscriptModel(row, promoter_offset=self.promoter_offset)
+
+        if model is None:
+            model = TranscriptModel(row, promoter_offset=self.promoter_offset)
+            self.models[row] = model
+        return model
+
+
+### EOF
@@ -2,41 +2,213 @@
 
 import os
 import json
+import time
+import threading
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
+SECRET_ID = "rds/anntools_database"
+DATABASE_NAME = "annotator"
+
+# Seconds a fetched RDS secret is reused before Secrets Manager is asked again
+SECRET_TTL = 900
+
+# MySQL error code for a rejected user/password (ER_ACCESS_DENIED_ERROR)
+ACCESS_DENIED = 1045
+
+_secret = None
+_secret_time = 0.0
+_secret_lock = threading.Lock()
+
+"""Get the RDS secret, cached for SECRET_TTL seconds
+refresh=True skips the cache, e.g. after the password was rotated
+"""
+
+
+def getRdsSecret(refresh=False):
+    global _secret, _secret_time
+
+    with _secret_lock:
+        if (
+            not refresh
+            and _secret is not None
+            and time.monotonic() - _secret_time < SECRET_TTL
+        ):
+            return _secret
+
+        AWS_REGION_NAME = (
+            os.environ["AWS_REGION_NAME"]
+            if ("AWS_REGION_NAME" in os.environ)
+            else "us-east-1"
+        )
+
+        # Get RDS secret from AWS Secrets Manager
+        asm = boto3.client("secretsmanager", region_name=AWS_REGION_NAME)
+        try:
+            asm_response = asm.get_secret_value(SecretId=SECRET_ID)
+            _secret = json.loads(asm_response["SecretString"])
+        except ClientError as e:
+            print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+            raise e
+
+        _secret_time = time.monotonic()
+        return _secret
+
+
+def isAccessDenied(e):
+    return len(e.args) > 0 and e.args[0] == ACCESS_DENIED
+
+
 """Get connection to reference database
+A connection refused for bad credentials is retried once with a freshly
+fetched secret
 """
 
 
 def db_connect():
-    AWS_REGION_NAME = (
-        os.environ["AWS_REGION_NAME"]
-        if ("AWS_REGION_NAME" in os.environ)
-        else "us-east-1"
-    )
-
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client("secretsmanager", region_name=AWS_REGION_NAME)
-    try:
-        asm_response = asm.get_secret_value(SecretId="rds/anntools_database")
-        rds_secret = json.loads(asm_response["SecretString"])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
-
-    # Extract database connection parameters
-    rds_host = rds_secret["host"]
-    mysql_port = rds_secret["port"]
-    username = rds_secret["username"]
-    password = rds_secret["password"]
-    database_name = "annotator"
-
-    # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host, port=mysql_port, user=username, passwd=password, db=database_name
-    )
+    for refresh in (False, True):
+        rds_secret = getRdsSecret(refresh=refresh)
+        try:
+            # Return a connection to the database
+            return pymysql.connect(
+                host=rds_secret["host"],
+                port=rds_secret["port"],
+                user=rds_secret["username"],
+                passwd=rds_secret["password"],
+                db=DATABASE_NAME,
+            )
+        except pymysql.err.OperationalError as e:
+            if refresh or not isAccessDenied(e):
+                raise e
+            print("RDS credentials were rejected, refreshing secret")
+
+
+"""Process-wide pool of reference database connections
+acquire() hands out an idle connection when there is one (checked with a
+ping first) and opens a new one otherwise; release() puts it back for the
+next stage. Up to max_idle connections are kept open between uses.
+Acquire latency and reuse are counted for the job log
+"""
+
+
+class ConnectionPool(object):
+    def __init__(self, max_idle=4):
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+        self.opened = 0
+        self.acquired = 0
+        self.reused = 0
+        self.acquire_seconds = 0.0
+        self.max_acquire_seconds = 0.0
+
+    def open(self):
+        conn = db_connect()
+        with self.lock:
+            self.opened = self.opened + 1
+        return conn
+
+    def acquire(self):
+        t = time.monotonic()
+        conn = None
+        reused = False
+        while conn is None:
+            with self.lock:
+                candidate = self.idle.pop() if len(self.idle) > 0 else None
+            if candidate is None:
+                conn = self.open()
+                break
+            try:
+                candidate.ping(reconnect=False)
+                conn = candidate
+                reused = True
+            except pymysql.err.Error:
+                self.discard(candidate)
+
+        elapsed = time.monotonic() - t
+        with self.lock:
+            self.acquired = self.acquired + 1
+            if reused:
+                self.reused = self.reused + 1
+            self.acquire_seconds = self.acquire_seconds + elapsed
+            self.max_acquire_seconds = max(self.max_acquire_seconds, elapsed)
+        return conn
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                return
+        self.discard(conn)
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except pymysql.err.Error:
+            pass
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            self.discard(conn)
+
+    def addStats(self, stats):
+        with self.lock:
+            self.opened = self.opened + stats["opened"]
+            self.acquired = self.acquired + stats["acquired"]
+            self.reused = self.reused + stats["reused"]
+            self.acquire_seconds = self.acquire_seconds + stats["acquire_seconds"]
+            self.max_acquire_seconds = max(
+                self.max_acquire_seconds, stats["max_acquire_seconds"]
+            )
+
+    def getStats(self):
+        with self.lock:
+            return {
+                "opened": self.opened,
+                "acquired": self.acquired,
+                "reused": self.reused,
+                "acquire_seconds": self.acquire_seconds,
+                "max_acquire_seconds": self.max_acquire_seconds,
+            }
+
+    def summary(self):
+        stats = self.getStats()
+        mean = stats["acquire_seconds"] / max(stats["acquired"], 1)
+        return (
+            f"Reference connections: {stats['acquired']} acquired, "
+            + f"{stats['reused']} reused, {stats['opened']} opened; "
+            + f"acquire mean {mean * 1000:.1f} ms, "
+            + f"max {stats['max_acquire_seconds'] * 1000:.1f} ms"
+        )
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+"""Get the process-wide reference connection pool
+"""
+
+
+def getPool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
+
+
+"""Forgets the pool without closing its connections, for forked children
+whose inherited connections belong to the parent
+"""
+
+
+def resetPool():
+    global _pool
+    _pool = None
 
 
 """Column inices for pileup and VCF
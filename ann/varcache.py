@@ -0,0 +1,328 @@
+# varcache.py
+# Persistent cache of whole-pipeline annotations, shared by the jobs run
+# on an annotator instance
+
+import json
+import time
+import sqlite3
+import threading
+
+import annotate as ann
+
+MAX_ENTRIES = 1000000
+
+"""How the pipeline rewrites a record, and how to replay it
+
+The stages only ever reset ID, add to INFO and (once gadAll matches) put
+a space in front of every column but the first; what they add depends on
+the chromosome, position and alleles, and on whether INFO starts out as
+"." or ends with ";". getKey() names a record by exactly those; a record
+with stray whitespace around its fields or its own positionType in INFO
+(which the gene stages read back) gets no key and always runs live.
+
+getDelta() compares a record as read with what the pipeline wrote for it
+and returns [ID, INFO added, spaced, counts], counts holding what each
+stage's counters went up by; replay() applies a delta to another record
+with the same key. Stages' isHeader() must all reject the record.
+"""
+
+
+def getKey(fields, inds):
+    if len(fields) < 8 or "positionType" in fields[7]:
+        return None
+    for f in fields:
+        if f != f.strip():
+            return None
+
+    chrom = fields[inds[0]]
+    if chrom.startswith("chr"):
+        chrom = chrom[len("chr") :]
+    if "chr" in chrom:
+        return None
+    try:
+        pos = int(fields[inds[1]])
+    except ValueError:
+        return None
+
+    ref = ann.clean_mysql_chars(fields[inds[2]]).upper()
+    alt = ann.clean_mysql_chars(fields[inds[3]]).upper()
+    info = fields[7]
+    shape = "." if info == "." else (";" if info.endswith(";") else "")
+    return "\t".join([chrom, str(pos), ref, alt, shape])
+
+
+def getDelta(fields, annotated, counts):
+    if len(annotated) != len(fields) or annotated[0] != fields[0]:
+        return None
+    spaced = len(fields) > 1 and annotated[1] == " " + fields[1]
+    pad = " " if spaced else ""
+    for i in range(1, len(fields)):
+        if i != 2 and i != 7 and annotated[i] != pad + fields[i]:
+            return None
+    if not annotated[2].startswith(pad) or not annotated[7].startswith(pad):
+        return None
+
+    rsid = annotated[2][len(pad) :]
+    info = annotated[7][len(pad) :]
+    if fields[7] != ".":
+        if not info.startswith(fields[7]):
+            return None
+        info = info[len(fields[7]) :]
+    return [rsid, info, spaced, counts]
+
+
+def replay(fields, delta):
+    rsid, info, spaced, _ = delta
+    if fields[7] != ".":
+        info = fields[7] + info
+    pad = " " if spaced else ""
+    annotated = [fields[0]] + [pad + f for f in fields[1:]]
+    annotated[2] = pad + rsid
+    annotated[7] = pad + info
+    return annotated
+
+
+def isHeader(line, stages):
+    for stage in stages:
+        if stage.isHeader(line):
+            return True
+    return False
+
+
+"""Keys of the records of a batch not filled in yet, as {key: [index]}
+"""
+
+
+def getKeys(batch, stages):
+    keys = {}
+    for i, line in enumerate(batch.lines):
+        if i in batch.cached or isHeader(line, stages):
+            continue
+        key = getKey(batch.records[i], stages[0].inds)
+        if key is not None:
+            keys.setdefault(key, []).append(i)
+    return keys
+
+
+"""Fills in the records of a batch under the keys found, as {key: delta},
+and marks the rest to have their counts collected; returns the number of
+hits and misses
+"""
+
+
+def fillBatch(batch, keys, found):
+    hits = 0
+    for key, rows in keys.items():
+        if key in found:
+            delta = found[key]
+            for i in rows:
+                batch.fields[i] = replay(batch.records[i], delta)
+                batch.cached[i] = delta[3]
+                batch.counts.pop(i, None)
+            hits = hits + len(rows)
+        else:
+            for i in rows:
+                batch.counts[i] = {}
+                batch.keys[i] = key
+    return hits, sum([len(rows) for rows in keys.values()]) - hits
+
+
+"""Deltas of the records a batch ran through every stage, as {key: delta}
+"""
+
+
+def getDeltas(batch, stages):
+    deltas = {}
+    for i, counts in batch.counts.items():
+        if len(counts) != len(stages) or batch.keys[i] in deltas:
+            continue
+        delta = getDelta(
+            batch.lines[i].split(batch.sep),
+            batch.fields[i],
+            [counts[k] for k in range(len(stages))],
+        )
+        if delta is not None:
+            deltas[batch.keys[i]] = delta
+    return deltas
+
+
+"""Annotations of records already seen by earlier jobs, in a SQLite file
+
+Keyed as getKey() names a record, under the reference version the job
+runs against (the snapshot's, or the configured one for live RDS tables),
+so a new reference never serves old annotations. resolve() fills in the
+batch's records that hit, so the stages skip them, and store() saves the
+deltas of the rest once the stages are done. Entries beyond max_entries
+are evicted least recently used first; an entry's use is stamped with
+the wall clock, which every process sharing the file agrees on, so none
+sees its own entries as older than they are. Hits and misses are counted
+for the count log.
+"""
+
+
+class VariantCache(object):
+    def __init__(self, path, version, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.version = version
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        # Batches are resolved and stored from the engines' pool threads
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("pragma journal_mode=wal")
+        self.conn.execute(
+            "create table if not exists variants "
+            + "(key text primary key, value text not null, used integer not null)"
+        )
+        self.conn.execute("create index if not exists variants_used on variants (used)")
+        self.conn.commit()
+        self.entries = self.conn.execute("select count(*) from variants").fetchone()[0]
+
+    # Shards reopen the cache in their own process
+    def __reduce__(self):
+        return (VariantCache, (self.path, self.version, self.max_entries))
+
+    def getName(self, key):
+        return self.version + "\t" + key
+
+    def find(self, names):
+        found = {}
+        for k in range(0, len(names), 500):
+            chunk = names[k : k + 500]
+            rows = self.conn.execute(
+                "select key, value from variants where key in "
+                + f"({','.join(['?'] * len(chunk))})",
+                chunk,
+            ).fetchall()
+            found.update(rows)
+        return found
+
+    def resolve(self, batch, stages):
+        keys = getKeys(batch, stages)
+        with self.lock:
+            found = self.find([self.getName(key) for key in keys])
+            if len(found) > 0:
+                used = time.time_ns()
+                self.conn.executemany(
+                    "update variants set used = ? where key = ?",
+                    [(used, name) for name in found],
+                )
+                self.conn.commit()
+
+        found = dict(
+            [
+                (key, json.loads(found[self.getName(key)]))
+                for key in keys
+                if self.getName(key) in found
+            ]
+        )
+        hits, misses = fillBatch(batch, keys, found)
+        self.hits = self.hits + hits
+        self.misses = self.misses + misses
+
+    def store(self, batch, stages):
+        deltas = getDeltas(batch, stages)
+        if len(deltas) == 0:
+            return
+
+        with self.lock:
+            # Another process may have stored some of the same records
+            names = [self.getName(key) for key in deltas]
+            added = len(names) - len(self.find(names))
+            used = time.time_ns()
+            self.conn.executemany(
+                "insert or replace into variants (key, value, used) values (?, ?, ?)",
+                [
+                    (
+                        self.getName(key),
+                        json.dumps(delta, separators=(",", ":")),
+                        used,
+                    )
+                    for key, delta in deltas.items()
+                ],
+            )
+            self.conn.commit()
+            self.entries = self.entries + added
+            if self.entries > self.max_entries:
+                self.evict()
+
+    """Drops the least recently used entries down to 90% of max_entries
+    """
+
+    def evict(self):
+        self.entries = self.conn.execute("select count(*) from variants").fetchone()[0]
+        excess = self.entries - int(self.max_entries * 0.9)
+        if excess <= 0:
+            return
+        self.conn.execute(
+            "delete from variants where key in "
+            + "(select key from variants order by used limit ?)",
+            (excess,),
+        )
+        self.conn.commit()
+        self.entries = self.entries - excess
+
+    def getCounts(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def addCounts(self, counts):
+        self.hits = self.hits + counts["hits"]
+        self.misses = self.misses + counts["misses"]
+
+    def resetCounts(self):
+        self.hits = 0
+        self.misses = 0
+
+    def writeLog(self, fh_log):
+        total = self.hits + self.misses
+        ratio = (self.hits / float(total)) * 100 if total > 0 else 0.0
+        fh_log.write(
+            f"Variant cache: {str(self.hits)} hits, {str(self.misses)} misses "
+            + f"({str(ratio)}% hit rate)\n"
+        )
+
+    def close(self):
+        self.conn.close()
+
+
+"""Lookups tried in turn, e.g. a precomputed panel (see panel.py) before
+the variant cache: each resolves the records those before it missed, and
+each stores what it keeps of the records run live
+"""
+
+
+class Tiers(object):
+    def __init__(self, tiers):
+        self.tiers = tiers
+
+    def resolve(self, batch, stages):
+        for tier in self.tiers:
+            tier.resolve(batch, stages)
+
+    def store(self, batch, stages):
+        for tier in self.tiers:
+            tier.store(batch, stages)
+
+    def getCounts(self):
+        return [tier.getCounts() for tier in self.tiers]
+
+    def addCounts(self, counts):
+        for tier, tier_counts in zip(self.tiers, counts):
+            tier.addCounts(tier_counts)
+
+    def resetCounts(self):
+        for tier in self.tiers:
+            tier.resetCounts()
+
+    def writeLog(self, fh_log):
+        for tier in self.tiers:
+            tier.writeLog(fh_log)
+
+    def close(self):
+        for tier in self.tiers:
+            tier.close()
+
+
+### EOF
@@ -0,0 +1,180 @@
+# workers.py
+# Pool of long-lived annotation worker processes
+#
+# NOTE: This file lives on the AnnTools instance
+
+import threading
+import traceback
+import multiprocessing
+from multiprocessing import connection
+from collections import deque
+
+"""Preforked pool of processes that run annotation jobs
+
+Each worker calls init() once when it starts, to import what the jobs
+need and open the clients and reference handles they share, then runs
+handler(state, job_id, *args) for each job it is given, state being what
+init() returned. Jobs submitted wait in the pool's queue and go out one
+at a time to idle workers, so at most size run at once; free() tells how
+many more can be submitted without waiting. results() returns what the
+workers reported back, as (job_id, ok, message): ok is what the handler
+returned, and message the traceback if it raised. A worker that dies is
+replaced, and the job it was running reported as failed.
+
+Workers are forked by a fork server, a single-threaded process started
+with the pool, never by the process using the pool: that one runs lease
+heartbeats and request handlers in threads of its own, and a child forked
+while another thread holds a lock (stdout's, botocore's) can deadlock.
+The fork server imports __main__ and the modules in preload once, so the
+workers it forks start warm; init and handler must be importable from
+them. Workers are not daemonic, so a job can still split its input over
+worker processes of its own (see driver.runParallel); close() stops them.
+Jobs can be submitted from several threads, while another waits for
+results.
+"""
+
+
+class WorkerPool(object):
+    def __init__(self, size, init, handler, preload=()):
+        self.context = multiprocessing.get_context("forkserver")
+        self.context.set_forkserver_preload(["__main__"] + list(preload))
+        self.size = size
+        self.init = init
+        self.handler = handler
+        self.backlog = deque()
+        self.lock = threading.Lock()
+        self.closed = False
+
+        # Each worker is sent its jobs, and reports back, over a pipe of its
+        # own, so a worker that dies cannot leave a shared channel locked
+        self.workers = {}
+        self.conns = {}
+        self.idle = []
+        self.running = {}
+        for _ in range(size):
+            self.startWorker()
+
+    def startWorker(self):
+        conn, worker_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=serve, args=(worker_conn, self.init, self.handler)
+        )
+        process.start()
+        worker_conn.close()
+        self.workers[process.pid] = process
+        self.conns[process.pid] = conn
+        self.idle.append(process.pid)
+
+    def free(self):
+        with self.lock:
+            return max(0, self.size - len(self.running) - len(self.backlog))
+
+    def submit(self, job_id, *args):
+        with self.lock:
+            self.backlog.append((job_id, args))
+            self.dispatch()
+
+    def dispatch(self):
+        if self.closed:
+            return
+        while len(self.backlog) > 0 and len(self.idle) > 0:
+            pid = self.idle.pop()
+            job_id, args = self.backlog.popleft()
+            self.running[pid] = job_id
+            self.conns[pid].send((job_id, args))
+
+    """Returns the jobs finished since the last call, waiting up to timeout
+    seconds for the first one
+    """
+
+    def results(self, timeout=0):
+        with self.lock:
+            pids = dict([(conn, pid) for pid, conn in self.conns.items()])
+        ready = connection.wait(list(pids), timeout=timeout)
+
+        with self.lock:
+            results = []
+            for conn in ready:
+                results.extend(self.receive(pids[conn]))
+
+            for pid, process in list(self.workers.items()):
+                if process.is_alive():
+                    continue
+                # Its last report may have come in since the wait
+                results.extend(self.receive(pid))
+                del self.workers[pid]
+                self.conns.pop(pid).close()
+                if pid in self.idle:
+                    self.idle.remove(pid)
+                job_id = self.running.pop(pid, None)
+                if self.closed:
+                    # Shutting down: the job is not failed but cut short,
+                    # and goes back to the queue with its lease
+                    continue
+                if job_id is not None:
+                    results.append(
+                        (job_id, False, f"worker exited with status {process.exitcode}")
+                    )
+                self.startWorker()
+
+            self.dispatch()
+        return results
+
+    def receive(self, pid):
+        conn = self.conns[pid]
+        try:
+            if not conn.poll():
+                return []
+            job_id, ok, message = conn.recv()
+        except (EOFError, OSError):
+            # The worker is gone; see results()
+            return []
+        if self.running.get(pid) == job_id:
+            del self.running[pid]
+            self.idle.append(pid)
+        return [(job_id, ok, message)]
+
+    """Stops the workers once they finish the jobs they are running; jobs
+    still waiting are dropped, and results() reports the last ones done
+    without starting workers again
+    """
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            conns = [
+                self.conns[pid]
+                for pid, process in self.workers.items()
+                if process.is_alive()
+            ]
+        for conn in conns:
+            try:
+                conn.send(None)
+            except OSError:
+                # The worker died since (BrokenPipeError)
+                pass
+        for process in list(self.workers.values()):
+            process.join()
+
+
+"""Worker process: runs the jobs it is sent until it is sent None
+"""
+
+
+def serve(conn, init, handler):
+    state = init()
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        job_id, args = job
+        try:
+            ok = bool(handler(state, job_id, *args))
+            message = None
+        except Exception:
+            ok = False
+            message = traceback.format_exc()
+        conn.send((job_id, ok, message))
+
+
+### EOF
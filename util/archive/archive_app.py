@@ -6,12 +6,15 @@ import json
 import requests
 import sys
 import time
+import threading
 from botocore.exceptions import ClientError
 from botocore.client import Config
 
 from flask import Flask, request, jsonify
 sys.path.append('/home/ubuntu/gas/util')
 from helpers import get_user_profile 
+import consumer
+import messages
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
@@ -26,6 +29,112 @@ def home():
     return f"This is the Archive utility: POST requests to /archive."
 
 
+"""Starts the archival of one job's results, for a free user; see
+consumer.py
+"""
+
+
+def archive_job(data, receipt):
+    job_id = data['job_id']
+    user_id = data['user_id']
+    results_key = data['results_key']
+
+    print("data loaded from message")
+    # Check if the user is a free user before doing any archival task             
+    try:
+        profile = get_user_profile(id=user_id, db_name=app.config["ACCOUNTS_DATABASE"])
+        user_type = profile['role']
+        print("user profile/type checked")
+    except ClientError as e:
+        print(f"Failed to get email/user's profile: {e}")
+        return consumer.RETRY
+    except Exception as e:
+        print(f"Failed to get email/user's profile: {e}")
+        return consumer.RETRY   
+    
+    if user_type == "free_user":
+        print("free user")
+        # Open a connection to Step Functions
+        sfs = boto3.client(
+            "stepfunctions",
+            region_name=app.config["AWS_REGION_NAME"],
+            config=Config(signature_version=app.config["AWS_SIGNATURE_VERSION"]),
+        )
+
+        try:
+            # Describe state machine: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/stepfunctions/client/describe_state_machine.html
+            check_state_machine_response = sfs.describe_state_machine(stateMachineArn=app.config["AWS_STATE_MACHINE"])
+            print("checked step function state machine exist")
+        except Exception as e:
+            print({
+                "code": 404,
+                "status": "error",
+                "message": f"error: state machine does not exist - {e}"
+            }, 404)
+            return consumer.RETRY
+
+        # Start run procedure in the state machine
+        try:
+            # Data needed to pass into state machine 
+            data_to_step_func = {
+                'job_id': job_id,
+                'results_key': results_key,
+                's3_results_bucket': app.config["AWS_S3_RESULTS_BUCKET"],
+                'region_name': app.config["AWS_REGION_NAME"],
+                'signature_version': app.config["AWS_SIGNATURE_VERSION"],
+                'table_name' : app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"],
+                'glacier_vault_name': app.config["AWS_GLACIER_VAULT_NAME"],
+            }
+            # Request step function to start execution: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/stepfunctions/client/start_execution.html
+            sfs_response = sfs.start_execution(
+                stateMachineArn=app.config["AWS_STATE_MACHINE"],
+                input=json.dumps(data_to_step_func)
+            )
+            print("step function started execution")
+        except ClientError as e:
+            # Trap failure to start step function execution
+            print({
+                "code": 500,
+                "status": "error",
+                "message": f"error: failure to start step function execution - {e}"
+            }, 500)
+            return consumer.RETRY
+
+    # The message is deleted once the archival has started
+    return consumer.DONE
+
+
+"""Receives archive requests from SQS and handles them, AWS_SQS_HANDLERS
+at a time; the consumer is made by the first request
+"""
+archive_consumer = None
+consumer_lock = threading.Lock()
+
+
+def process_archive_requests():
+    global archive_consumer
+    with consumer_lock:
+        if archive_consumer is None:
+            # Open a connection to sqs
+            sqs_client = boto3.client(
+                "sqs",
+                region_name=app.config["AWS_REGION_NAME"],
+                config=Config(signature_version=app.config["AWS_SIGNATURE_VERSION"]),
+            )
+            archive_consumer = consumer.Consumer(
+                sqs_client,
+                app.config["AWS_SQS_ARCHIVE_QUEUE_NAME"],
+                archive_job,
+                messages.ARCHIVE.decode,
+                workers=int(app.config["AWS_SQS_HANDLERS"]),
+                max_messages=int(app.config["AWS_SQS_MAX_MESSAGES"]),
+                wait_time=int(app.config["AWS_SQS_WAIT_TIME"]),
+                dead_letter_url=app.config["AWS_SQS_ARCHIVE_DEAD_LETTER_QUEUE_NAME"],
+                max_receives=int(app.config["AWS_SQS_MAX_RECEIVES"]),
+            )
+    return archive_consumer.poll()
+
+
 @app.route("/archive", methods=["POST"])
 def archive_free_user_data():
 
@@ -75,25 +184,10 @@ def archive_free_user_data():
                 400,
             )
     elif message_type == 'Notification':
-        # Process job request
-        sqs = app.config["AWS_SQS_ARCHIVE_QUEUE_NAME"]
-
-        # Open a connection to sqs
-        sqs_client = boto3.client(
-            "sqs",
-            region_name=app.config["AWS_REGION_NAME"],
-            config=Config(signature_version=app.config["AWS_SIGNATURE_VERSION"]),
-        )
-
-        # Attempt to read the maximum number of messages from the queue
+        # Process archive requests
         try:
-            # SQS receive message: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/receive_message.html
-            sqs_msg_response = sqs_client.receive_message(
-                QueueUrl=sqs,
-                MaxNumberOfMessages=int(app.config["AWS_SQS_MAX_MESSAGES"]),
-                WaitTimeSeconds=int(app.config["AWS_SQS_WAIT_TIME"]),
-            )
-            print("sqs message received")
+            count = process_archive_requests()
+            print(f"{count} archive requests handled")
         except ClientError as e:
             # Trap failure to receive messages from SQS service
             print(f"Failed to receive message: {e}")
@@ -108,113 +202,6 @@ def archive_free_user_data():
                 500,
             )
 
-        # Process messages received
-        if 'Messages' in sqs_msg_response:
-            for msg in sqs_msg_response['Messages']:
-                # Extract job parameters from the message body 
-                data = json.loads(msg['Body'])['Message']
-                data = data.replace("'", '"')
-                data = json.loads(data)
-                # The unique receipt identifier is for deleting the message
-                receipt_identifier = msg['ReceiptHandle']
-
-                try:
-                    job_id = data['job_id']['S']
-                    user_id = data['user_id']['S']
-                    results_key = data['results_key']['S']
-                    if not job_id or not user_id or not results_key:
-                        print({
-                            "code": 400,
-                            "status": "error",
-                            "message": "error: empty field value"
-                        }, 400)
-                        continue
-                except KeyError as e:
-                    print({
-                        "code": 400,
-                        "status": "error",
-                        "message": f"error: key error {e}"
-                    }, 400)
-                    continue
-
-                print("data loaded from message")
-                # Check if the user is a free user before doing any archival task             
-                try:
-                    profile = get_user_profile(id=user_id, db_name=app.config["ACCOUNTS_DATABASE"])
-                    user_type = profile['role']
-                    print("user profile/type checked")
-                except ClientError as e:
-                    print(f"Failed to get email/user's profile: {e}")
-                    continue
-                except Exception as e:
-                    print(f"Failed to get email/user's profile: {e}")
-                    continue   
-                
-                if user_type == "free_user":
-                    print("free user")
-                    # Open a connection to Step Functions
-                    sfs = boto3.client(
-                        "stepfunctions",
-                        region_name=app.config["AWS_REGION_NAME"],
-                        config=Config(signature_version=app.config["AWS_SIGNATURE_VERSION"]),
-                    )
-
-                    try:
-                        # Describe state machine: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/stepfunctions/client/describe_state_machine.html
-                        check_state_machine_response = sfs.describe_state_machine(stateMachineArn=app.config["AWS_STATE_MACHINE"])
-                        print("checked step function state machine exist")
-                    except Exception as e:
-                        print({
-                            "code": 404,
-                            "status": "error",
-                            "message": f"error: state machine does not exist - {e}"
-                        }, 404)
-                        continue
-
-                    # Start run procedure in the state machine
-                    try:
-                        # Data needed to pass into state machine 
-                        data_to_step_func = {
-                            'job_id': job_id,
-                            'results_key': results_key,
-                            's3_results_bucket': app.config["AWS_S3_RESULTS_BUCKET"],
-                            'region_name': app.config["AWS_REGION_NAME"],
-                            'signature_version': app.config["AWS_SIGNATURE_VERSION"],
-                            'table_name' : app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"],
-                            'glacier_vault_name': app.config["AWS_GLACIER_VAULT_NAME"],
-                        }
-                        # Request step function to start execution: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/stepfunctions/client/start_execution.html
-                        sfs_response = sfs.start_execution(
-                            stateMachineArn=app.config["AWS_STATE_MACHINE"],
-                            input=json.dumps(data_to_step_func)
-                        )
-                        print("step function started execution")
-                    except ClientError as e:
-                        # Trap failure to start step function execution
-                        print({
-                            "code": 500,
-                            "status": "error",
-                            "message": f"error: failure to start step function execution - {e}"
-                        }, 500)
-                        continue
-
-                # Delete the message from the queue, if job was successfully submitted
-                try:
-                    # SQS delete message: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/delete_message.html
-                    sqs_response = sqs_client.delete_message(
-                        QueueUrl=sqs,
-                        ReceiptHandle=receipt_identifier
-                    )
-                    print("message deleted from sqs")
-                except ClientError as e:
-                    # Trap failure to delete messages from SQS service
-                    print({
-                        "code": 500,
-                        "status": "error",
-                        "message": f"Failed to delete message: {e}"
-                    }, 500)
-                    continue
-
     print("Success: Archive request processed.")
     return (
         jsonify(
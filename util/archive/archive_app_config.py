@@ -45,6 +45,11 @@ class Config(object):
     # AWS SQS queues
     AWS_SQS_WAIT_TIME = 20
     AWS_SQS_MAX_MESSAGES = 10
+    # Requests handled at once, and times a request is received before it
+    # goes to the dead-letter queue (if one is set) instead
+    AWS_SQS_HANDLERS = 10
+    AWS_SQS_MAX_RECEIVES = 5
+    AWS_SQS_ARCHIVE_DEAD_LETTER_QUEUE_NAME = None
     AWS_SQS_ARCHIVE_QUEUE_NAME = (
         f"https://sqs.us-east-1.amazonaws.com/127134666975/{iam_username}_a{HW}_job_archive"
     )
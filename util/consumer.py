@@ -0,0 +1,246 @@
+# consumer.py
+# Shared SQS consumer: receives messages in batches, runs a handler on
+# each in a bounded thread pool and deletes the ones handled in batches
+
+import ast
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from botocore.exceptions import ClientError
+
+# What a handler returns for a message: DONE deletes it, RETRY leaves it to
+# be received again once its visibility timeout runs out, and HELD leaves it
+# to the handler, which has taken over deleting it (e.g. under a lease)
+DONE = "done"
+RETRY = "retry"
+HELD = "held"
+
+# Messages received, and deleted, per SQS call at most
+BATCH_SIZE = 10
+
+"""Raised for a message that cannot be decoded; it will never be handled,
+so it goes straight to the dead-letter queue
+"""
+
+
+class DecodeError(ValueError):
+    pass
+
+
+"""Item carried by a message body: the Message of an SNS notification, or
+the body itself when it was sent to the queue directly, written as JSON
+or as a Python dict literal (the str() of a DynamoDB item)
+"""
+
+
+def decodeBody(body):
+    try:
+        data = json.loads(body)
+    except ValueError as e:
+        raise DecodeError(f"body is not JSON - {e}")
+    if isinstance(data, dict) and isinstance(data.get("Message"), str):
+        data = data["Message"]
+    if isinstance(data, str):
+        try:
+            data = json.loads(data)
+        except ValueError:
+            try:
+                data = ast.literal_eval(data)
+            except (ValueError, SyntaxError) as e:
+                raise DecodeError(f"message is not an item - {e}")
+    if not isinstance(data, dict):
+        raise DecodeError("message is not an item")
+    return data
+
+
+"""Runs handler(data, receipt) on the messages of an SQS queue, data being
+what decoder(body) makes of a message (e.g. messages.JOB.decode) and
+receipt its receipt handle
+
+Each poll() receives up to a batch of messages, as many as there are
+handler threads (and capacity(), if given, allows), decodes them and
+runs the handler on each in the pool, so the messages of a batch are
+handled concurrently. While handlers run, the visibility of their
+messages is extended every heartbeat seconds. The messages they are done
+with are deleted in one call.
+
+A message that does not decode, or that has been received max_receives
+times already, is sent to the dead-letter queue, if there is one, and
+deleted; without one it is left, as a handler that fails (raises) leaves
+its message, to be received again.
+"""
+
+
+class Consumer(object):
+    def __init__(
+        self,
+        sqs_client,
+        queue_url,
+        handler,
+        decoder,
+        workers=BATCH_SIZE,
+        max_messages=BATCH_SIZE,
+        wait_time=20,
+        visibility=None,
+        heartbeat=None,
+        dead_letter_url=None,
+        max_receives=None,
+        capacity=None,
+    ):
+        self.sqs = sqs_client
+        self.queue_url = queue_url
+        self.handler = handler
+        self.decoder = decoder
+        self.workers = workers
+        self.max_messages = min(max_messages, BATCH_SIZE)
+        self.wait_time = wait_time
+        self.visibility = visibility
+        self.heartbeat = heartbeat
+        self.dead_letter_url = dead_letter_url
+        self.max_receives = max_receives
+        self.capacity = capacity
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    """Receives and handles one batch of messages; returns the number
+    handled, or raises ClientError if the queue could not be read
+    """
+
+    def poll(self, wait_time=None):
+        count = min(self.max_messages, self.workers)
+        if self.capacity is not None:
+            count = min(count, self.capacity())
+        if count <= 0:
+            return 0
+
+        # SQS receive message: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/receive_message.html
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=count,
+            WaitTimeSeconds=self.wait_time if wait_time is None else wait_time,
+            AttributeNames=["ApproximateReceiveCount"],
+        )
+        messages = response.get("Messages", [])
+
+        done = []
+        running = {}
+        for message in messages:
+            receives = int(
+                message.get("Attributes", {}).get("ApproximateReceiveCount", 1)
+            )
+            if self.max_receives is not None and receives > self.max_receives:
+                if self.deadLetter(message, f"received {receives} times"):
+                    done.append(message)
+                continue
+            try:
+                decoded = self.decoder(message["Body"])
+            except DecodeError as e:
+                print(f"Failed to decode message {message['MessageId']}: {e}")
+                if self.deadLetter(message, str(e)):
+                    done.append(message)
+                continue
+            running[
+                self.executor.submit(self.handle, decoded, message["ReceiptHandle"])
+            ] = message
+
+        # Keep the messages being handled hidden until their handlers return
+        pending = set(running)
+        extended = time.time()
+        while len(pending) > 0:
+            timeout = None
+            if self.heartbeat is not None:
+                timeout = max(0, extended + self.heartbeat - time.time())
+            _, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if self.heartbeat is not None and time.time() >= extended + self.heartbeat:
+                self.extend([running[future] for future in pending])
+                extended = time.time()
+        for future, message in running.items():
+            if future.result() == DONE:
+                done.append(message)
+
+        self.delete(done)
+        return len(running)
+
+    def handle(self, data, receipt):
+        try:
+            result = self.handler(data, receipt)
+        except Exception as e:
+            print(f"Failed to handle message: {e}")
+            return RETRY
+        return DONE if result is None else result
+
+    def extend(self, messages):
+        if self.visibility is None:
+            return
+        for k in range(0, len(messages), BATCH_SIZE):
+            try:
+                # Change visibility in batches: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/change_message_visibility_batch.html
+                self.sqs.change_message_visibility_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[
+                        {
+                            "Id": str(i),
+                            "ReceiptHandle": message["ReceiptHandle"],
+                            "VisibilityTimeout": self.visibility,
+                        }
+                        for i, message in enumerate(messages[k : k + BATCH_SIZE])
+                    ],
+                )
+            except ClientError as e:
+                print(f"Failed to extend message visibility: {e}")
+
+    def delete(self, messages):
+        for k in range(0, len(messages), BATCH_SIZE):
+            try:
+                # SQS delete messages in batches: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/delete_message_batch.html
+                response = self.sqs.delete_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[
+                        {"Id": str(i), "ReceiptHandle": message["ReceiptHandle"]}
+                        for i, message in enumerate(messages[k : k + BATCH_SIZE])
+                    ],
+                )
+            except ClientError as e:
+                print(f"Failed to delete messages: {e}")
+                continue
+            for failure in response.get("Failed", []):
+                print(f"Failed to delete message: {failure.get('Message')}")
+
+    """Sends a message to the dead-letter queue; returns True if it was, so
+    it can be deleted here
+    """
+
+    def deadLetter(self, message, reason):
+        if self.dead_letter_url is None:
+            return False
+        try:
+            self.sqs.send_message(
+                QueueUrl=self.dead_letter_url,
+                MessageBody=message["Body"],
+                MessageAttributes={
+                    "reason": {"DataType": "String", "StringValue": reason},
+                    "source": {"DataType": "String", "StringValue": self.queue_url},
+                },
+            )
+        except ClientError as e:
+            print(f"Failed to send message to the dead-letter queue: {e}")
+            return False
+        return True
+
+    """Polls for as long as the process runs, backing off a little when
+    the queue cannot be read
+    """
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except ClientError as e:
+                print(f"Failed to receive message: {e}")
+                time.sleep(1)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+### EOF
@@ -0,0 +1,139 @@
+# messages.py
+# Messages the GAS services publish to each other through SNS and SQS:
+# job requests, job results, archive requests and thaw requests
+
+import json
+
+from consumer import DecodeError, decodeBody
+
+# Version of the message format written by encode(); decode() reads it and
+# every older one, back to the str() of a DynamoDB item (version 0)
+VERSION = 1
+
+# Largest message SNS accepts, in bytes; it is also the limit for the
+# whole of a publish_batch request, so messages are kept compact
+MAX_SIZE = 256 * 1024
+
+"""Raised for values that do not make a valid message
+"""
+
+
+class EncodeError(ValueError):
+    pass
+
+
+"""Message of one type, with its fields named with their attribute type,
+"S" for strings or "N" for integers
+
+encode() checks the values given and writes them as compact JSON, along
+with the type and format version:
+
+    {"type":"thaw","version":1,"user_id":"..."}
+
+decode() reads a message body back into a dict of plain values, checking
+that it is of this type and that every field is there, not empty and of
+its type. Fields listed as optional may be left out, and are then None.
+Messages published before the format was versioned, the str() of a
+DynamoDB item, are still read.
+"""
+
+
+class MessageType(object):
+    def __init__(self, name, fields, optional=()):
+        self.name = name
+        self.fields = fields
+        self.optional = optional
+
+    def encode(self, values):
+        unknown = set(values) - set(self.fields)
+        if len(unknown) > 0:
+            raise EncodeError(
+                f"{self.name} message with unknown fields {sorted(unknown)}"
+            )
+        message = {"type": self.name, "version": VERSION}
+        for field, kind in self.fields.items():
+            value = values.get(field)
+            if value is None or value == "":
+                if field in self.optional:
+                    continue
+                raise EncodeError(f"{self.name} message without {field}")
+            if not isValue(kind, value):
+                raise EncodeError(f"{self.name} message with bad {field}")
+            message[field] = value
+        body = json.dumps(message, separators=(",", ":"))
+        if len(body.encode("utf-8")) > MAX_SIZE:
+            raise EncodeError(f"{self.name} message over {MAX_SIZE} bytes")
+        return body
+
+    def decode(self, body):
+        item = decodeBody(body)
+        version = item.get("version", 0)
+        if version == 0:
+            # The str() of a DynamoDB item: each value under its type
+            item = dict(
+                [
+                    (field, item[field].get(kind))
+                    for field, kind in self.fields.items()
+                    if isinstance(item.get(field), dict)
+                ]
+            )
+        elif not isinstance(version, int) or version > VERSION:
+            raise DecodeError(f"{self.name} message of unknown version {version}")
+        elif item.get("type") != self.name:
+            raise DecodeError(f"{item.get('type')} message, not {self.name}")
+
+        values = {}
+        for field, kind in self.fields.items():
+            value = item.get(field)
+            if value is None or value == "":
+                if field in self.optional:
+                    values[field] = None
+                    continue
+                raise DecodeError(f"{self.name} message without {field}")
+            if kind == "N" and isinstance(value, str):
+                try:
+                    value = int(value)
+                except ValueError:
+                    raise DecodeError(f"{self.name} message with bad {field}")
+            if not isValue(kind, value):
+                raise DecodeError(f"{self.name} message with bad {field}")
+            values[field] = value
+        return values
+
+
+def isValue(kind, value):
+    if kind == "N":
+        return isinstance(value, int) and not isinstance(value, bool)
+    return isinstance(value, str)
+
+
+"""Job requests, published by the web app for the annotators
+"""
+JOB = MessageType(
+    "job",
+    {
+        "job_id": "S",
+        "user_id": "S",
+        "input_file_name": "S",
+        "s3_inputs_bucket": "S",
+        "s3_key_input_file": "S",
+        "submit_time": "N",
+        "job_status": "S",
+    },
+)
+
+"""Job results, published by run.py for the notification utility
+"""
+RESULT = MessageType("result", {"job_id": "S", "complete_time": "N", "user_id": "S"})
+
+"""Archive requests, published by run.py for the archive utility
+"""
+ARCHIVE = MessageType("archive", {"job_id": "S", "user_id": "S", "results_key": "S"})
+
+"""Thaw requests, published by the web app when a user upgrades, for the
+thaw utility
+"""
+THAW = MessageType("thaw", {"user_id": "S"})
+
+
+### EOF
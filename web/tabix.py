@@ -0,0 +1,189 @@
+# tabix.py
+# Region queries on BGZF-compressed annotation results through their
+# tabix (.tbi) index, reading only the blocks that hold the region
+
+import gzip
+import struct
+import zlib
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+# A BGZF block never exceeds 64 KiB compressed
+MAX_BLOCK_SIZE = 1 << 16
+LINEAR_SHIFT = 14
+
+"""Parses a tabix index into {chrom: (bins, linear)}, where bins maps a
+bin number to its (start, end) virtual offset chunks and linear holds the
+smallest record offset of every 16 kb window
+"""
+
+
+def parse_index(data):
+    data = gzip.decompress(data)
+    if data[:4] != b"TBI\1":
+        raise ValueError("not a tabix index")
+    n_ref = struct.unpack("<i", data[4:8])[0]
+    l_nm = struct.unpack("<i", data[32:36])[0]
+    names = data[36 : 36 + l_nm].split(b"\0")[:n_ref]
+    pos = 36 + l_nm
+
+    index = {}
+    for name in names:
+        bins = {}
+        n_bin = struct.unpack("<i", data[pos : pos + 4])[0]
+        pos += 4
+        for _ in range(n_bin):
+            bin, n_chunk = struct.unpack("<Ii", data[pos : pos + 8])
+            pos += 8
+            chunks = struct.unpack(f"<{2 * n_chunk}Q", data[pos : pos + 16 * n_chunk])
+            pos += 16 * n_chunk
+            bins[bin] = list(zip(chunks[0::2], chunks[1::2]))
+        n_intv = struct.unpack("<i", data[pos : pos + 4])[0]
+        pos += 4
+        linear = struct.unpack(f"<{n_intv}Q", data[pos : pos + 8 * n_intv])
+        pos += 8 * n_intv
+        index[name.decode("utf-8")] = (bins, linear)
+    return index
+
+
+"""Bins of the binning scheme that may hold records overlapping [beg, end),
+0-based
+"""
+
+
+def reg2bins(beg, end):
+    end = end - 1
+    bins = [0]
+    for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+"""Virtual offset chunks that may hold records overlapping [beg, end) on
+chrom, sorted and merged where they touch
+"""
+
+
+def get_chunks(index, chrom, beg, end):
+    if chrom not in index:
+        return []
+    bins, linear = index[chrom]
+
+    # Records starting before the first offset of the window holding beg
+    # cannot reach it
+    window = beg >> LINEAR_SHIFT
+    min_offset = 0
+    if len(linear) > 0:
+        min_offset = linear[min(window, len(linear) - 1)]
+
+    chunks = []
+    for bin in reg2bins(beg, end):
+        for start, stop in bins.get(bin, []):
+            if stop > min_offset:
+                chunks.append((max(start, min_offset), stop))
+    chunks.sort()
+
+    merged = []
+    for start, stop in chunks:
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+"""Inflates consecutive BGZF blocks, returning the uncompressed bytes and
+the compressed offset (relative to data) of each block in them
+"""
+
+
+def inflate_blocks(data):
+    out = []
+    blocks = {}
+    pos = 0
+    size = 0
+    while pos + 18 <= len(data):
+        bsize = struct.unpack("<H", data[pos + 16 : pos + 18])[0] + 1
+        if pos + bsize > len(data):
+            break
+        block = zlib.decompress(data[pos + 18 : pos + bsize - 8], -zlib.MAX_WBITS)
+        blocks[pos] = size
+        out.append(block)
+        size += len(block)
+        pos += bsize
+    return b"".join(out), blocks
+
+
+"""Reads the records of one chunk with a single byte-range GET
+"""
+
+
+def read_chunk(s3, bucket, key, start, stop):
+    first = start >> 16
+    last = stop >> 16
+    # The block holding stop is only needed if the chunk ends inside it
+    end = last + MAX_BLOCK_SIZE if stop & 0xFFFF else last
+    response = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={first}-{end - 1}")
+    data, blocks = inflate_blocks(response["Body"].read())
+    begin = blocks[0] + (start & 0xFFFF)
+    finish = (
+        blocks[last - first] + (stop & 0xFFFF) if last - first in blocks else len(data)
+    )
+    return data[begin:finish]
+
+
+"""Parsed index of a result object, kept for the most recently queried
+results and revalidated against the index's ETag on every query
+"""
+
+INDEX_CACHE_SIZE = 64
+index_cache = OrderedDict()
+
+
+def load_index(s3, bucket, key):
+    cached = index_cache.get((bucket, key))
+    try:
+        if cached is None:
+            response = s3.get_object(Bucket=bucket, Key=key + ".tbi")
+        else:
+            response = s3.get_object(
+                Bucket=bucket, Key=key + ".tbi", IfNoneMatch=cached[0]
+            )
+    except ClientError as e:
+        if cached is None or e.response["Error"]["Code"] not in ("304", "NotModified"):
+            raise
+        index_cache.move_to_end((bucket, key))
+        return cached[1]
+
+    index = parse_index(response["Body"].read())
+    index_cache[(bucket, key)] = (response["ETag"], index)
+    index_cache.move_to_end((bucket, key))
+    if len(index_cache) > INDEX_CACHE_SIZE:
+        index_cache.popitem(last=False)
+    return index
+
+
+"""Returns the lines of records on chrom overlapping the 1-based, closed
+region [start, end] of a BGZF result indexed at key + ".tbi"
+"""
+
+
+def query_region(s3, bucket, key, chrom, start, end):
+    index = load_index(s3, bucket, key)
+    beg = start - 1
+
+    lines = []
+    for chunk_start, chunk_stop in get_chunks(index, chrom, beg, end):
+        data = read_chunk(s3, bucket, key, chunk_start, chunk_stop)
+        for line in data.decode("utf-8").splitlines():
+            fields = line.split("\t", 4)
+            if len(fields) < 4 or fields[0] != chrom:
+                continue
+            pos = int(fields[1]) - 1
+            if pos < end and pos + max(len(fields[3]), 1) > beg:
+                lines.append(line)
+    return lines
+
+
+### EOF
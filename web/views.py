@@ -1,6 +1,8 @@
 # views.py
 # Application logic 
 
+import os
+import sys
 import uuid
 import time
 import json
@@ -11,13 +13,17 @@ from botocore.client import Config
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError, ParamValidationError
 
-from flask import abort, flash, redirect, render_template, request, session, url_for
+from flask import abort, flash, redirect, render_template, request, session, url_for, Response
 
 from app import app, db
 from decorators import authenticated, is_premium
 
 from auth import get_profile
 
+# Import the message types shared with the annotator and utility services
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, "util"))
+import messages
+
 """Start annotation request
 Create the required AWS S3 policy document and render a form for
 uploading an annotation input file using the policy document
@@ -130,6 +136,23 @@ def create_annotation_job_request():
 
     user_id = session["primary_identity"]
 
+    # Build the job request message first, so a job that cannot be
+    # published is never persisted, left PENDING with no request for it
+    try:
+        job_message = messages.JOB.encode({
+            "job_id": job_ID,
+            "user_id": user_id,
+            "input_file_name": input_file,
+            "s3_inputs_bucket": in_bucket,
+            "s3_key_input_file": in_key,
+            "submit_time": submit_time,
+            "job_status": "PENDING",
+        })
+    except messages.EncodeError as e:
+        # Trap a job request that does not match the message type
+        app.logger.error(f"Invalid job request: {e}")
+        return abort(400)
+
     # Create a job item and persist it to the annotations database
     data = {
         "job_id": {"S": job_ID}, 
@@ -179,7 +202,7 @@ def create_annotation_job_request():
         response = sns_client.publish(
                         # Use TargetArn for a specific target, TopicArn for multiple subscribers
                         TargetArn=sns_target,
-                        Message=str(data),
+                        Message=job_message,
                     )
     except ParamValidationError as e:
         # Trap parameter validation error
@@ -367,18 +390,29 @@ def annotation_details(id):
         if 's3_key_result_file' in annotation:
             results_bucket = annotation['s3_results_bucket']['S']
             result_file_key = annotation['s3_key_result_file']['S']
+            # Download under the user's file name, "input.annot.vcf" or
+            # "input.annot.vcf.gz" when the results are BGZF compressed
+            result_file_name = result_file_key.split('/')[-1].split('~', 1)[-1]
+            result_params = {
+                'Bucket': results_bucket,
+                'Key': result_file_key,
+                'ResponseContentDisposition': f'attachment; filename="{result_file_name}"',
+            }
+            if result_file_name.endswith('.gz'):
+                result_params['ResponseContentType'] = 'application/gzip'
             try:
                 # Generate presigned url to download s3 object: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/generate_presigned_url.html
                 # Example of how to use generate_presigned_url: https://stackoverflow.com/questions/56802869/how-can-i-let-a-user-download-a-file-from-an-s3-bucket-when-clicking-on-a-button
                 result_file_presigned_url = s3.generate_presigned_url(
                     ClientMethod='get_object',
-                    Params={'Bucket': results_bucket, 'Key': result_file_key},
+                    Params=result_params,
                     ExpiresIn=app.config["AWS_SIGNED_REQUEST_EXPIRATION"],
                 )
             except ClientError as e:
                 app.logger.error(f"Unable to generate presigned URL to download result file: {e}")
                 return abort(500)
             annotation['result_file_link'] = {'S': result_file_presigned_url}
+            annotation['result_file_name'] = {'S': result_file_name}
 
     return render_template("annotation.html", annotation=annotation, block_results=block_results, retrieval=retrieval_in_progress)
 
@@ -462,6 +496,81 @@ def annotation_log(id):
     return render_template("view_log.html", log=log)
 
 
+"""Serve the annotated records in a region of an annotation job's results
+Reads only the BGZF blocks holding the region, found through the tabix
+index uploaded next to the results; region is 1-based and inclusive
+"""
+import tabix
+
+
+@app.route("/annotations/<id>/region", methods=["GET"])
+@authenticated
+def annotation_region(id):
+    chrom = request.args.get('chrom')
+    try:
+        start = int(request.args.get('start', ''))
+        end = int(request.args.get('end', ''))
+    except ValueError:
+        app.logger.error("error: region start/end missing or not integers")
+        return abort(400)
+    if not chrom or start < 1 or end < start:
+        app.logger.error(f"error: invalid region {chrom}:{start}-{end}")
+        return abort(400)
+
+    # Open a connection to dynamoDB
+    db_client = boto3.client(
+        "dynamodb",
+        region_name=app.config["AWS_REGION_NAME"],
+        config=Config(signature_version=app.config["AWS_SIGNATURE_VERSION"]),
+    )
+    table_name = app.config["AWS_DYNAMODB_ANNOTATIONS_TABLE"]
+    user_id = session["primary_identity"]
+
+    try:
+        # get_item: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/table/get_item.html
+        get_item_response = db_client.get_item(TableName=table_name, Key={'job_id': {'S': id}})
+    except ClientError as e:
+        app.logger.error(f"error: failed to query database - {e}")
+        return abort(500)
+    if 'Item' not in get_item_response:
+        return abort(404)
+    annotation = get_item_response['Item']
+
+    if annotation['user_id']['S'] != user_id:
+        # Trap forbidden access
+        app.logger.error(f"error: forbidden access, job {id} does not belong to the user {user_id}")
+        return abort(403)
+
+    # Archived results are not in S3 until they are restored; their index
+    # stays, as the restored object is the same
+    if 'results_file_archive_id' in annotation and annotation['results_file_archive_id']['S']:
+        app.logger.error(f"error: results of job {id} are archived")
+        return abort(404)
+
+    result_file_key = annotation.get('s3_key_result_file', {}).get('S', '')
+    if not result_file_key.endswith('.gz'):
+        # Only BGZF-compressed results carry an index
+        app.logger.error(f"error: results of job {id} are not indexed")
+        return abort(404)
+
+    s3 = boto3.client(
+        "s3",
+        region_name=app.config["AWS_REGION_NAME"],
+        config=Config(signature_version=app.config["AWS_SIGNATURE_VERSION"]),
+    )
+    try:
+        lines = tabix.query_region(
+            s3, annotation['s3_results_bucket']['S'], result_file_key, chrom, start, end
+        )
+    except ClientError as e:
+        # Trap index or results not found
+        app.logger.error(f"error: failed to read region from results - {e}")
+        return abort(404)
+
+    body = "".join([line + "\n" for line in lines])
+    return Response(body, mimetype="text/plain")
+
+
 """Subscription management handler
 """
 import stripe
@@ -484,7 +593,16 @@ def subscribe():
             # Trap stripe_token missing error
             app.logger.error("error: stripe token missing")
             return abort(400)
-        
+
+        # Build the thaw request message before charging the customer, so
+        # an upgrade never goes through without it
+        try:
+            thaw_message = messages.THAW.encode({"user_id": session["primary_identity"]})
+        except messages.EncodeError as e:
+            # Trap a thaw request that does not match the message type
+            app.logger.error(f"Invalid thaw request: {e}")
+            return abort(400)
+
         # Create a customer on Stripe
         # Stripe API Create Customer: https://docs.stripe.com/api/customers/create
         stripe.api_key = app.config["STRIPE_SECRET_KEY"]
@@ -570,15 +688,11 @@ def subscribe():
         )
         sns_target = app.config["AWS_SNS_JOB_THAW_TOPIC"]
         try:
-            user_id = session["primary_identity"]
-            data = {
-                "user_id": {"S": user_id}, 
-            }
             # Publish message to sns: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
             sns_response = sns.publish(
                             # Use TargetArn for a specific target, TopicArn for multiple subscribers
                             TargetArn=sns_target,
-                            Message=str(data),
+                            Message=thaw_message,
                         )
         except ParamValidationError as e:
             # Trap parameter validation error